@@ -1,5 +1,7 @@
-from django.contrib import admin
-from .models import Medicine, Supplier, Customer, Inventory, SupplierPhone
+from django.contrib import admin, messages
+from .models import Medicine, Supplier, Customer, Inventory, SupplierPhone, StockMovement, TableCounter
+from .ledger import record_movements
+from .shards import enable_sharding, disable_sharding
 
 # 定义电话的内联显示
 class SupplierPhoneInline(admin.TabularInline):
@@ -22,9 +24,77 @@ class SupplierAdmin(admin.ModelAdmin):
 
 @admin.register(Inventory)
 class InventoryAdmin(admin.ModelAdmin):
-    list_display = ['medicine', 'batch_number', 'quantity', 'expiry_date']
+    list_display = ['medicine', 'batch_number', 'show_quantity', 'expiry_date', 'is_sharded']
+    list_filter = ['is_sharded']
     search_fields = ['medicine__common_name', 'batch_number']
+    actions = ['make_sharded', 'make_unsharded']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_live_quantity()
+
+    def get_readonly_fields(self, request, obj=None):
+        """已有批次的数量只能通过 "调整库存" 修改，保证每次变动都有流水"""
+        if obj is not None:
+            return ['quantity', 'is_sharded']
+        return ['is_sharded']
+
+    def save_model(self, request, obj, form, change):
+        """新增批次时记一条期初流水 (同 inventory_create)，changeform_view 本身已在事务中执行"""
+        super().save_model(request, obj, form, change)
+        if not change:
+            record_movements([(obj, obj.quantity)], 'opening', employee=request.user, unit_cost=obj.medicine.buy_price)
+
+    # 自定义方法：分片批次显示主行 + 各分片的总数量
+    def show_quantity(self, obj):
+        return obj.total_quantity
+    show_quantity.short_description = "当前数量"
+
+    @admin.action(description="开启分片计数 (热销批次)")
+    def make_sharded(self, request, queryset):
+        enabled = 0
+        for pk in queryset.values_list('pk', flat=True):
+            try:
+                enable_sharding(pk)
+                enabled += 1
+            except ValueError as e:
+                self.message_user(request, str(e), messages.ERROR)
+        if enabled:
+            self.message_user(request, "已开启分片计数")
+
+    @admin.action(description="关闭分片计数")
+    def make_unsharded(self, request, queryset):
+        for pk in queryset.values_list('pk', flat=True):
+            disable_sharding(pk)
+        self.message_user(request, "已关闭分片计数")
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    """库存流水 (只读)"""
+    list_display = ['created_at', 'inventory', 'reason', 'source_id', 'quantity', 'balance', 'employee']
+    list_filter = ['reason', 'created_at']
+    search_fields = ['inventory__medicine__common_name', 'inventory__batch_number']
+    list_select_related = ['inventory__medicine', 'employee']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 admin.site.register(Medicine)
 # admin.site.register(Supplier)  
-admin.site.register(Customer)
\ No newline at end of file
+admin.site.register(Customer)
+
+@admin.register(TableCounter)
+class TableCounterAdmin(admin.ModelAdmin):
+    """表行数计数 (只读，自动维护，可用 refresh_table_counters 命令校正)"""
+    list_display = ['table', 'rows']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
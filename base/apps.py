@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def ensure_search_triggers(sender, using, **kwargs):
+    """migrate 之后补建 FTS 同步触发器 (SQLite 重建表时会丢失表上的触发器)"""
+    from django.db import connections
+    from .search import install_search_index
+    install_search_index(connections[using], create_tables=False)
 
 
 class BaseConfig(AppConfig):
     name = 'base'
-    verbose_name = '02. 基础资料与库存'
\ No newline at end of file
+    verbose_name = '02. 基础资料与库存'
+
+    def ready(self):
+        from .counters import connect_counters
+        post_migrate.connect(ensure_search_triggers, sender=self)
+        connect_counters()
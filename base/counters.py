@@ -0,0 +1,60 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from .models import Inventory, Medicine, TableCounter
+
+# ==========================================
+# 数据表行数计数 (TableCounter)
+# ==========================================
+# 不带筛选条件的药品库存 / 药品信息列表用计数显示总页数，不对整张表 COUNT(*)。
+#   - 新增/删除单行时 (post_save created / post_delete)，在同一事务中对计数 +1 / -1
+#   - 绕过信号的批量新增 (biz/stock.py 进货入库新建批次的 bulk_create) 调用 add() 手工累加
+#   - 计数行不存在时 (新库、升级后) 首次读取时 COUNT 一次补建；refresh_table_counters 全量校正
+# 计数只用于显示 "约 N 页"，翻页是否还有下一页由分页器多取一行判断 (base/pagination.py)，偏差不影响翻页。
+
+COUNTED_MODELS = (Medicine, Inventory)
+
+
+def _key(model):
+    return model._meta.label
+
+
+def add(model, delta):
+    """计数加 delta (计数行不存在时忽略，首次读取时会按实际行数补建)"""
+    if delta:
+        TableCounter.objects.filter(table=_key(model)).update(rows=F('rows') + delta)
+
+
+def recount(model):
+    """按实际行数重写计数，返回行数"""
+    rows = model.objects.count()
+    TableCounter.objects.update_or_create(table=_key(model), defaults={'rows': rows})
+    return rows
+
+
+def estimated_count(model):
+    """表的估计行数 (一次主键查询)"""
+    rows = TableCounter.objects.filter(table=_key(model)).values_list('rows', flat=True).first()
+    if rows is None:
+        rows = recount(model)
+    return max(rows, 0)
+
+
+def refresh_table_counters():
+    """校正全部计数，返回 {表: 行数}"""
+    return {_key(model): recount(model) for model in COUNTED_MODELS}
+
+
+def count_created(sender, instance, created, **kwargs):
+    if created:
+        add(sender, 1)
+
+
+def count_deleted(sender, instance, **kwargs):
+    add(sender, -1)
+
+
+def connect_counters():
+    """注册计数信号 (BaseConfig.ready 调用)"""
+    for model in COUNTED_MODELS:
+        post_save.connect(count_created, sender=model, dispatch_uid=f'table_counter_created_{_key(model)}')
+        post_delete.connect(count_deleted, sender=model, dispatch_uid=f'table_counter_deleted_{_key(model)}')
@@ -0,0 +1,71 @@
+from datetime import timedelta
+from django.db.models import BooleanField, Case, Count, Q, Sum, Value, When
+from django.utils import timezone
+from .models import Inventory
+
+# ==========================================
+# 效期风险 (临期 / 过期库存)
+# ==========================================
+# 看板的各区间数字由一条条件聚合 (Count/Sum + filter) 一次算出，不再逐区间各查一遍。
+# 查询条件与部分索引 idx_inv_expiry_in_stock 的谓词一致 (quantity > 0 或分片批次)，
+# 数据库只扫描有库存的批次，历史上卖空的批次再多也不影响看板速度。
+
+# 临期提示阈值 (天)，药品库存列表的 "临期" 标记与此一致
+EXPIRING_SOON_DAYS = 90
+
+# 看板区间：(编码, 名称, 距今天数上限)；依次判断，超过最后一档为 "安全"
+# 有效期当天即算已过期，与库存估值 (base/valuation.py) 和销售先到期先出 (只分配 expiry_date > 今天) 一致
+EXPIRY_WINDOWS = [
+    ('30d', '30 天内到期', 30),
+    ('60d', '31-60 天到期', 60),
+    ('90d', '61-90 天到期', 90),
+]
+
+
+def in_stock():
+    """有库存的批次 (命中部分索引)，附加实时总数量 live_quantity"""
+    return (
+        Inventory.objects.filter(Q(quantity__gt=0) | Q(is_sharded=True))
+        .with_live_quantity()
+        .filter(live_quantity__gt=0)
+    )
+
+
+def expiring_soon(days=EXPIRING_SOON_DAYS):
+    """SQL 表达式：有效期在 days 天内 (含已过期) 为 True，供 annotate / order_by 使用"""
+    warning_date = timezone.localdate() + timedelta(days=days)
+    return Case(
+        When(expiry_date__lte=warning_date, then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    )
+
+
+def expiry_overview():
+    """
+    各效期区间的批次数和数量 (一条查询)，返回按区间排列的列表：
+    [{'code', 'label', 'batches', 'quantity'}]，依次为 已过期、30/60/90 天内、安全
+    """
+    today = timezone.localdate()
+    windows = [('expired', '已过期', Q(expiry_date__lte=today))]
+    lower = today + timedelta(days=1)
+    for code, label, days in EXPIRY_WINDOWS:
+        upper = today + timedelta(days=days)
+        windows.append((code, label, Q(expiry_date__gte=lower, expiry_date__lte=upper)))
+        lower = upper + timedelta(days=1)
+    windows.append(('safe', '安全', Q(expiry_date__gte=lower)))
+
+    aggregates = {}
+    for code, label, condition in windows:
+        aggregates[f'{code}_batches'] = Count('pk', filter=condition)
+        aggregates[f'{code}_quantity'] = Sum('live_quantity', filter=condition)
+    result = in_stock().aggregate(**aggregates)
+    return [
+        {
+            'code': code,
+            'label': label,
+            'batches': result[f'{code}_batches'],
+            'quantity': result[f'{code}_quantity'] or 0,
+        }
+        for code, label, condition in windows
+    ]
@@ -0,0 +1,136 @@
+from django.db import transaction
+from django.db.models import F, Max, Sum
+from django.utils import timezone
+from .models import Inventory, StockMovement, StockSnapshot
+from .shards import live_quantities, sharded_ids, take_from_shards
+
+# ==========================================
+# 库存流水账
+# ==========================================
+# 所有改变 Inventory.quantity 的地方都要通过这里留下流水：
+#   - 单据审核 (biz/stock.py 批量过账后调用 record_movements)
+#   - 手工调整 (adjust_inventory)
+# 每日快照 (take_snapshot) 让历史结余查询 (stock_as_of) 只需读一份快照加少量尾部流水。
+
+
+def record_movements(postings, reason, source_id=None, employee=None, note='', unit_cost=None):
+    """
+    批量追加流水 (一条 INSERT)。
+    postings: [(inventory, 变动数量)]，inventory.quantity 必须已经是变动后的结余。
+    unit_cost 只对期初结存有意义 (FIFO 成本计算用)。
+    分片批次的结余按 "主行 + 各分片" 汇总 (已带 live_quantity 的直接使用，其余一条查询补齐)。
+    """
+    now = timezone.now()
+    sharded = [
+        inventory.pk for inventory, delta in postings
+        if delta and inventory.is_sharded and not hasattr(inventory, 'live_quantity')
+    ]
+    live = live_quantities(sharded) if sharded else {}
+    StockMovement.objects.bulk_create([
+        StockMovement(
+            inventory_id=inventory.pk,
+            reason=reason,
+            source_id=source_id,
+            quantity=delta,
+            balance=live.get(inventory.pk, getattr(inventory, 'live_quantity', inventory.quantity)),
+            unit_cost=unit_cost,
+            created_at=now,
+            employee=employee,
+            note=note,
+        )
+        for inventory, delta in postings
+        if delta
+    ])
+
+
+def adjust_inventory(inventory_id, delta, reason, employee=None, note=''):
+    """
+    手工调整库存并记流水，返回调整后的结余。
+    使用条件 UPDATE 原子完成 "检查 + 修改"，不会出现读-改-写覆盖别人的修改。
+    分片批次减少时先从分片扣减，不够的部分再从主行扣减。
+    """
+    with transaction.atomic():
+        from_main = delta
+        if delta < 0 and sharded_ids([inventory_id]):
+            from_main = -take_from_shards({inventory_id: -delta}).get(inventory_id, 0)
+        updated = Inventory.objects.filter(
+            pk=inventory_id, quantity__gte=max(-from_main, 0)
+        ).update(quantity=F('quantity') + from_main)
+        if not updated:
+            raise ValueError("调整后数量不能为负数")
+        inventory = Inventory.objects.with_live_quantity().get(pk=inventory_id)
+        record_movements([(inventory, delta)], reason, employee=employee, note=note)
+    return inventory.total_quantity
+
+
+def take_snapshot(snapshot_date=None):
+    """
+    生成 (或重新生成) 某一天的库存快照，返回快照行数。
+    新快照 = 上一份快照 + 两份快照之间的流水，整个过程只读流水表，
+    不受同时在写 Inventory 的审核操作影响。
+    """
+    taken_at = timezone.now()
+    snapshot_date = snapshot_date or timezone.localdate(taken_at)
+
+    with transaction.atomic():
+        watermark = StockMovement.objects.aggregate(m=Max('id'))['m'] or 0
+        StockSnapshot.objects.filter(snapshot_date=snapshot_date).delete()
+
+        previous = StockSnapshot.objects.filter(snapshot_date__lt=snapshot_date).aggregate(d=Max('snapshot_date'))['d']
+        balances = {}
+        since_id = 0
+        if previous:
+            for inventory_id, balance, last_id in StockSnapshot.objects.filter(
+                snapshot_date=previous
+            ).values_list('inventory_id', 'balance', 'last_movement_id'):
+                balances[inventory_id] = balance
+                since_id = last_id
+
+        tail = (
+            StockMovement.objects.filter(id__gt=since_id, id__lte=watermark)
+            .values('inventory_id')
+            .annotate(delta=Sum('quantity'))
+        )
+        for row in tail:
+            balances[row['inventory_id']] = balances.get(row['inventory_id'], 0) + row['delta']
+
+        # 只保留仍然存在的批次
+        alive = set(Inventory.objects.filter(pk__in=list(balances)).values_list('pk', flat=True))
+        StockSnapshot.objects.bulk_create([
+            StockSnapshot(
+                snapshot_date=snapshot_date,
+                taken_at=taken_at,
+                inventory_id=inventory_id,
+                balance=balance,
+                last_movement_id=watermark,
+            )
+            for inventory_id, balance in balances.items()
+            if inventory_id in alive
+        ], batch_size=1000)
+    return len(alive)
+
+
+def stock_as_of(when, inventory_ids=None):
+    """
+    查询某一时刻的库存结余，返回 {inventory_id: 结余}。
+    读取 when 之前最近的一份快照，再加上快照之后、when 之前的流水。
+    """
+    snapshots = StockSnapshot.objects.filter(taken_at__lte=when)
+    movements = StockMovement.objects.filter(created_at__lte=when)
+    if inventory_ids is not None:
+        snapshots = snapshots.filter(inventory_id__in=inventory_ids)
+        movements = movements.filter(inventory_id__in=inventory_ids)
+
+    latest = snapshots.aggregate(d=Max('snapshot_date'))['d']
+    balances = {}
+    since_id = 0
+    if latest:
+        for inventory_id, balance, last_id in snapshots.filter(
+            snapshot_date=latest
+        ).values_list('inventory_id', 'balance', 'last_movement_id'):
+            balances[inventory_id] = balance
+            since_id = last_id
+
+    for row in movements.filter(id__gt=since_id).values('inventory_id').annotate(delta=Sum('quantity')):
+        balances[row['inventory_id']] = balances.get(row['inventory_id'], 0) + row['delta']
+    return balances
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from base.models import Medicine
+from base.pinyin import name_pinyin
+
+class Command(BaseCommand):
+    help = 'Fill in Medicine.pinyin / pinyin_initials from the common name (after upgrading, importing or bulk-writing medicines)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every medicine, not only those without pinyin')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Medicines updated per transaction (default 1000)')
+
+    def handle(self, *args, **options):
+        medicines = Medicine.objects.order_by('pk')
+        if not options['all']:
+            medicines = medicines.filter(pinyin_initials='')
+        batch_size = options['batch_size']
+
+        # 按主键分块读取和写回，每块一个事务
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(medicines.filter(pk__gt=last_pk).only('pk', 'common_name', 'pinyin', 'pinyin_initials')[:batch_size])
+            if not batch:
+                break
+            changed = []
+            for medicine in batch:
+                values = name_pinyin(medicine.common_name)
+                if values != (medicine.pinyin, medicine.pinyin_initials):
+                    medicine.pinyin, medicine.pinyin_initials = values
+                    changed.append(medicine)
+            with transaction.atomic():
+                Medicine.objects.bulk_update(changed, ['pinyin', 'pinyin_initials'])
+            total += len(changed)
+            last_pk = batch[-1].pk
+            self.stdout.write(f"  up to #{last_pk}: {len(changed)} updated")
+
+        self.stdout.write(self.style.SUCCESS(f"Pinyin filled in for {total} medicines."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from base.models import Inventory
+from base.shards import rebalance, rebalance_dry
+
+class Command(BaseCommand):
+    help = 'Redistribute quantity across the shards of sharded inventory batches (run periodically, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--low-water', type=int, default=0,
+                            help='Rebalance batches that have a shard at or below this quantity (default 0)')
+        parser.add_argument('--all', action='store_true', help='Rebalance every sharded batch')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            ids = list(Inventory.objects.filter(is_sharded=True).values_list('pk', flat=True))
+            for pk in ids:
+                rebalance(pk)
+            count = len(ids)
+        else:
+            count = rebalance_dry(options['low_water'])
+        self.stdout.write(self.style.SUCCESS(f"Rebalanced {count} sharded inventory batches."))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from base.search import rebuild_search_index
+
+class Command(BaseCommand):
+    help = 'Rebuild the SQLite FTS5 search index for medicines and inventory batches and restore its sync triggers'
+
+    def handle(self, *args, **options):
+        if not rebuild_search_index():
+            self.stdout.write(self.style.WARNING(
+                "Full-text search index is not available (not SQLite, or FTS5 trigram unsupported); "
+                "searches fall back to icontains."
+            ))
+            return
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
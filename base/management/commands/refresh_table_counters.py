@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from base.counters import refresh_table_counters
+
+class Command(BaseCommand):
+    help = 'Recount the table row counters used for estimated page totals on the medicine and inventory lists'
+
+    def handle(self, *args, **options):
+        for table, rows in refresh_table_counters().items():
+            self.stdout.write(f"{table}: {rows} rows")
+        self.stdout.write(self.style.SUCCESS("Table counters refreshed."))
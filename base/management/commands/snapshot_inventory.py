@@ -0,0 +1,20 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from base.ledger import take_snapshot
+
+class Command(BaseCommand):
+    help = 'Take the daily inventory balance snapshot used by as-of stock queries (run once a day, e.g. from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Snapshot date (YYYY-MM-DD), defaults to today')
+
+    def handle(self, *args, **options):
+        snapshot_date = None
+        if options['date']:
+            try:
+                snapshot_date = date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError(f"Invalid date: {options['date']}")
+
+        count = take_snapshot(snapshot_date)
+        self.stdout.write(self.style.SUCCESS(f"Snapshot saved for {count} inventory batches."))
@@ -0,0 +1,65 @@
+# Generated by Django 6.0 on 2026-10-17 03:49
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_opening_movements(apps, schema_editor):
+    """为已有库存批次补一条期初流水，保证流水结余与当前库存一致"""
+    Inventory = apps.get_model('base', 'Inventory')
+    StockMovement = apps.get_model('base', 'StockMovement')
+    StockMovement.objects.bulk_create([
+        StockMovement(inventory_id=pk, reason='opening', quantity=qty, balance=qty, note='启用库存流水时的期初结存')
+        for pk, qty in Inventory.objects.filter(quantity__gt=0).values_list('pk', 'quantity').iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_medicine_idx_medicine_name_medicine_idx_manuf_price'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('opening', '期初结存'), ('purchase', '进货入库'), ('sales', '销售出库'), ('sales_return', '销售退货入库'), ('purchase_return', '采购退货出库'), ('stocktake', '盘点差异'), ('damage', '破损报废'), ('expired', '过期销毁'), ('correction', '批次信息更正'), ('other', '其他调整')], max_length=20, verbose_name='变动原因')),
+                ('source_id', models.PositiveBigIntegerField(blank=True, null=True, verbose_name='来源单据ID')),
+                ('quantity', models.IntegerField(help_text='正数入库，负数出库', verbose_name='变动数量')),
+                ('balance', models.IntegerField(verbose_name='变动后结余')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='发生时间')),
+                ('note', models.CharField(blank=True, max_length=200, verbose_name='备注')),
+                ('employee', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='经办人')),
+                ('inventory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='base.inventory', verbose_name='库存批次')),
+            ],
+            options={
+                'verbose_name': '库存流水',
+                'verbose_name_plural': '库存流水',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['inventory', 'created_at'], name='idx_movement_inv_time'), models.Index(fields=['reason', 'source_id'], name='idx_movement_source')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot_date', models.DateField(verbose_name='快照日期')),
+                ('taken_at', models.DateTimeField(verbose_name='生成时间')),
+                ('balance', models.IntegerField(verbose_name='结余')),
+                ('last_movement_id', models.PositiveBigIntegerField(default=0, verbose_name='已包含的最后流水ID')),
+                ('inventory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='base.inventory', verbose_name='库存批次')),
+            ],
+            options={
+                'verbose_name': '库存快照',
+                'verbose_name_plural': '库存快照',
+                'indexes': [models.Index(fields=['taken_at'], name='idx_snapshot_taken_at')],
+                'unique_together': {('snapshot_date', 'inventory')},
+            },
+        ),
+        migrations.RunPython(create_opening_movements, migrations.RunPython.noop),
+    ]
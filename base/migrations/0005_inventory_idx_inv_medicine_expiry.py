@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-17 03:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_stockmovement_stocksnapshot'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='inventory',
+            index=models.Index(fields=['medicine', 'expiry_date'], name='idx_inv_medicine_expiry'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 03:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_inventory_idx_inv_medicine_expiry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventory',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0, verbose_name='已预留数量'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-17 03:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_inventory_reserved'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inventory',
+            name='is_sharded',
+            field=models.BooleanField(default=False, verbose_name='分片计数'),
+        ),
+        migrations.CreateModel(
+            name='InventoryShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard_no', models.PositiveSmallIntegerField(verbose_name='分片号')),
+                ('quantity', models.PositiveIntegerField(default=0, verbose_name='分片数量')),
+                ('inventory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='base.inventory', verbose_name='库存批次')),
+            ],
+            options={
+                'verbose_name': '库存分片',
+                'verbose_name_plural': '库存分片',
+                'unique_together': {('inventory', 'shard_no')},
+            },
+        ),
+    ]
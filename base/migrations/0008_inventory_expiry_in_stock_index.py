@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-17 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_inventory_is_sharded_inventoryshard'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='inventory',
+            index=models.Index(condition=models.Q(('quantity__gt', 0), ('is_sharded', True), _connector='OR'), fields=['expiry_date'], name='idx_inv_expiry_in_stock'),
+        ),
+    ]
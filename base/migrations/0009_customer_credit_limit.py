@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_inventory_expiry_in_stock_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='credit_limit',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='留空表示不限额', max_digits=12, null=True, verbose_name='信用额度'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='outstanding_balance',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14, verbose_name='未收余额'),
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 6.0 on 2026-10-17 04:31
+
+from django.db import migrations
+
+# 药品 / 库存批次的 FTS5 全文索引 (trigram 分词) 及同步触发器，说明见 base/search.py。
+# 建表和触发器语句按本迁移时的结构原样写在这里，不引用 base/search.py，之后那边再改也不影响已有迁移。
+# 只在 SQLite 且支持 FTS5 trigram 分词时执行；其他情况跳过，检索自动退回 icontains。
+
+CREATE_SQL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS base_medicine_fts USING fts5(
+        common_name, specification, manufacturer, approval_number,
+        content='base_medicine', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS base_inventory_fts USING fts5(
+        batch_number, content='base_inventory', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_ai AFTER INSERT ON base_medicine BEGIN
+        INSERT INTO base_medicine_fts(rowid, common_name, specification, manufacturer, approval_number)
+        VALUES (new.id, new.common_name, new.specification, new.manufacturer, new.approval_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_ad AFTER DELETE ON base_medicine BEGIN
+        INSERT INTO base_medicine_fts(base_medicine_fts, rowid, common_name, specification, manufacturer, approval_number)
+        VALUES ('delete', old.id, old.common_name, old.specification, old.manufacturer, old.approval_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_au
+    AFTER UPDATE OF common_name, specification, manufacturer, approval_number ON base_medicine BEGIN
+        INSERT INTO base_medicine_fts(base_medicine_fts, rowid, common_name, specification, manufacturer, approval_number)
+        VALUES ('delete', old.id, old.common_name, old.specification, old.manufacturer, old.approval_number);
+        INSERT INTO base_medicine_fts(rowid, common_name, specification, manufacturer, approval_number)
+        VALUES (new.id, new.common_name, new.specification, new.manufacturer, new.approval_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_inventory_fts_ai AFTER INSERT ON base_inventory BEGIN
+        INSERT INTO base_inventory_fts(rowid, batch_number) VALUES (new.id, new.batch_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_inventory_fts_ad AFTER DELETE ON base_inventory BEGIN
+        INSERT INTO base_inventory_fts(base_inventory_fts, rowid, batch_number) VALUES ('delete', old.id, old.batch_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_inventory_fts_au
+    AFTER UPDATE OF batch_number ON base_inventory WHEN old.batch_number IS NOT new.batch_number BEGIN
+        INSERT INTO base_inventory_fts(base_inventory_fts, rowid, batch_number) VALUES ('delete', old.id, old.batch_number);
+        INSERT INTO base_inventory_fts(rowid, batch_number) VALUES (new.id, new.batch_number);
+    END""",
+    "INSERT INTO base_medicine_fts(base_medicine_fts) VALUES ('rebuild')",
+    "INSERT INTO base_inventory_fts(base_inventory_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS base_medicine_fts_ai',
+    'DROP TRIGGER IF EXISTS base_medicine_fts_ad',
+    'DROP TRIGGER IF EXISTS base_medicine_fts_au',
+    'DROP TRIGGER IF EXISTS base_inventory_fts_ai',
+    'DROP TRIGGER IF EXISTS base_inventory_fts_ad',
+    'DROP TRIGGER IF EXISTS base_inventory_fts_au',
+    'DROP TABLE IF EXISTS base_medicine_fts',
+    'DROP TABLE IF EXISTS base_inventory_fts',
+]
+
+
+class FTS5RunSQL(migrations.RunSQL):
+    """只在 SQLite 且支持 FTS5 trigram 分词时执行的 RunSQL"""
+
+    @staticmethod
+    def supported(connection):
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(probe, tokenize='trigram')")
+            except Exception:
+                return False
+            cursor.execute('DROP TABLE temp.fts5_probe')
+        return True
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self.supported(schema_editor.connection):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_customer_credit_limit'),
+    ]
+
+    operations = [
+        FTS5RunSQL(CREATE_SQL, DROP_SQL),
+    ]
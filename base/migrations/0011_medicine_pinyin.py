@@ -0,0 +1,82 @@
+# Generated by Django 6.0 on 2026-10-17 04:38
+
+from django.db import migrations, models
+
+# 给药品表加字段时 SQLite 会重建整张表，表上的触发器随之丢失：
+# 加字段前先拆掉药品全文索引的触发器，加完字段后重建触发器并重新填充 base_medicine_fts。
+# 语句原样写在这里，不引用 base/search.py；没有建全文索引的数据库 (0010 跳过) 什么也不做。
+
+MEDICINE_TRIGGERS_SQL = [
+    """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_ai AFTER INSERT ON base_medicine BEGIN
+        INSERT INTO base_medicine_fts(rowid, common_name, specification, manufacturer, approval_number)
+        VALUES (new.id, new.common_name, new.specification, new.manufacturer, new.approval_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_ad AFTER DELETE ON base_medicine BEGIN
+        INSERT INTO base_medicine_fts(base_medicine_fts, rowid, common_name, specification, manufacturer, approval_number)
+        VALUES ('delete', old.id, old.common_name, old.specification, old.manufacturer, old.approval_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_au
+    AFTER UPDATE OF common_name, specification, manufacturer, approval_number ON base_medicine BEGIN
+        INSERT INTO base_medicine_fts(base_medicine_fts, rowid, common_name, specification, manufacturer, approval_number)
+        VALUES ('delete', old.id, old.common_name, old.specification, old.manufacturer, old.approval_number);
+        INSERT INTO base_medicine_fts(rowid, common_name, specification, manufacturer, approval_number)
+        VALUES (new.id, new.common_name, new.specification, new.manufacturer, new.approval_number);
+    END""",
+    "INSERT INTO base_medicine_fts(base_medicine_fts) VALUES ('rebuild')",
+]
+
+DROP_MEDICINE_TRIGGERS_SQL = [
+    'DROP TRIGGER IF EXISTS base_medicine_fts_ai',
+    'DROP TRIGGER IF EXISTS base_medicine_fts_ad',
+    'DROP TRIGGER IF EXISTS base_medicine_fts_au',
+]
+
+
+class MedicineFTSRunSQL(migrations.RunSQL):
+    """只在药品全文索引表存在时执行的 RunSQL"""
+
+    @staticmethod
+    def installed(connection):
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'base_medicine_fts'")
+            return cursor.fetchone() is not None
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self.installed(schema_editor.connection):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self.installed(schema_editor.connection):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0010_search_index'),
+    ]
+
+    operations = [
+        MedicineFTSRunSQL(DROP_MEDICINE_TRIGGERS_SQL, MEDICINE_TRIGGERS_SQL),
+        migrations.AddField(
+            model_name='medicine',
+            name='pinyin',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='通用名全拼'),
+        ),
+        migrations.AddField(
+            model_name='medicine',
+            name='pinyin_initials',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='通用名拼音首字母'),
+        ),
+        migrations.AddIndex(
+            model_name='medicine',
+            index=models.Index(fields=['pinyin'], name='idx_medicine_pinyin'),
+        ),
+        migrations.AddIndex(
+            model_name='medicine',
+            index=models.Index(fields=['pinyin_initials'], name='idx_medicine_py_initials'),
+        ),
+        MedicineFTSRunSQL(MEDICINE_TRIGGERS_SQL, DROP_MEDICINE_TRIGGERS_SQL),
+    ]
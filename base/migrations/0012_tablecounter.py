@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0011_medicine_pinyin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TableCounter',
+            fields=[
+                ('table', models.CharField(max_length=100, primary_key=True, serialize=False, verbose_name='数据表')),
+                ('rows', models.BigIntegerField(default=0, verbose_name='行数')),
+            ],
+            options={
+                'verbose_name': '表行数计数',
+                'verbose_name_plural': '表行数计数',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-17 04:51
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_opening_cost(apps, schema_editor):
+    """已有的期初流水按迁移时的药品进价补记单位成本"""
+    StockMovement = apps.get_model('base', 'StockMovement')
+    Inventory = apps.get_model('base', 'Inventory')
+    buy_price = Inventory.objects.filter(pk=OuterRef('inventory_id')).values('medicine__buy_price')[:1]
+    StockMovement.objects.filter(reason='opening', unit_cost__isnull=True).update(unit_cost=Subquery(buy_price))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0012_tablecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockmovement',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True, verbose_name='单位成本'),
+        ),
+        migrations.RunPython(fill_opening_cost, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,9 @@
 from django.db import models
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.conf import settings
+from django.utils import timezone
+from .pinyin import PINYIN_MAX_LENGTH, name_pinyin
 
 # --- 抽象基类 (不会在数据库建表，仅供继承) ---
 class AddressInfo(models.Model):
@@ -30,10 +35,42 @@ class AddressInfo(models.Model):
         non_empty_parts = [part for part in parts if part]
         return ''.join(non_empty_parts)
     
+class NameTrackedModel(models.Model):
+    """
+    名称跟踪 (抽象基类)：记住从数据库加载时的名称字段 (name_field) 的值，
+    改名时重写单据检索文档 (biz/signals.py) 因此不必在保存前再查一次数据库。
+    """
+    name_field = 'name'
+
+    # 新建对象或字段未加载 (如 .only()) 时为 None
+    _loaded_name = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_name = instance.__dict__.get(cls.name_field)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or self.name_field in fields:
+            self._loaded_name = self.__dict__.get(self.name_field)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or self.name_field in update_fields:
+            self._loaded_name = getattr(self, self.name_field)
+
 # --- 强实体 ---
 
-class Medicine(models.Model):
+class Medicine(NameTrackedModel):
     """药品信息"""
+    name_field = 'common_name'
+
     # MedicineID 由 Django 自动生成 id
     common_name = models.CharField("通用名", max_length=100)
     specification = models.CharField("规格", max_length=50)
@@ -44,6 +81,10 @@ class Medicine(models.Model):
     buy_price = models.DecimalField("指导进价", max_digits=10, decimal_places=2)
     sell_price = models.DecimalField("指导售价", max_digits=10, decimal_places=2)
 
+    # 通用名拼音 (保存时自动计算，供拼音检索，见 base/pinyin.py)
+    pinyin = models.CharField("通用名全拼", max_length=PINYIN_MAX_LENGTH, blank=True, default='', editable=False)
+    pinyin_initials = models.CharField("通用名拼音首字母", max_length=PINYIN_MAX_LENGTH, blank=True, default='', editable=False)
+
     class Meta:
         verbose_name = "药品信息"
         verbose_name_plural = verbose_name
@@ -52,13 +93,23 @@ class Medicine(models.Model):
             models.Index(fields=['common_name'], name='idx_medicine_name'),
             # 联合索引：如果经常按厂家找药，且按价格排序
             models.Index(fields=['manufacturer', 'buy_price'], name='idx_manuf_price'),
+            # 拼音前缀检索 (范围扫描)
+            models.Index(fields=['pinyin'], name='idx_medicine_pinyin'),
+            models.Index(fields=['pinyin_initials'], name='idx_medicine_py_initials'),
         ]
 
     def __str__(self):
         return f"{self.common_name} - {self.specification}"
+
+    def save(self, *args, **kwargs):
+        self.pinyin, self.pinyin_initials = name_pinyin(self.common_name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'common_name' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'pinyin', 'pinyin_initials'}
+        super().save(*args, **kwargs)
     
 
-class Supplier(AddressInfo):
+class Supplier(NameTrackedModel, AddressInfo):
     """供应商 (继承地址信息)"""
     name = models.CharField("供应商名称", max_length=100)
     contact_person = models.CharField("联系人", max_length=50)
@@ -101,11 +152,16 @@ class SupplierPhone(models.Model):
         return f"{self.get_type_display()}: {self.number}"
     
 
-class Customer(AddressInfo):
+class Customer(NameTrackedModel, AddressInfo):
     """客户 (继承地址信息)"""
     name = models.CharField("客户姓名/药店名", max_length=100)
     type = models.CharField("类型", max_length=20, choices=[('wholesale', '批发'), ('retail', '零售')])
     phone = models.CharField("联系电话", max_length=20)
+    # 赊销信用额度，留空表示不限额；审核销售单时检查 (biz/credit.py)
+    credit_limit = models.DecimalField("信用额度", max_digits=12, decimal_places=2, null=True, blank=True,
+                                       help_text="留空表示不限额")
+    # 未收余额 = 已审核销售单金额 - 已收款，由 biz/credit.py 在审核/收款的同一事务中增量维护
+    outstanding_balance = models.DecimalField("未收余额", max_digits=14, decimal_places=2, default=0, editable=False)
 
     class Meta:
         verbose_name = "客户"
@@ -117,6 +173,23 @@ class Customer(AddressInfo):
 
 # --- 核心实体 (Inventory) ---
 
+class InventoryQuerySet(models.QuerySet):
+    def with_live_quantity(self):
+        """
+        附加 live_quantity：实时总数量。
+        普通批次就是 quantity；分片批次 = 主行 quantity + 各分片数量之和 (一个子查询)。
+        """
+        shard_total = (
+            InventoryShard.objects.filter(inventory=OuterRef('pk'))
+            .values('inventory')
+            .annotate(total=Sum('quantity'))
+            .values('total')
+        )
+        return self.annotate(
+            live_quantity=F('quantity') + Coalesce(Subquery(shard_total), Value(0))
+        )
+
+
 class Inventory(models.Model):
     """库存表 (强实体设计，代理主键 InventoryID)"""
     # 对应 ER 图：Has_Batch 关系 (指向 Medicine)
@@ -125,6 +198,10 @@ class Inventory(models.Model):
     batch_number = models.CharField("生产批号", max_length=50)
     expiry_date = models.DateField("有效期至")
     quantity = models.PositiveIntegerField("当前数量", default=0)
+    # 待审核销售单预留的数量，由 biz/reservations.py 增量维护
+    reserved = models.PositiveIntegerField("已预留数量", default=0)
+    # 热销批次可开启分片计数 (base/shards.py)：数量分散到多行 InventoryShard，扣减互不排队
+    is_sharded = models.BooleanField("分片计数", default=False)
     # 库位可选，暂时先注释
     # warehouse_location = models.CharField("库位", max_length=50, blank=True)
 
@@ -133,6 +210,149 @@ class Inventory(models.Model):
         unique_together = ('medicine', 'batch_number')
         verbose_name = "库存记录"
         verbose_name_plural = verbose_name
+        indexes = [
+            # 先到期先出 (FEFO) 分配：按药品取批次并按有效期排序
+            models.Index(fields=['medicine', 'expiry_date'], name='idx_inv_medicine_expiry'),
+            # 效期看板 / 临期查询：只索引有库存的批次 (部分索引)，卖空的批次不占索引空间。
+            # 分片批次的主行数量可能为 0 而分片中仍有库存，因此一并收录
+            models.Index(
+                fields=['expiry_date'], name='idx_inv_expiry_in_stock',
+                condition=Q(quantity__gt=0) | Q(is_sharded=True),
+            ),
+        ]
+
+    objects = InventoryQuerySet.as_manager()
+
+    @property
+    def total_quantity(self):
+        """实时总数量：分片批次为主行数量 + 各分片之和 (优先使用 with_live_quantity() 的结果)"""
+        if hasattr(self, 'live_quantity'):
+            return self.live_quantity
+        if not self.is_sharded:
+            return self.quantity
+        return self.quantity + (self.shards.aggregate(total=Sum('quantity'))['total'] or 0)
+
+    @property
+    def available(self):
+        """可用数量 = 当前数量 - 已预留数量"""
+        return self.total_quantity - self.reserved
+
+    def __str__(self):
+        return f"{self.medicine.common_name} [{self.batch_number}] 余: {self.total_quantity}"
+
+
+class InventoryShard(models.Model):
+    """
+    分片库存计数 (仅 is_sharded 的批次使用)。
+    扣减时随机选一个分片做条件 UPDATE，并发扣减落在不同的行上，不再争抢同一把行锁；
+    主行 Inventory.quantity 相当于额外的一个分片，同时为已预留数量兜底。
+    """
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE, related_name='shards', verbose_name="库存批次")
+    shard_no = models.PositiveSmallIntegerField("分片号")
+    quantity = models.PositiveIntegerField("分片数量", default=0)
+
+    class Meta:
+        unique_together = ('inventory', 'shard_no')
+        verbose_name = "库存分片"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f"{self.inventory_id}#{self.shard_no}: {self.quantity}"
+
+# --- 库存流水账 (只追加，不修改) ---
+
+class StockMovement(models.Model):
+    """
+    库存流水：每一次库存变动追加一行，记录来源单据、带符号数量和变动后的结余。
+    Inventory.quantity 是当前结余，本表是它的完整历史。
+    """
+    REASON_CHOICES = [
+        ('opening', '期初结存'),
+        ('purchase', '进货入库'),
+        ('sales', '销售出库'),
+        ('sales_return', '销售退货入库'),
+        ('purchase_return', '采购退货出库'),
+        ('stocktake', '盘点差异'),
+        ('damage', '破损报废'),
+        ('expired', '过期销毁'),
+        ('correction', '批次信息更正'),
+        ('other', '其他调整'),
+    ]
+    # 可以在 "调整库存" 页面手工选择的原因
+    ADJUST_REASONS = ['stocktake', 'damage', 'expired', 'other']
+
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE, related_name='movements', verbose_name="库存批次")
+    reason = models.CharField("变动原因", max_length=20, choices=REASON_CHOICES)
+    # 来源单据的主键 (单据类型由 reason 决定)，手工调整时为空
+    source_id = models.PositiveBigIntegerField("来源单据ID", null=True, blank=True)
+    quantity = models.IntegerField("变动数量", help_text="正数入库，负数出库")
+    balance = models.IntegerField("变动后结余")
+    # 期初结存的单位成本，写流水时按当时的药品进价记下 (进价以后会变)，FIFO 成本计算使用
+    unit_cost = models.DecimalField("单位成本", max_digits=10, decimal_places=2, null=True, blank=True)
+    created_at = models.DateTimeField("发生时间", default=timezone.now)
+    employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="经办人")
+    note = models.CharField("备注", max_length=200, blank=True)
+
+    class Meta:
+        verbose_name = "库存流水"
+        verbose_name_plural = verbose_name
+        ordering = ['-id']
+        indexes = [
+            # 查询某批次在某时间点之前的最后一条流水
+            models.Index(fields=['inventory', 'created_at'], name='idx_movement_inv_time'),
+            # 按来源单据追溯
+            models.Index(fields=['reason', 'source_id'], name='idx_movement_source'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("库存流水只允许追加，不能修改")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("库存流水只允许追加，不能删除")
+
+    def __str__(self):
+        return f"{self.get_reason_display()} {self.quantity:+d} -> {self.balance}"
+
+
+class StockSnapshot(models.Model):
+    """
+    每日库存快照：某一时刻每个批次的结余。
+    查询历史结余时，只需读取一份快照 + 快照之后的少量流水，不必回放全部历史。
+    """
+    snapshot_date = models.DateField("快照日期")
+    taken_at = models.DateTimeField("生成时间")
+    inventory = models.ForeignKey(Inventory, on_delete=models.CASCADE, related_name='snapshots', verbose_name="库存批次")
+    balance = models.IntegerField("结余")
+    # 生成快照时已包含的最后一条流水 ID，之后的流水属于 "尾部"
+    last_movement_id = models.PositiveBigIntegerField("已包含的最后流水ID", default=0)
+
+    class Meta:
+        unique_together = ('snapshot_date', 'inventory')
+        verbose_name = "库存快照"
+        verbose_name_plural = verbose_name
+        indexes = [
+            models.Index(fields=['taken_at'], name='idx_snapshot_taken_at'),
+        ]
+
+    def __str__(self):
+        return f"{self.snapshot_date} {self.inventory_id}: {self.balance}"
+
+# --- 列表行数计数 ---
+
+class TableCounter(models.Model):
+    """
+    数据表行数计数，供不带筛选条件的列表页显示 "约 N 页" (base/pagination.py)，不必每次 COUNT(*)。
+    由 base/counters.py 在新增/删除时增量维护；绕过信号的批量写入可能使它略有偏差，
+    可用 refresh_table_counters 校正。
+    """
+    table = models.CharField("数据表", max_length=100, primary_key=True)
+    rows = models.BigIntegerField("行数", default=0)
+
+    class Meta:
+        verbose_name = "表行数计数"
+        verbose_name_plural = verbose_name
 
     def __str__(self):
-        return f"{self.medicine.common_name} [{self.batch_number}] 余: {self.quantity}"
\ No newline at end of file
+        return f"{self.table}: {self.rows}"
@@ -0,0 +1,103 @@
+import hashlib
+import math
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Page
+
+# ==========================================
+# 药品库存 / 药品信息列表的分页 (少做 COUNT)
+# ==========================================
+# Django 的 Paginator 每次翻页都要对整个筛选结果 COUNT(*)，筛选越复杂越贵。这里的分页器：
+#   - 每页多取一行 (LIMIT n + 1)，有没有下一页由这一行判断，不依赖总数
+#   - 不带筛选条件时，总数取自增量维护的表行数计数 (base/counters.py)，页面显示 "约 N 页"
+#   - 带筛选条件时，总数按筛选条件缓存 LIST_COUNT_CACHE_TIMEOUT 秒；只有第一页在缓存缺失时 COUNT 一次，
+#     翻到后面的页时缓存已过期就不再 COUNT，只显示 "第 N 页" 和上一页/下一页
+#   - 取到的行数不满一页时 (到了最后一页)，总数就是精确值，顺便写入缓存
+# 计数或缓存有偏差时页面仍能正常翻页：最后一页以实际取到的行为准；页码超出范围时 COUNT 一次并跳到最后一页。
+
+COUNT_CACHE_PREFIX = 'list_count'
+
+
+def count_cache_key(model, filters):
+    """筛选条件 -> 总数缓存键 (filters 为 {参数: 值})"""
+    signature = repr(sorted((key, str(value)) for key, value in filters.items()))
+    digest = hashlib.md5(signature.encode()).hexdigest()
+    return f'{COUNT_CACHE_PREFIX}:{model._meta.label}:{digest}'
+
+
+class ListPage(Page):
+    """一页数据；是否还有下一页由多取的一行决定"""
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def start_index(self):
+        return self.paginator.per_page * (self.number - 1) + 1 if self.object_list else 0
+
+    def end_index(self):
+        return self.paginator.per_page * (self.number - 1) + len(self.object_list)
+
+
+class ListPaginator:
+    """
+    用法同 Paginator.get_page。filters 为当前生效的筛选条件 (值为空的参数忽略)，
+    没有筛选条件时传入 estimated_count (表的估计行数)。
+    get_page 之后 count / num_pages 为总数和总页数，未知时为 None；estimated 为 True 表示是估计值。
+    """
+
+    def __init__(self, object_list, per_page, filters=None, estimated_count=None):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.filters = {key: value for key, value in (filters or {}).items() if value}
+        self.estimated = not self.filters and estimated_count is not None
+        self.count = estimated_count if self.estimated else None
+        self.num_pages = None
+        self._cache_key = count_cache_key(object_list.model, self.filters)
+
+    def _cache_count(self, count):
+        cache.set(self._cache_key, count, getattr(settings, 'LIST_COUNT_CACHE_TIMEOUT', 30))
+
+    def _fetch(self, number):
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        return rows[:self.per_page], len(rows) > self.per_page
+
+    def get_page(self, number):
+        try:
+            number = max(int(number), 1)
+        except (TypeError, ValueError):
+            number = 1
+        if not self.estimated:
+            self.count = cache.get(self._cache_key)
+
+        rows, has_next = self._fetch(number)
+        if not rows and number > 1:
+            # 页码超出实际范围 (计数偏大或手工输入)：按精确总数跳到最后一页
+            self.count = self.object_list.count()
+            self.estimated = False
+            self._cache_count(self.count)
+            number = max(math.ceil(self.count / self.per_page), 1)
+            rows, has_next = self._fetch(number)
+
+        if not has_next:
+            # 最后一页：总数是精确值
+            self.count = (number - 1) * self.per_page + len(rows)
+            self.estimated = False
+            self._cache_count(self.count)
+        elif self.count is None and number == 1:
+            self.count = self.object_list.count()
+            self._cache_count(self.count)
+
+        if self.count is not None:
+            self.num_pages = max(math.ceil(self.count / self.per_page), number + has_next, 1)
+        return ListPage(rows, number, self, has_next)
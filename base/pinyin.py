@@ -0,0 +1,51 @@
+from django.db.models import Q
+from pypinyin import Style, lazy_pinyin
+
+# ==========================================
+# 药品通用名拼音检索
+# ==========================================
+# Medicine.pinyin (全拼) / Medicine.pinyin_initials (首字母) 在保存药品时由通用名计算并冗余存储，
+# 只保留小写字母 (数字、符号、空格去掉，ü 写作 v)，例如 阿莫西林胶囊 -> amoxilinjiaonang / amxljn。
+# 柜台输入的拼音按前缀匹配：写成 [prefix, prefix 末位加一) 的范围条件，
+# 直接在 idx_medicine_pinyin / idx_medicine_py_initials 上做范围扫描，
+# 不用 LIKE 'x%' (SQLite 的 LIKE 默认不区分大小写、带 ESCAPE，用不上索引)。
+# 导入历史药品或批量写入 (bulk_create / update 不经过 save) 后用 backfill_medicine_pinyin 补齐。
+
+# 全拼只用于前缀匹配，过长的部分截掉
+PINYIN_MAX_LENGTH = 255
+
+
+def _letters(text):
+    return ''.join(ch for ch in text.lower() if 'a' <= ch <= 'z')
+
+
+def name_pinyin(name):
+    """通用名 -> (全拼, 首字母)"""
+    full = lazy_pinyin(name or '')
+    initials = lazy_pinyin(name or '', style=Style.FIRST_LETTER)
+    return (
+        ''.join(_letters(part) for part in full)[:PINYIN_MAX_LENGTH],
+        ''.join(_letters(part) for part in initials)[:PINYIN_MAX_LENGTH],
+    )
+
+
+def is_pinyin_query(query):
+    """检索词是否可能是拼音 (只含英文字母)"""
+    return bool(query) and query.isascii() and query.isalpha()
+
+
+def _prefix_range(field, prefix):
+    """field 以 prefix 开头，写成可走索引的范围条件"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': upper})
+
+
+def pinyin_condition(query, prefix=''):
+    """
+    拼音检索条件：首字母或全拼以检索词开头。检索词不是拼音时返回 None。
+    prefix 为药品的关联路径，例如库存批次上用 'medicine__'。
+    """
+    if not is_pinyin_query(query):
+        return None
+    query = query.lower()
+    return _prefix_range(f'{prefix}pinyin_initials', query) | _prefix_range(f'{prefix}pinyin', query)
@@ -0,0 +1,234 @@
+from django.db import connection
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from .pinyin import pinyin_condition
+
+# ==========================================
+# 药品 / 库存批次全文检索
+# ==========================================
+# SQLite 下建立两张 FTS5 虚拟表 (trigram 分词，中文任意子串都能命中)，都是外部内容表 (只存索引)：
+#   - base_medicine_fts：通用名、规格、生产厂家、批准文号 (rowid = Medicine.id)
+#   - base_inventory_fts：生产批号 (rowid = Inventory.id)
+# 库存批次按药品名称/厂家检索时走 base_medicine_fts 再按 medicine_id 关联，批次索引不冗余药品信息。
+# 两张表由各自数据表上的触发器同步 (包括 bulk_create / update 等绕过信号的写入)，
+# 触发器只引用本表和对应的 FTS 表，SQLite 重建表 (部分 ALTER 会这样做) 时不会因为跨表引用而失败。
+# 检索先在 FTS 表中按词项定位，再按 rank (bm25) 排序，不再对整张表做 LIKE '%x%' 扫描。
+# 以下情况退回 icontains 查询：数据库不是 SQLite、SQLite 没有 FTS5/trigram (迁移时未建表)、
+# 检索词中有少于 3 个字符的词 (trigram 无法索引)。
+# 只含英文字母的检索词另外按通用名拼音 / 首字母前缀匹配 (base/pinyin.py)，结果合并，拼音命中的排在最前。
+# 重建表时表上的触发器随之丢失，每次 migrate 之后 (post_migrate，见 base/apps.py)
+# 补建缺失的触发器并重新填充对应的 FTS 表。
+
+MEDICINE_FTS = 'base_medicine_fts'
+INVENTORY_FTS = 'base_inventory_fts'
+
+# trigram 分词能索引的最短词长
+MIN_TERM_LENGTH = 3
+
+_available = {}
+
+
+def fts_available(table):
+    """当前数据库中是否存在 FTS 表 (按连接别名缓存)"""
+    key = (connection.alias, connection.settings_dict['NAME'], table)
+    if key not in _available:
+        if connection.vendor != 'sqlite':
+            _available[key] = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [table])
+                _available[key] = cursor.fetchone() is not None
+    return _available[key]
+
+
+def match_expression(query):
+    """
+    检索词 -> FTS5 MATCH 表达式：按空白拆分，每个词作为短语 (双引号转义)，词与词之间为 AND。
+    有词短于 MIN_TERM_LENGTH 时返回 None (需退回 icontains)。
+    """
+    terms = query.split()
+    if not terms or any(len(term) < MIN_TERM_LENGTH for term in terms):
+        return None
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+def _search(queryset, query, sources, fallback_fields, pinyin=None):
+    """
+    sources 为 [(FTS 表, 本表中对应 rowid 的字段)]，任一 FTS 表命中即算命中。
+    返回 (queryset, ranked)。ranked 为 True 时 queryset 已附加 search_rank (越小越相关，
+    拼音命中的为 NULL，多个来源取第一个命中的)，调用方可按它排序；否则为 icontains 的结果。
+    pinyin 为拼音前缀条件 (见 base/pinyin.py)，与全文检索 / icontains 的结果合并。
+    """
+    expression = None
+    if all(fts_available(table) for table, field in sources):
+        expression = match_expression(query)
+    if expression is None:
+        condition = Q()
+        for field in fallback_fields:
+            condition |= Q(**{f'{field}__icontains': query})
+        if pinyin is not None:
+            condition |= pinyin
+        return queryset.filter(condition), False
+
+    own_table = queryset.model._meta.db_table
+    condition = Q()
+    ranks = []
+    for table, field in sources:
+        column = queryset.model._meta.get_field(field).column
+        condition |= Q(**{f'{field}__in': RawSQL(f'SELECT rowid FROM {table} WHERE {table} MATCH %s', [expression])})
+        ranks.append(RawSQL(
+            f'SELECT rank FROM {table} WHERE {table} MATCH %s AND rowid = "{own_table}"."{column}"',
+            [expression], output_field=FloatField(),
+        ))
+    rank = Coalesce(*ranks) if len(ranks) > 1 else ranks[0]
+    if pinyin is not None:
+        condition |= pinyin
+        rank = Case(When(pinyin, then=Value(None)), default=rank, output_field=FloatField())
+    return queryset.filter(condition).annotate(search_rank=rank), True
+
+
+def search_medicines(queryset, query):
+    """按通用名 (含拼音/拼音首字母)、规格、生产厂家、批准文号检索药品，返回 (queryset, ranked)"""
+    return _search(
+        queryset, query, [(MEDICINE_FTS, 'id')],
+        ['common_name', 'specification', 'manufacturer', 'approval_number'],
+        pinyin_condition(query),
+    )
+
+
+def search_inventory(queryset, query):
+    """
+    按生产批号和所属药品的通用名 (含拼音/拼音首字母)、规格、生产厂家、批准文号检索库存批次，
+    批号命中的排在前面。返回 (queryset, ranked)
+    """
+    return _search(
+        queryset, query, [(INVENTORY_FTS, 'id'), (MEDICINE_FTS, 'medicine')],
+        ['medicine__common_name', 'medicine__manufacturer', 'batch_number'],
+        pinyin_condition(query, 'medicine__'),
+    )
+
+
+def rebuild_search_index():
+    """
+    从药品表和库存表重建两张 FTS 表，并补齐缺失的触发器 (例如直接导入数据库文件之后)。
+    FTS 表不存在时返回 False。
+    """
+    if not install_search_index(connection, create_tables=False):
+        return False
+    with connection.cursor() as cursor:
+        for table in TABLE_SQL:
+            cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+    return True
+
+
+# ==========================================
+# 建表与触发器
+# ==========================================
+
+TABLE_SQL = {
+    MEDICINE_FTS: """CREATE VIRTUAL TABLE IF NOT EXISTS base_medicine_fts USING fts5(
+        common_name, specification, manufacturer, approval_number,
+        content='base_medicine', content_rowid='id', tokenize='trigram'
+    )""",
+    INVENTORY_FTS: """CREATE VIRTUAL TABLE IF NOT EXISTS base_inventory_fts USING fts5(
+        batch_number, content='base_inventory', content_rowid='id', tokenize='trigram'
+    )""",
+}
+
+# FTS 表 -> {触发器名: 建触发器的 SQL}
+TRIGGER_SQL = {
+    MEDICINE_FTS: {
+        'base_medicine_fts_ai': """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_ai AFTER INSERT ON base_medicine BEGIN
+            INSERT INTO base_medicine_fts(rowid, common_name, specification, manufacturer, approval_number)
+            VALUES (new.id, new.common_name, new.specification, new.manufacturer, new.approval_number);
+        END""",
+        'base_medicine_fts_ad': """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_ad AFTER DELETE ON base_medicine BEGIN
+            INSERT INTO base_medicine_fts(base_medicine_fts, rowid, common_name, specification, manufacturer, approval_number)
+            VALUES ('delete', old.id, old.common_name, old.specification, old.manufacturer, old.approval_number);
+        END""",
+        'base_medicine_fts_au': """CREATE TRIGGER IF NOT EXISTS base_medicine_fts_au
+        AFTER UPDATE OF common_name, specification, manufacturer, approval_number ON base_medicine BEGIN
+            INSERT INTO base_medicine_fts(base_medicine_fts, rowid, common_name, specification, manufacturer, approval_number)
+            VALUES ('delete', old.id, old.common_name, old.specification, old.manufacturer, old.approval_number);
+            INSERT INTO base_medicine_fts(rowid, common_name, specification, manufacturer, approval_number)
+            VALUES (new.id, new.common_name, new.specification, new.manufacturer, new.approval_number);
+        END""",
+    },
+    INVENTORY_FTS: {
+        'base_inventory_fts_ai': """CREATE TRIGGER IF NOT EXISTS base_inventory_fts_ai AFTER INSERT ON base_inventory BEGIN
+            INSERT INTO base_inventory_fts(rowid, batch_number) VALUES (new.id, new.batch_number);
+        END""",
+        'base_inventory_fts_ad': """CREATE TRIGGER IF NOT EXISTS base_inventory_fts_ad AFTER DELETE ON base_inventory BEGIN
+            INSERT INTO base_inventory_fts(base_inventory_fts, rowid, batch_number) VALUES ('delete', old.id, old.batch_number);
+        END""",
+        # 库存数量频繁更新，只有批号真的变化时才改索引
+        'base_inventory_fts_au': """CREATE TRIGGER IF NOT EXISTS base_inventory_fts_au
+        AFTER UPDATE OF batch_number ON base_inventory WHEN old.batch_number IS NOT new.batch_number BEGIN
+            INSERT INTO base_inventory_fts(base_inventory_fts, rowid, batch_number) VALUES ('delete', old.id, old.batch_number);
+            INSERT INTO base_inventory_fts(rowid, batch_number) VALUES (new.id, new.batch_number);
+        END""",
+    },
+}
+
+
+def fts5_trigram_supported(conn):
+    """SQLite 是否编译了 FTS5 且支持 trigram 分词 (SQLite 3.34+)"""
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(probe, tokenize='trigram')")
+        except Exception:
+            return False
+        cursor.execute('DROP TABLE temp.fts5_probe')
+    return True
+
+
+def _existing(cursor, kind):
+    cursor.execute('SELECT name FROM sqlite_master WHERE type = %s', [kind])
+    return {name for name, in cursor.fetchall()}
+
+
+def install_search_index(conn, create_tables=True, tables=None, triggers=None):
+    """
+    建立 FTS 表并补齐缺失的触发器，可重复执行。新建的表，或者触发器丢失过的表 (期间的写入没有同步)，
+    从数据表重新填充。create_tables=False 时只处理已存在的 FTS 表 (post_migrate 使用)。
+    tables / triggers 默认为本模块的 TABLE_SQL / TRIGGER_SQL，其他应用的 FTS 表 (如单据检索) 传入自己的定义。
+    不支持 FTS5 trigram 时什么也不做，返回 False。
+    """
+    tables_sql = tables or TABLE_SQL
+    triggers_sql = triggers or TRIGGER_SQL
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        existing = _existing(cursor, 'table')
+    if not create_tables:
+        if not set(tables_sql) <= existing:
+            return False
+    elif not fts5_trigram_supported(conn):
+        return False
+    _available.clear()
+    with conn.cursor() as cursor:
+        existing_triggers = _existing(cursor, 'trigger')
+        for table, statement in tables_sql.items():
+            missing = [sql for name, sql in triggers_sql[table].items() if name not in existing_triggers]
+            if table in existing and not missing:
+                continue
+            cursor.execute(statement)
+            for sql in missing:
+                cursor.execute(sql)
+            cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+    return True
+
+
+def uninstall_search_index(conn, triggers=None):
+    """删除 FTS 表和触发器 (triggers 同 install_search_index)"""
+    if conn.vendor != 'sqlite':
+        return
+    _available.clear()
+    with conn.cursor() as cursor:
+        for table, names in (triggers or TRIGGER_SQL).items():
+            for name in names:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
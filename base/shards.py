@@ -0,0 +1,139 @@
+import random
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, F, Sum, Min, IntegerField
+from .models import Inventory, InventoryShard
+
+# ==========================================
+# 热销批次的分片库存计数
+# ==========================================
+# 普通批次每次扣减都要更新同一行 Inventory，并发审核在这一把行锁上排队。
+# 开启分片后 (enable_sharding)，批次的可用数量分散到 K 行 InventoryShard：
+#   - 扣减 (take_from_shards)：从随机分片开始做条件 UPDATE，并发扣减大多落在不同行上
+#   - 增加 (进货/退货/手工调整)：仍然加到主行 Inventory.quantity，不影响扣减
+#   - 读取：总数量 = 主行 + 各分片之和 (Inventory.objects.with_live_quantity())
+#   - 再平衡 (rebalance)：某个分片耗尽时，把主行和各分片的可用数量重新平均分配
+# 库存预留 (biz/reservations.py) 记在主行 Inventory.reserved 上，审核时要在主行上回退，
+# 会把并发审核重新排到主行这一把锁上。因此分片批次不做预留 (销售明细在审核时由条件扣减检查库存)，
+# 有未释放预留的批次也不能开启分片。早于这条规则的预留仍由主行兜底：再平衡时主行至少保留 reserved。
+
+
+def _shard_count():
+    return getattr(settings, 'STOCK_SHARD_COUNT', 8)
+
+
+def sharded_ids(inventory_ids):
+    """返回其中开启了分片计数的批次主键集合"""
+    if not inventory_ids:
+        return set()
+    return set(Inventory.objects.filter(pk__in=list(inventory_ids), is_sharded=True).values_list('pk', flat=True))
+
+
+def live_quantities(inventory_ids):
+    """批量查询实时总数量，返回 {inventory_id: 数量}"""
+    return dict(
+        Inventory.objects.with_live_quantity()
+        .filter(pk__in=list(inventory_ids))
+        .values_list('pk', 'live_quantity')
+    )
+
+
+def take_from_shards(needed):
+    """
+    从分片中扣减，needed: {inventory_id: 数量}，返回分片不够扣的剩余数量 {inventory_id: 剩余}。
+    每个分片一条条件 UPDATE (quantity >= 本次扣减量)，被别人抢先扣空就换下一个分片；
+    剩余部分由调用方从主行扣减。必须在调用方的事务中执行，整单失败时一起回滚。
+    """
+    shards = {}
+    for shard_id, inventory_id, quantity in (
+        InventoryShard.objects.filter(inventory_id__in=list(needed), quantity__gt=0)
+        .values_list('pk', 'inventory_id', 'quantity')
+    ):
+        shards.setdefault(inventory_id, []).append((shard_id, quantity))
+
+    remaining = {}
+    for inventory_id, qty in needed.items():
+        candidates = shards.get(inventory_id, [])
+        if candidates:
+            # 随机起点，避免所有请求都先打到同一个分片
+            start = random.randrange(len(candidates))
+            candidates = candidates[start:] + candidates[:start]
+        for shard_id, seen in candidates:
+            if qty == 0:
+                break
+            take = min(seen, qty)
+            if InventoryShard.objects.filter(pk=shard_id, quantity__gte=take).update(quantity=F('quantity') - take):
+                qty -= take
+        if qty:
+            remaining[inventory_id] = qty
+    return remaining
+
+
+def rebalance(inventory_id):
+    """
+    把一个分片批次的可用数量在主行和各分片之间重新平均分配，总数量不变。
+    加锁顺序固定为 主行 -> 分片 (按主键)，与审核扣减不会互相死锁。
+    """
+    with transaction.atomic():
+        inventory = Inventory.objects.select_for_update().get(pk=inventory_id)
+        if not inventory.is_sharded:
+            return
+        shards = list(InventoryShard.objects.select_for_update().filter(inventory=inventory).order_by('pk'))
+        if not shards:
+            return
+        total = inventory.quantity + sum(s.quantity for s in shards)
+        # 主行保留已预留的数量 (总数不够时全部留在主行)，剩下的平均分配
+        held = min(inventory.reserved, total)
+        share, extra = divmod(total - held, len(shards) + 1)
+        InventoryShard.objects.filter(pk__in=[s.pk for s in shards]).update(
+            quantity=Case(
+                *[When(pk=s.pk, then=share + (1 if i < extra else 0)) for i, s in enumerate(shards)],
+                default=F('quantity'),
+                output_field=IntegerField(),
+            )
+        )
+        Inventory.objects.filter(pk=inventory.pk).update(quantity=held + share)
+
+
+def rebalance_dry(low_water=0):
+    """再平衡所有存在分片数量 <= low_water 的批次，返回处理的批次数"""
+    dry = list(
+        Inventory.objects.filter(is_sharded=True)
+        .annotate(lowest=Min('shards__quantity'))
+        .filter(lowest__lte=low_water)
+        .values_list('pk', flat=True)
+    )
+    for inventory_id in dry:
+        rebalance(inventory_id)
+    return len(dry)
+
+
+def enable_sharding(inventory_id, shards=None):
+    """
+    开启分片计数：建立 K 个分片并把可用数量平均分配过去。
+    批次上还有待审核销售单的预留时抛出 ValueError (分片批次不做预留，见模块说明)。
+    """
+    shards = shards or _shard_count()
+    with transaction.atomic():
+        inventory = Inventory.objects.select_for_update().get(pk=inventory_id)
+        if inventory.is_sharded:
+            return
+        if inventory.reserved:
+            raise ValueError(f"{inventory.batch_number} 有 {inventory.reserved} 件已被待审核销售单预留，释放后才能开启分片计数")
+        InventoryShard.objects.bulk_create([
+            InventoryShard(inventory=inventory, shard_no=no, quantity=0) for no in range(shards)
+        ])
+        Inventory.objects.filter(pk=inventory.pk).update(is_sharded=True)
+        rebalance(inventory.pk)
+
+
+def disable_sharding(inventory_id):
+    """关闭分片计数：各分片数量合并回主行后删除分片"""
+    with transaction.atomic():
+        inventory = Inventory.objects.select_for_update().get(pk=inventory_id)
+        if not inventory.is_sharded:
+            return
+        shards = InventoryShard.objects.select_for_update().filter(inventory=inventory)
+        total = shards.aggregate(total=Sum('quantity'))['total'] or 0
+        shards.delete()
+        Inventory.objects.filter(pk=inventory.pk).update(quantity=F('quantity') + total, is_sharded=False)
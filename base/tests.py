@@ -1,7 +1,9 @@
 from django.test import TestCase
 from django.db.utils import IntegrityError
 from django.utils import timezone
-from .models import Medicine, Supplier, SupplierPhone, Customer, Inventory
+from .models import Medicine, Supplier, SupplierPhone, Customer, Inventory, StockMovement
+from .ledger import adjust_inventory, take_snapshot, stock_as_of
+from .shards import enable_sharding, disable_sharding, take_from_shards, rebalance_dry
 from datetime import timedelta
 
 class BaseModelTests(TestCase):
@@ -103,4 +105,425 @@ class BaseModelTests(TestCase):
                 batch_number=batch,
                 expiry_date=expiry,
                 quantity=20
-            )
\ No newline at end of file
+            )
+
+
+class StockLedgerTests(TestCase):
+    """库存流水账测试"""
+
+    def setUp(self):
+        medicine = Medicine.objects.create(
+            common_name='布洛芬缓释胶囊', specification='0.3g*20粒', manufacturer='某某药业',
+            approval_number='国药准字H00000001', buy_price=8, sell_price=15
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=medicine, batch_number='L001',
+            expiry_date=timezone.now().date() + timedelta(days=365), quantity=0
+        )
+
+    def test_adjust_records_movement(self):
+        """手工调整通过流水账完成，并记录原因和结余"""
+        self.assertEqual(adjust_inventory(self.inventory.pk, 30, 'stocktake'), 30)
+        self.assertEqual(adjust_inventory(self.inventory.pk, -5, 'damage'), 25)
+        movements = list(self.inventory.movements.order_by('id').values_list('reason', 'quantity', 'balance'))
+        self.assertEqual(movements, [('stocktake', 30, 30), ('damage', -5, 25)])
+
+    def test_adjust_rejects_negative_balance(self):
+        """调整后为负数时拒绝，且不留下流水"""
+        with self.assertRaises(ValueError):
+            adjust_inventory(self.inventory.pk, -1, 'damage')
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 0)
+        self.assertFalse(StockMovement.objects.exists())
+
+    def test_movements_are_append_only(self):
+        """流水不允许修改或删除"""
+        adjust_inventory(self.inventory.pk, 10, 'stocktake')
+        movement = StockMovement.objects.get()
+        with self.assertRaises(ValueError):
+            movement.save()
+        with self.assertRaises(ValueError):
+            movement.delete()
+
+    def test_stock_as_of_uses_snapshot_and_tail(self):
+        """历史结余 = 快照 + 快照之后的流水"""
+        adjust_inventory(self.inventory.pk, 10, 'stocktake')
+        take_snapshot()
+        adjust_inventory(self.inventory.pk, 5, 'stocktake')
+        before_last = timezone.now()
+        adjust_inventory(self.inventory.pk, -3, 'damage')
+
+        self.assertEqual(stock_as_of(before_last), {self.inventory.pk: 15})
+        self.assertEqual(stock_as_of(timezone.now())[self.inventory.pk], 12)
+        self.assertEqual(stock_as_of(timezone.now() - timedelta(days=1)), {})
+
+    def test_edit_writes_only_changed_fields(self):
+        """编辑批次只写回改动的字段，不覆盖其他请求修改的数量/预留"""
+        from django.contrib.auth import get_user_model
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        user = get_user_model().objects.create_user(username='editor', password='password', is_superuser=True)
+        self.client.force_login(user)
+        data = {
+            'medicine': self.inventory.medicine_id, 'batch_number': 'L001-A',
+            'expiry_date': self.inventory.expiry_date.isoformat(), 'quantity': 0,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(f'/inventory/{self.inventory.pk}/edit/', data)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "base_inventory"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"batch_number"', updates[0])
+        self.assertNotIn('"quantity"', updates[0])
+        self.assertNotIn('"reserved"', updates[0])
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.batch_number, 'L001-A')
+        self.assertFalse(StockMovement.objects.exists())
+
+    def test_admin_add_records_opening(self):
+        """在 Admin 中新增批次同样记期初流水"""
+        from django.contrib.auth import get_user_model
+        self.client.force_login(get_user_model().objects.create_superuser(username='root', password='password'))
+        response = self.client.post('/admin/base/inventory/add/', {
+            'medicine': self.inventory.medicine_id, 'batch_number': 'L002',
+            'expiry_date': self.inventory.expiry_date.isoformat(), 'quantity': 12, 'reserved': 0,
+        })
+        self.assertEqual(response.status_code, 302)
+        movement = StockMovement.objects.get(inventory__batch_number='L002')
+        self.assertEqual((movement.reason, movement.quantity, movement.balance, movement.unit_cost), ('opening', 12, 12, 8))
+
+
+class ShardedInventoryTests(TestCase):
+    """热销批次分片计数测试"""
+
+    def setUp(self):
+        medicine = Medicine.objects.create(
+            common_name='对乙酰氨基酚片', specification='0.5g*12片', manufacturer='某某药业',
+            approval_number='国药准字H00000002', buy_price=2, sell_price=5
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=medicine, batch_number='S001',
+            expiry_date=timezone.now().date() + timedelta(days=365), quantity=40
+        )
+        enable_sharding(self.inventory.pk, shards=3)
+
+    def _live(self):
+        return Inventory.objects.with_live_quantity().get(pk=self.inventory.pk)
+
+    def test_enable_spreads_quantity(self):
+        """开启后数量平均分到主行和各分片，总数不变"""
+        inv = self._live()
+        self.assertTrue(inv.is_sharded)
+        self.assertEqual(inv.live_quantity, 40)
+        self.assertEqual(inv.quantity, 10)
+        self.assertEqual(sorted(inv.shards.values_list('quantity', flat=True)), [10, 10, 10])
+
+    def test_deduction_uses_shards_first(self):
+        """扣减先落在分片上，分片不够时再扣主行；不足时整体回滚"""
+        remaining = take_from_shards({self.inventory.pk: 25})
+        self.assertEqual(remaining, {})
+        self.assertEqual(self._live().quantity, 10)
+        self.assertEqual(adjust_inventory(self.inventory.pk, -12, 'damage'), 3)
+
+        with self.assertRaises(ValueError):
+            adjust_inventory(self.inventory.pk, -4, 'damage')
+        self.assertEqual(self._live().live_quantity, 3)
+        self.assertEqual(self.inventory.movements.get().balance, 3)
+
+    def test_rebalance_and_disable(self):
+        """再平衡只在分片耗尽时发生，关闭分片后数量合并回主行"""
+        take_from_shards({self.inventory.pk: 30})
+        self.assertEqual(rebalance_dry(), 1)
+        inv = self._live()
+        self.assertEqual(inv.live_quantity, 10)
+        self.assertTrue(inv.shards.filter(quantity__gt=0).exists())
+
+        disable_sharding(self.inventory.pk)
+        inv = self._live()
+        self.assertEqual((inv.is_sharded, inv.quantity, inv.shards.count()), (False, 10, 0))
+
+    def test_rebalance_never_goes_negative(self):
+        """主行数量少于已预留数量时，再平衡不会给出负数份额"""
+        from .shards import rebalance
+        self.inventory.shards.update(quantity=0)
+        Inventory.objects.filter(pk=self.inventory.pk).update(quantity=5, reserved=8)
+        rebalance(self.inventory.pk)
+        inv = self._live()
+        self.assertEqual((inv.quantity, inv.live_quantity), (5, 5))
+        self.assertEqual(sorted(inv.shards.values_list('quantity', flat=True)), [0, 0, 0])
+
+        Inventory.objects.filter(pk=self.inventory.pk).update(quantity=20, reserved=8)
+        rebalance(self.inventory.pk)
+        inv = self._live()
+        self.assertEqual((inv.quantity, inv.live_quantity), (11, 20))
+        self.assertEqual(sorted(inv.shards.values_list('quantity', flat=True)), [3, 3, 3])
+
+    def test_reserved_batch_cannot_be_sharded(self):
+        other = Inventory.objects.create(
+            medicine=self.inventory.medicine, batch_number='S002',
+            expiry_date=self.inventory.expiry_date, quantity=10, reserved=2
+        )
+        with self.assertRaises(ValueError):
+            enable_sharding(other.pk)
+        other.refresh_from_db()
+        self.assertFalse(other.is_sharded)
+
+
+class InventoryValuationTests(TestCase):
+    """库存估值测试"""
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        self.medicine = Medicine.objects.create(
+            common_name='头孢克肟分散片', specification='0.1g*6片', manufacturer='甲药业',
+            approval_number='国药准字H00000003', buy_price='2.50', sell_price=6
+        )
+        other = Medicine.objects.create(
+            common_name='维生素C片', specification='0.1g*100片', manufacturer='乙药业',
+            approval_number='国药准字H00000004', buy_price='0.10', sell_price=1
+        )
+        today = timezone.now().date()
+        Inventory.objects.create(medicine=self.medicine, batch_number='V1', expiry_date=today + timedelta(days=10), quantity=4)
+        Inventory.objects.create(medicine=self.medicine, batch_number='V2', expiry_date=today + timedelta(days=400), quantity=10)
+        Inventory.objects.create(medicine=other, batch_number='V3', expiry_date=today - timedelta(days=1), quantity=30)
+        Inventory.objects.create(medicine=other, batch_number='V4', expiry_date=today + timedelta(days=400), quantity=0)
+        get_user_model().objects.create_user(username='valuer', password='password', position='manager')
+        self.client.login(username='valuer', password='password')
+
+    def test_summary_groups_in_sql(self):
+        from .valuation import valuation_summary
+        by_bucket = {row['bucket']: (row['batches'], row['amount']) for row in valuation_summary('bucket')}
+        self.assertEqual(by_bucket, {'30d': (1, 10), 'long': (1, 25), 'expired': (1, 3)})
+        by_manufacturer = [(row['medicine__manufacturer'], row['quantity']) for row in valuation_summary('medicine__manufacturer')]
+        self.assertEqual(by_manufacturer, [('甲药业', 14), ('乙药业', 30)])
+
+    def test_csv_export_streams_rows(self):
+        response = self.client.get('/inventory/valuation/export/')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('药品,'))
+        self.assertIn('V2', lines[2])
+        self.assertTrue(lines[2].endswith(',25.00'))
+
+
+class ExpiryDashboardTests(TestCase):
+    """效期看板测试"""
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        medicine = Medicine.objects.create(
+            common_name='罗红霉素胶囊', specification='0.15g*12粒', manufacturer='丙药业',
+            approval_number='国药准字H00000005', buy_price=3, sell_price=8
+        )
+        today = timezone.now().date()
+        for batch, days, qty in [('E1', -5, 3), ('E2', 20, 5), ('E3', 45, 7), ('E4', 80, 9), ('E5', 200, 11), ('E6', 10, 0)]:
+            Inventory.objects.create(medicine=medicine, batch_number=batch, expiry_date=today + timedelta(days=days), quantity=qty)
+        get_user_model().objects.create_user(username='keeper', password='password', position='warehouse')
+        self.client.login(username='keeper', password='password')
+
+    def test_overview_is_one_query(self):
+        from .expiry import expiry_overview
+        with self.assertNumQueries(1):
+            windows = expiry_overview()
+        # 卖空的批次 E6 不计入
+        self.assertEqual(
+            [(w['code'], w['batches'], w['quantity']) for w in windows],
+            [('expired', 1, 3), ('30d', 1, 5), ('60d', 1, 7), ('90d', 1, 9), ('safe', 1, 11)]
+        )
+
+    def test_expiry_day_counts_as_expired(self):
+        from .expiry import expiry_overview
+        from .valuation import valued_inventory
+        batch = Inventory.objects.create(
+            medicine=Medicine.objects.get(), batch_number='E7', expiry_date=timezone.now().date(), quantity=2
+        )
+        windows = {w['code']: (w['batches'], w['quantity']) for w in expiry_overview()}
+        self.assertEqual(windows['expired'], (2, 5))
+        self.assertEqual(valued_inventory().get(pk=batch.pk).bucket, 'expired')
+
+    def test_medicine_list_flags_and_sorts_in_sql(self):
+        response = self.client.get('/medicine/', {'sort': 'expiry'})
+        items = list(response.context['inventory_items'])
+        self.assertEqual([i.batch_number for i in items], ['E1', 'E6', 'E2', 'E3', 'E4', 'E5'])
+        self.assertEqual([i.is_expiring_soon for i in items], [True] * 5 + [False])
+
+        response = self.client.get('/inventory/expiry/')
+        self.assertEqual([i.batch_number for i in response.context['at_risk']], ['E1', 'E2', 'E3', 'E4'])
+
+
+class SearchIndexTests(TestCase):
+    """药品 / 库存全文检索测试"""
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        self.amoxicillin = Medicine.objects.create(
+            common_name='阿莫西林胶囊', specification='0.25g*24粒', manufacturer='甲制药厂',
+            approval_number='国药准字H10000001', buy_price=5, sell_price=10
+        )
+        self.cefalexin = Medicine.objects.create(
+            common_name='头孢氨苄片', specification='0.125g*36片', manufacturer='乙制药厂阿莫西林车间',
+            approval_number='国药准字H10000002', buy_price=4, sell_price=9
+        )
+        expiry = timezone.now().date() + timedelta(days=365)
+        Inventory.objects.create(medicine=self.amoxicillin, batch_number='AMX2401', expiry_date=expiry, quantity=10)
+        Inventory.objects.create(medicine=self.cefalexin, batch_number='CFX2402', expiry_date=expiry, quantity=10)
+        get_user_model().objects.create_user(username='searcher', password='password', position='manager')
+        self.client.login(username='searcher', password='password')
+
+    def _medicines(self, query):
+        from .search import search_medicines
+        queryset, ranked = search_medicines(Medicine.objects.all(), query)
+        if ranked:
+            queryset = queryset.order_by('search_rank', 'pk')
+        return [m.common_name for m in queryset], ranked
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        from .search import fts_available, MEDICINE_FTS
+        if not fts_available(MEDICINE_FTS):
+            self.skipTest('SQLite FTS5 trigram tokenizer not available')
+        # 通用名命中的排在只有厂家命中的前面
+        self.assertEqual(self._medicines('阿莫西林'), (['阿莫西林胶囊', '头孢氨苄片'], True))
+        self.assertEqual(self._medicines('H10000002'), (['头孢氨苄片'], True))
+
+        Medicine.objects.filter(pk=self.cefalexin.pk).update(manufacturer='乙制药厂')
+        self.assertEqual(self._medicines('阿莫西林'), (['阿莫西林胶囊'], True))
+        self.amoxicillin.delete()
+        self.assertEqual(self._medicines('阿莫西林'), ([], True))
+
+    def test_short_terms_fall_back_to_icontains(self):
+        self.assertEqual(self._medicines('头孢'), (['头孢氨苄片'], False))
+
+    def test_list_views_search_through_index(self):
+        response = self.client.get('/medicine/', {'search': 'CFX24'})
+        self.assertEqual([i.batch_number for i in response.context['inventory_items']], ['CFX2402'])
+        # 药品改名后，批次的索引随之更新
+        Medicine.objects.filter(pk=self.cefalexin.pk).update(common_name='头孢氨苄缓释片')
+        response = self.client.get('/medicine/', {'search': '氨苄缓释'})
+        self.assertEqual([i.batch_number for i in response.context['inventory_items']], ['CFX2402'])
+
+        response = self.client.get('/medicine-info/', {'search': '西林胶囊'})
+        self.assertEqual([m.common_name for m in response.context['medicines']], ['阿莫西林胶囊'])
+
+
+class PinyinSearchTests(TestCase):
+    """拼音检索测试"""
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        for name, number in [('阿莫西林胶囊', 'PY1'), ('头孢氨苄片', 'PY2'), ('维生素C片', 'PY3')]:
+            Medicine.objects.create(
+                common_name=name, specification='1g', manufacturer='拼音药业',
+                approval_number=number, buy_price=1, sell_price=2
+            )
+        get_user_model().objects.create_user(username='counter', password='password', position='sales')
+        self.client.login(username='counter', password='password')
+
+    def test_pinyin_columns_follow_name(self):
+        medicine = Medicine.objects.get(approval_number='PY3')
+        self.assertEqual((medicine.pinyin, medicine.pinyin_initials), ('weishengsucpian', 'wsscp'))
+        medicine.common_name = '维生素B片'
+        medicine.save(update_fields=['common_name'])
+        medicine.refresh_from_db()
+        self.assertEqual(medicine.pinyin_initials, 'wssbp')
+
+    def test_initials_and_full_pinyin_prefix(self):
+        for query, expected in [('amxl', ['阿莫西林胶囊']), ('AMX', ['阿莫西林胶囊']), ('toubao', ['头孢氨苄片']), ('xyz', [])]:
+            response = self.client.get('/medicine-info/', {'search': query})
+            self.assertEqual([m.common_name for m in response.context['medicines']], expected, query)
+
+    def test_prefix_uses_range_on_index(self):
+        from django.db import connection
+        from .pinyin import pinyin_condition
+        sql, params = Medicine.objects.filter(pinyin_condition('amxl')).query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('idx_medicine_py_initials', plan)
+        self.assertIn('idx_medicine_pinyin', plan)
+
+    def test_backfill_command(self):
+        from django.core.management import call_command
+        from io import StringIO
+        Medicine.objects.update(pinyin='', pinyin_initials='')
+        call_command('backfill_medicine_pinyin', stdout=StringIO())
+        self.assertEqual(
+            sorted(Medicine.objects.values_list('pinyin_initials', flat=True)), ['amxljn', 'tbabp', 'wsscp']
+        )
+
+
+class ListPaginationTests(TestCase):
+    """列表分页计数测试"""
+
+    def setUp(self):
+        from django.contrib.auth import get_user_model
+        from django.core.cache import cache
+        cache.clear()
+        for i in range(45):
+            Medicine.objects.create(
+                common_name=f'分页药品{i:02d}', specification='1g', manufacturer='分页药业',
+                approval_number=f'PG{i:02d}', buy_price=i, sell_price=i + 1
+            )
+        get_user_model().objects.create_user(username='pager', password='password', position='manager')
+        self.client.login(username='pager', password='password')
+
+    def _get(self, params):
+        """请求列表页，返回 (响应, 是否执行了 COUNT)"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/medicine-info/', params)
+        return response, any('COUNT(' in q['sql'] for q in queries.captured_queries)
+
+    def test_counter_follows_inserts_and_deletes(self):
+        from .counters import estimated_count, refresh_table_counters
+        self.assertEqual(estimated_count(Medicine), 45)
+        Medicine.objects.filter(approval_number='PG00').delete()
+        self.assertEqual(estimated_count(Medicine), 44)
+        # 绕过信号的批量写入只能校正
+        Medicine.objects.bulk_create([Medicine(
+            common_name='批量药品', specification='1g', manufacturer='M', approval_number='PGX', buy_price=1, sell_price=2
+        )])
+        self.assertEqual(estimated_count(Medicine), 44)
+        self.assertEqual(refresh_table_counters()['base.Medicine'], 45)
+
+    def test_unfiltered_list_uses_counter_without_count(self):
+        from .models import TableCounter
+        from .counters import estimated_count
+        estimated_count(Medicine)
+        response, counted = self._get({'page': 2})
+        self.assertFalse(counted)
+        page = response.context['medicines']
+        self.assertEqual((page.number, page.paginator.num_pages, page.paginator.estimated), (2, 3, True))
+        self.assertContains(response, '约 3 页')
+
+        # 计数偏大时，最后一页以实际取到的行为准；超出范围的页码跳到最后一页
+        TableCounter.objects.filter(table='base.Medicine').update(rows=100)
+        page = self.client.get('/medicine-info/', {'page': 3}).context['medicines']
+        self.assertEqual((len(page), page.has_next(), page.paginator.num_pages), (5, False, 3))
+        page = self.client.get('/medicine-info/', {'page': 5}).context['medicines']
+        self.assertEqual((page.number, len(page), page.paginator.estimated), (3, 5, False))
+
+    def test_filtered_count_is_cached(self):
+        params = {'search': '分页', 'min_buy_price': '10'}
+        # 第一页缓存缺失时 COUNT 一次
+        response, counted = self._get(params)
+        page = response.context['medicines']
+        self.assertTrue(counted)
+        self.assertEqual((page.paginator.count, page.paginator.num_pages, page.paginator.estimated), (35, 2, False))
+        response, counted = self._get(params)
+        self.assertFalse(counted)
+        self.assertEqual(response.context['medicines'].paginator.num_pages, 2)
+
+    def test_deep_page_falls_back_to_has_next(self):
+        from django.core.cache import cache
+        response, counted = self._get({'search': '分页', 'page': 2})
+        page = response.context['medicines']
+        self.assertFalse(counted)
+        self.assertTrue(page.has_next())
+        self.assertIsNone(page.paginator.num_pages)
+        self.assertContains(response, '第 2 页</span>')
+        self.assertNotContains(response, '末页')
+        # 翻到最后一页时得到精确总数
+        cache.clear()
+        page = self.client.get('/medicine-info/', {'search': '分页', 'page': 3}).context['medicines']
+        self.assertEqual((len(page), page.paginator.count, page.paginator.num_pages), (5, 45, 3))
@@ -0,0 +1,87 @@
+import csv
+from datetime import timedelta
+from decimal import Decimal
+from django.db.models import Case, When, Value, F, Sum, Count, CharField, DecimalField, ExpressionWrapper
+from django.utils import timezone
+from .models import Inventory
+
+# ==========================================
+# 库存估值 (数量 * 进价)
+# ==========================================
+# 所有金额都在 SQL 中按 "实时数量 * 药品进价" 汇总，分组维度：药品、生产厂家、有效期区间。
+# CSV 导出逐批次流式输出 (iterator + StreamingHttpResponse)，50 万个批次也只占用固定内存。
+
+# 有效期区间：(编码, 名称, 距今天数上限)；依次判断，最后一档为 "180 天以上"
+# 有效期当天即算已过期，与效期看板 (base/expiry.py) 一致
+EXPIRY_BUCKETS = [
+    ('expired', '已过期', 0),
+    ('30d', '30 天内到期', 30),
+    ('90d', '31-90 天到期', 90),
+    ('180d', '91-180 天到期', 180),
+]
+LONG_BUCKET = ('long', '180 天以上')
+BUCKET_LABELS = dict([(code, label) for code, label, days in EXPIRY_BUCKETS] + [LONG_BUCKET])
+
+
+def valued_inventory():
+    """有库存的批次，附加 live_quantity、有效期区间 bucket 和库存金额 value"""
+    today = timezone.localdate()
+    bucket = Case(
+        *[When(expiry_date__lte=today + timedelta(days=days), then=Value(code))
+          for code, label, days in EXPIRY_BUCKETS],
+        default=Value(LONG_BUCKET[0]),
+        output_field=CharField(),
+    )
+    value = ExpressionWrapper(
+        F('live_quantity') * F('medicine__buy_price'),
+        output_field=DecimalField(max_digits=16, decimal_places=2),
+    )
+    return (
+        Inventory.objects.with_live_quantity()
+        .filter(live_quantity__gt=0)
+        .annotate(bucket=bucket, value=value)
+    )
+
+
+def valuation_summary(*group_by):
+    """
+    按指定维度汇总库存数量和金额 (一条 GROUP BY 查询)，按金额从高到低排列。
+    例如 valuation_summary('medicine__manufacturer') 或
+    valuation_summary('medicine_id', 'medicine__common_name', 'bucket')
+    """
+    rows = list(
+        valued_inventory()
+        .values(*group_by)
+        .annotate(batches=Count('pk'), quantity=Sum('live_quantity'), amount=Sum('value'))
+        .order_by('-amount')
+    )
+    for row in rows:
+        if 'bucket' in row:
+            row['bucket_label'] = BUCKET_LABELS[row['bucket']]
+    return rows
+
+
+class _Echo:
+    """csv.writer 需要一个文件对象，这里直接把写入的一行返回给生成器"""
+
+    def write(self, value):
+        return value
+
+
+def iter_valuation_csv(chunk_size=2000):
+    """逐行生成库存估值 CSV (带 BOM，Excel 直接打开中文不乱码)"""
+    writer = csv.writer(_Echo())
+    yield '\ufeff'
+    yield writer.writerow(['药品', '规格', '生产厂家', '批号', '有效期至', '有效期区间', '数量', '进价', '库存金额'])
+    rows = (
+        valued_inventory()
+        .order_by('medicine__common_name', 'expiry_date', 'pk')
+        .values_list(
+            'medicine__common_name', 'medicine__specification', 'medicine__manufacturer',
+            'batch_number', 'expiry_date', 'bucket', 'live_quantity', 'medicine__buy_price', 'value',
+        )
+        .iterator(chunk_size=chunk_size)
+    )
+    for name, spec, manufacturer, batch, expiry, bucket, quantity, price, value in rows:
+        amount = Decimal(value or 0).quantize(Decimal('0.01'))
+        yield writer.writerow([name, spec, manufacturer, batch, expiry, BUCKET_LABELS[bucket], quantity, price, amount])
@@ -2,12 +2,20 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django import forms
-from .models import Inventory, Customer, Medicine, Supplier
+from .models import Inventory, Customer, Medicine, Supplier, StockMovement
+from .ledger import adjust_inventory, record_movements
+from .valuation import valued_inventory, valuation_summary, iter_valuation_csv
+from .expiry import EXPIRING_SOON_DAYS, expiring_soon, expiry_overview, in_stock
+from .search import search_inventory, search_medicines
+from .counters import estimated_count
+from .pagination import ListPaginator
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta, date
 from django.db import IntegrityError
-from django.db.models import Q
+from django.db.models import F, Q, Sum, Count
 from django.core.paginator import Paginator
+from django.http import StreamingHttpResponse
 
 @login_required
 def medicine_list(request):
@@ -17,24 +25,23 @@ def medicine_list(request):
         messages.error(request, '无权限查看库存')
         return redirect('index')
 
-    queryset = Inventory.objects.select_related('medicine')
+    # 分片批次的数量分散在多行，列表按实时总数量显示和筛选
+    queryset = Inventory.objects.with_live_quantity().select_related('medicine')
     
     # 搜索参数
     search_query = request.GET.get('search', '')
+    ranked = False
     if search_query:
-        queryset = queryset.filter(
-            Q(medicine__common_name__icontains=search_query) |
-            Q(medicine__manufacturer__icontains=search_query) |
-            Q(batch_number__icontains=search_query)
-        )
+        # 全文索引检索 (不支持时退回 icontains)，见 base/search.py
+        queryset, ranked = search_inventory(queryset, search_query)
     
     # 筛选参数
     min_quantity = request.GET.get('min_quantity')
     max_quantity = request.GET.get('max_quantity')
     if min_quantity:
-        queryset = queryset.filter(quantity__gte=min_quantity)
+        queryset = queryset.filter(live_quantity__gte=min_quantity)
     if max_quantity:
-        queryset = queryset.filter(quantity__lte=max_quantity)
+        queryset = queryset.filter(live_quantity__lte=max_quantity)
     
     expiry_start = request.GET.get('expiry_start')
     expiry_end = request.GET.get('expiry_end')
@@ -43,18 +50,29 @@ def medicine_list(request):
     if expiry_end:
         queryset = queryset.filter(expiry_date__lte=expiry_end)
     
-    # 分页
-    paginator = Paginator(queryset.order_by('medicine__common_name', 'expiry_date'), 20)
-    page_number = request.GET.get('page')
-    inventory_items = paginator.get_page(page_number)
-    
-    # 简单的临期判断逻辑 (未来3个月内过期)
-    today = timezone.now().date()
-    warning_date = today + timedelta(days=90)
-    
-    for item in inventory_items:
-        item.is_expiring_soon = item.expiry_date <= warning_date
-        
+    # 临期标记 (未来3个月内过期) 在 SQL 中计算，可直接参与排序
+    queryset = queryset.annotate(is_expiring_soon=expiring_soon())
+    sort = request.GET.get('sort', '')
+    if sort == 'expiry':
+        # 临期优先：临期批次排在前面，再按有效期从近到远
+        ordering = ('-is_expiring_soon', 'expiry_date', 'medicine__common_name')
+    elif ranked:
+        # 有检索词时按相关度排列 (拼音命中的 search_rank 为空，排在最前)
+        ordering = (F('search_rank').asc(nulls_first=True), 'medicine__common_name', 'expiry_date')
+    else:
+        ordering = ('medicine__common_name', 'expiry_date')
+
+    # 分页：不做每页一次的 COUNT(*)，无筛选时用表行数计数估计总页数 (base/pagination.py)
+    filters = {
+        'search': search_query, 'min_quantity': min_quantity, 'max_quantity': max_quantity,
+        'expiry_start': expiry_start, 'expiry_end': expiry_end,
+    }
+    paginator = ListPaginator(
+        queryset.order_by(*ordering, 'pk'), 20, filters,
+        estimated_count=None if any(filters.values()) else estimated_count(Inventory),
+    )
+    inventory_items = paginator.get_page(request.GET.get('page'))
+
     context = {
         'inventory_items': inventory_items,
         'search_query': search_query,
@@ -62,9 +80,66 @@ def medicine_list(request):
         'max_quantity': max_quantity,
         'expiry_start': expiry_start,
         'expiry_end': expiry_end,
+        'sort': sort,
     }
     return render(request, 'base/medicine_list.html', context)
 
+# 效期风险看板
+@login_required
+def expiry_dashboard(request):
+    if not (request.user.has_perm('base.view_inventory') or request.user.position in ['warehouse', 'manager', 'sales']):
+        messages.error(request, '无权限查看库存')
+        return redirect('index')
+
+    # 即将到期的批次按有效期从近到远列出 (走部分索引 idx_inv_expiry_in_stock)
+    warning_date = timezone.localdate() + timedelta(days=EXPIRING_SOON_DAYS)
+    at_risk = (
+        in_stock().filter(expiry_date__lte=warning_date)
+        .select_related('medicine')
+        .order_by('expiry_date', 'pk')
+    )
+    context = {
+        'windows': expiry_overview(),
+        'at_risk': Paginator(at_risk, 50).get_page(request.GET.get('page')),
+        'today': timezone.localdate(),
+        'warning_days': EXPIRING_SOON_DAYS,
+    }
+    return render(request, 'base/expiry_dashboard.html', context)
+
+def can_view_valuation(user):
+    # 库存金额属于财务数据：仓库、经理、财务可以查看
+    return user.has_perm('base.view_inventory') or user.position in ['warehouse', 'manager', 'finance']
+
+# 库存估值视图
+@login_required
+def inventory_valuation(request):
+    if not can_view_valuation(request.user):
+        messages.error(request, '无权限查看库存估值')
+        return redirect('index')
+
+    totals = valued_inventory().aggregate(batches=Count('pk'), quantity=Sum('live_quantity'), amount=Sum('value'))
+    by_medicine = Paginator(
+        valuation_summary('medicine_id', 'medicine__common_name', 'medicine__manufacturer', 'bucket'), 50
+    ).get_page(request.GET.get('page'))
+    context = {
+        'totals': totals,
+        'by_bucket': valuation_summary('bucket'),
+        'by_manufacturer': valuation_summary('medicine__manufacturer'),
+        'by_medicine': by_medicine,
+    }
+    return render(request, 'base/inventory_valuation.html', context)
+
+# 库存估值 CSV 导出 (流式输出，内存占用与批次数量无关)
+@login_required
+def inventory_valuation_csv(request):
+    if not can_view_valuation(request.user):
+        messages.error(request, '无权限导出库存估值')
+        return redirect('index')
+    response = StreamingHttpResponse(iter_valuation_csv(), content_type='text/csv; charset=utf-8')
+    filename = f"inventory_valuation_{timezone.localdate():%Y%m%d}.csv"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 # 客户列表视图
 @login_required
 def customer_list(request):
@@ -97,7 +172,7 @@ class CustomerForm(forms.ModelForm):
     class Meta:
         model = Customer
         fields = [
-            'name', 'type', 'phone',
+            'name', 'type', 'phone', 'credit_limit',
             'province', 'city', 'district',
             'street', 'detail_address', 'zip_code'
         ]
@@ -142,6 +217,11 @@ def customer_edit(request, pk):
 # 库存调整表单
 class InventoryAdjustForm(forms.Form):
     delta = forms.IntegerField(label='调整数量')
+    reason = forms.ChoiceField(
+        label='调整原因',
+        choices=[(code, label) for code, label in StockMovement.REASON_CHOICES if code in StockMovement.ADJUST_REASONS],
+    )
+    note = forms.CharField(label='备注', max_length=200, required=False)
 
 # 库存新增/编辑表单 
 class InventoryForm(forms.ModelForm):
@@ -157,6 +237,10 @@ class InventoryForm(forms.ModelForm):
             self.fields['expiry_date'].widget.attrs['min'] = date.today().isoformat()
         except Exception:
             pass
+        if self.instance.pk and self.instance.is_sharded:
+            # 分片批次的数量分散在多行，只能通过 "调整库存" 修改
+            self.fields['quantity'].disabled = True
+            self.fields['quantity'].help_text = '分片计数批次请通过调整库存修改数量'
 
 # 库存调整视图
 @login_required
@@ -164,17 +248,19 @@ def inventory_adjust(request, pk):
     if not request.user.has_perm('base.change_inventory'):
         messages.error(request, '无权限调整库存')
         return redirect('medicine_list')
-    item = get_object_or_404(Inventory.objects.select_related('medicine'), pk=pk)
+    item = get_object_or_404(Inventory.objects.with_live_quantity().select_related('medicine'), pk=pk)
     if request.method == 'POST':
         form = InventoryAdjustForm(request.POST)
         if form.is_valid():
-            delta = form.cleaned_data['delta']
-            new_qty = item.quantity + delta
-            if new_qty < 0:
-                messages.error(request, '调整后数量不能为负数')
+            try:
+                # 通过流水账原子调整，不再读-改-写 item.save()
+                adjust_inventory(
+                    item.pk, form.cleaned_data['delta'], form.cleaned_data['reason'],
+                    employee=request.user, note=form.cleaned_data['note'],
+                )
+            except ValueError as e:
+                messages.error(request, str(e))
             else:
-                item.quantity = new_qty
-                item.save()
                 messages.success(request, '库存已更新')
                 return redirect('medicine_list')
     else:
@@ -191,7 +277,11 @@ def inventory_create(request):
         form = InventoryForm(request.POST)
         if form.is_valid():
             try:
-                form.save()
+                with transaction.atomic():
+                    item = form.save()
+                    record_movements(
+                        [(item, item.quantity)], 'opening', employee=request.user, unit_cost=item.medicine.buy_price
+                    )
                 messages.success(request, '库存批次已新增')
                 return redirect('medicine_list')
             except IntegrityError:
@@ -211,11 +301,26 @@ def inventory_edit(request, pk):
         form = InventoryForm(request.POST, instance=item)
         if form.is_valid():
             try:
-                form.save()
+                with transaction.atomic():
+                    # 锁定后重新读取，只写回表单改动过的字段：
+                    # 打开页面之后被其他请求修改的 quantity / reserved / is_sharded 不会被旧值覆盖
+                    locked = Inventory.objects.select_for_update().get(pk=item.pk)
+                    changed = [name for name in form.changed_data if not form.fields[name].disabled]
+                    if 'quantity' in changed and locked.is_sharded:
+                        raise ValueError('该批次已开启分片计数，数量只能通过 "调整库存" 修改')
+                    old_quantity = locked.quantity
+                    for name in changed:
+                        setattr(locked, name, form.cleaned_data[name])
+                    if changed:
+                        locked.save(update_fields=changed)
+                    # 差额按锁定时的数量计算，记入流水
+                    record_movements([(locked, locked.quantity - old_quantity)], 'correction', employee=request.user)
                 messages.success(request, '库存批次已更新')
                 return redirect('medicine_list')
             except IntegrityError:
                 form.add_error('batch_number', '同药品批号已存在')
+            except ValueError as e:
+                form.add_error('quantity', str(e))
     else:
         form = InventoryForm(instance=item)
     return render(request, 'base/inventory_form.html', {'form': form, 'is_edit': True, 'item': item})
@@ -232,13 +337,11 @@ def medicine_info_list(request):
     
     # 搜索参数
     search_query = request.GET.get('search', '')
+    ordering = ('common_name', 'manufacturer')
     if search_query:
-        queryset = queryset.filter(
-            Q(common_name__icontains=search_query) |
-            Q(specification__icontains=search_query) |
-            Q(manufacturer__icontains=search_query) |
-            Q(approval_number__icontains=search_query)
-        )
+        queryset, ranked = search_medicines(queryset, search_query)
+        if ranked:
+            ordering = (F('search_rank').asc(nulls_first=True),) + ordering
     
     # 筛选参数
     min_buy_price = request.GET.get('min_buy_price')
@@ -255,10 +358,16 @@ def medicine_info_list(request):
     if max_sell_price:
         queryset = queryset.filter(sell_price__lte=max_sell_price)
     
-    # 分页
-    paginator = Paginator(queryset.order_by('common_name', 'manufacturer'), 20)
-    page_number = request.GET.get('page')
-    medicines = paginator.get_page(page_number)
+    # 分页 (同药品库存列表)
+    filters = {
+        'search': search_query, 'min_buy_price': min_buy_price, 'max_buy_price': max_buy_price,
+        'min_sell_price': min_sell_price, 'max_sell_price': max_sell_price,
+    }
+    paginator = ListPaginator(
+        queryset.order_by(*ordering, 'pk'), 20, filters,
+        estimated_count=None if any(filters.values()) else estimated_count(Medicine),
+    )
+    medicines = paginator.get_page(request.GET.get('page'))
     
     context = {
         'medicines': medicines,
@@ -1,10 +1,91 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.http import HttpResponseRedirect
 from .models import (
     PurchaseOrder, PurchaseDetail,
     SalesOrder, SalesDetail,
     SalesReturnOrder, SalesReturnDetail,
-    PurchaseReturnOrder, PurchaseReturnDetail
+    PurchaseReturnOrder, PurchaseReturnDetail,
+    StockReservation, DailyBizSummary, SalesCube, Receipt,
+    SupplierMonthlyMetrics, OrderSearchDoc
 )
+from .signals import defer_order_totals
+from .reservations import reserve_order
+from .stock_writer import get_stock_writer, submit_approval, submit_approvals
+
+
+class DeferredTotalsMixin:
+    """保存内联明细时延迟重算单据总金额，整张单据只重算一次"""
+
+    def save_related(self, request, form, formsets, change):
+        # changeform_view 本身已在事务中执行
+        with defer_order_totals():
+            super().save_related(request, form, formsets, change)
+
+class _OrderRejected(Exception):
+    """保存单据时的业务错误 (库存不足等)，由 ApprovalSaveMixin 转为页面提示"""
+
+
+class ApprovalSaveMixin:
+    """
+    编辑页把状态改为 "已审核" 时，单据先按原状态保存，明细保存之后再经 submit_approval 审核过账：
+    未开启组提交时在同一事务中直接过账；开启组提交 (settings.STOCK_WRITER) 时在事务提交之后交给写入线程。
+    库存不足等业务错误 (ValueError) 时整次保存回滚，在页面上提示错误并回到编辑页，而不是返回 500
+    (组提交模式下单据已经保存，保持原状态)。
+    """
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        request._approve_after_commit = None
+        try:
+            # 父类在事务中执行，异常抛出时单据和明细的写入已全部回滚
+            response = super().changeform_view(request, object_id, form_url, extra_context)
+        except _OrderRejected as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return HttpResponseRedirect(request.get_full_path())
+        order = request._approve_after_commit
+        if order is not None:
+            try:
+                submit_approval(order)
+            except ValueError as e:
+                self.message_user(request, f"{order} 已保存，但审核失败：{e}", messages.ERROR)
+        return response
+
+    @staticmethod
+    def reject_on_error(func, *args):
+        try:
+            return func(*args)
+        except ValueError as e:
+            raise _OrderRejected(str(e)) from e
+
+    def save_model(self, request, obj, form, change):
+        obj._approving = obj.status == 'approved' and obj._loaded_status != 'approved'
+        if obj._approving:
+            obj.status = obj._loaded_status or 'pending'
+        super().save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        # 重算总金额时超出信用额度等错误同样回滚并提示
+        self.reject_on_error(super().save_related, request, form, formsets, change)
+        order = form.instance
+        if getattr(order, '_approving', False):
+            # 明细已保存、总金额已重算 (DeferredTotalsMixin)，审核使用新金额
+            order.refresh_from_db(fields=['total_amount'])
+            if get_stock_writer() is None:
+                self.reject_on_error(submit_approval, order)
+            else:
+                request._approve_after_commit = order
+
+class BulkApproveMixin:
+    """列表页 "批量审核" 动作：整批一次加锁、逐单过账 (每单一个保存点)，失败的单据单独提示"""
+    actions = ['approve_selected']
+
+    @admin.action(description="批量审核所选单据")
+    def approve_selected(self, request, queryset):
+        results = submit_approvals(self.model, list(queryset.values_list('pk', flat=True)))
+        approved = sum(1 for order, error in results if error is None)
+        self.message_user(request, f"已审核 {approved} 张单据", messages.SUCCESS)
+        for order, error in results:
+            if error:
+                self.message_user(request, f"{order} 审核失败：{error}", messages.ERROR)
 
 # ==========================================
 # 1. 进货业务 Admin 配置
@@ -16,7 +97,7 @@ class PurchaseDetailInline(admin.TabularInline):
     extra = 1
 
 @admin.register(PurchaseOrder)
-class PurchaseOrderAdmin(admin.ModelAdmin):
+class PurchaseOrderAdmin(ApprovalSaveMixin, BulkApproveMixin, DeferredTotalsMixin, admin.ModelAdmin):
     """进货单管理"""
     inlines = [PurchaseDetailInline]
     list_display = ['id', 'supplier', 'employee', 'total_amount', 'status', 'order_date']
@@ -47,7 +128,7 @@ class SalesDetailInline(admin.TabularInline):
     extra = 1
 
 @admin.register(SalesOrder)
-class SalesOrderAdmin(admin.ModelAdmin):
+class SalesOrderAdmin(ApprovalSaveMixin, BulkApproveMixin, DeferredTotalsMixin, admin.ModelAdmin):
     """销售单管理"""
     inlines = [SalesDetailInline]
     list_display = ['id', 'customer', 'employee', 'total_amount', 'status', 'order_date']
@@ -56,6 +137,11 @@ class SalesOrderAdmin(admin.ModelAdmin):
     
     readonly_fields = ['total_amount']
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # 待审核销售单按明细预留库存，可用库存不足时整次保存回滚并提示
+        self.reject_on_error(reserve_order, form.instance)
+
     def get_readonly_fields(self, request, obj=None):
         """新建时锁定状态，防止直接审核导致库存不扣减 bug"""
         if obj is None:
@@ -72,7 +158,7 @@ class SalesReturnDetailInline(admin.TabularInline):
     extra = 1
 
 @admin.register(SalesReturnOrder)
-class SalesReturnOrderAdmin(admin.ModelAdmin):
+class SalesReturnOrderAdmin(ApprovalSaveMixin, BulkApproveMixin, DeferredTotalsMixin, admin.ModelAdmin):
     """销售退货单管理"""
     inlines = [SalesReturnDetailInline]
     list_display = ['id', 'customer', 'employee', 'total_amount', 'status', 'return_date']
@@ -97,7 +183,7 @@ class PurchaseReturnDetailInline(admin.TabularInline):
     extra = 1
 
 @admin.register(PurchaseReturnOrder)
-class PurchaseReturnOrderAdmin(admin.ModelAdmin):
+class PurchaseReturnOrderAdmin(ApprovalSaveMixin, BulkApproveMixin, DeferredTotalsMixin, admin.ModelAdmin):
     """采购退货单管理"""
     inlines = [PurchaseReturnDetailInline]
     list_display = ['id', 'supplier', 'employee', 'total_amount', 'status', 'return_date']
@@ -110,4 +196,82 @@ class PurchaseReturnOrderAdmin(admin.ModelAdmin):
         """新建时锁定状态"""
         if obj is None:
             return ['status', 'total_amount']
-        return self.readonly_fields
\ No newline at end of file
+        return self.readonly_fields
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    """库存预留 (只读，由销售单自动维护)"""
+    list_display = ['order', 'inventory', 'quantity', 'created_at', 'expires_at']
+    list_filter = ['expires_at']
+    list_select_related = ['order__customer', 'inventory__medicine']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(DailyBizSummary)
+class DailyBizSummaryAdmin(admin.ModelAdmin):
+    """每日业务汇总 (只读，由审核自动维护，可用 rebuild_daily_summary 命令重建)"""
+    list_display = ['day', 'doc_type', 'order_count', 'amount']
+    list_filter = ['doc_type', 'day']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SalesCube)
+class SalesCubeAdmin(admin.ModelAdmin):
+    """销售多维汇总 (只读，由审核自动维护，可用 rebuild_sales_cube 命令重建)"""
+    list_display = ['month', 'medicine', 'manufacturer', 'customer_type', 'province', 'city', 'quantity', 'amount']
+    list_filter = ['month', 'customer_type', 'province']
+    list_select_related = ['medicine']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Receipt)
+class ReceiptAdmin(admin.ModelAdmin):
+    """销售收款管理"""
+    list_display = ['id', 'order', 'amount', 'method', 'received_at', 'employee']
+    list_filter = ['method', 'received_at']
+    search_fields = ['order__id', 'order__customer__name']
+    raw_id_fields = ['order']
+    list_select_related = ['order__customer', 'employee']
+
+
+@admin.register(SupplierMonthlyMetrics)
+class SupplierMonthlyMetricsAdmin(admin.ModelAdmin):
+    """供应商月度指标 (只读，由审核自动维护，可用 rebuild_supplier_metrics 命令重建)"""
+    list_display = ['supplier', 'month', 'purchase_orders', 'purchase_amount', 'return_amount']
+    list_filter = ['month']
+    list_select_related = ['supplier']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(OrderSearchDoc)
+class OrderSearchDocAdmin(admin.ModelAdmin):
+    """单据检索文档 (只读，随单据自动维护，可用 rebuild_order_search 命令重建)"""
+    list_display = ['kind', 'order_id', 'document']
+    list_filter = ['kind']
+    search_fields = ['document']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,60 @@
+from django.db import DatabaseError, transaction
+from .stock import _collect, _lock_rows
+
+# ==========================================
+# 单据审核
+# ==========================================
+# 审核 = 把 status 改为 approved 并保存，库存过账等动作由 biz/signals.py 中的信号完成。
+
+
+def approve_order(order):
+    """
+    审核一张单据。库存不足等业务错误抛出 ValueError，
+    此时本次审核的所有写入都会回滚，内存中的单据也恢复原状态。
+    """
+    if order.status == 'approved':
+        return
+    previous = order.status
+    order.status = 'approved'
+    try:
+        with transaction.atomic():
+            order.save(update_fields=['status'])
+    except Exception:
+        order.status = previous
+        raise
+
+
+def approve_orders(order_model, pks):
+    """
+    批量审核多张单据，返回 [(order, 错误信息或 None)]，按单号排序。
+    - 两条查询取出所有待审核单据及其明细 (信号里的 details.all() 直接使用预取结果)
+    - 一条查询按主键顺序锁定所有单据涉及的库存行，之后逐单过账不会与其他审核互相死锁
+    - 每张单据一个保存点：某张单据库存不足或遇到数据库错误只回滚它自己，已审核成功的单据照常提交
+    只有加锁是整批一次完成的；库存过账仍由信号逐单执行 (每张单据各自一条 UPDATE 和一条流水 INSERT)，
+    这样单张单据失败时回滚到它自己的保存点即可，不影响其他单据。
+    """
+    results = []
+    with transaction.atomic():
+        orders = list(
+            order_model.objects.filter(pk__in=pks, status='pending')
+            .prefetch_related('details')
+            .order_by('pk')
+        )
+        # 只指定药品的销售明细 (FEFO) 在审核时才分配批次，由 allocate_fefo 自己加锁
+        lines, _ = _collect(
+            d for order in orders for d in order.details.all()
+            if getattr(d, 'inventory_id', None) or getattr(d, 'batch_number', None)
+        )
+        _lock_rows(lines)
+
+        for order in orders:
+            try:
+                approve_order(order)
+            except ValueError as e:
+                results.append((order, str(e)))
+            except DatabaseError as e:
+                # 数据库错误 (如 SQLite 的 database is locked、唯一约束冲突) 同样只回滚这一张单据
+                results.append((order, f"数据库错误：{e}"))
+            else:
+                results.append((order, None))
+    return results
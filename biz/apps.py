@@ -1,4 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def ensure_order_search_triggers(sender, using, **kwargs):
+    """migrate 之后补建单据检索的 FTS 同步触发器 (同 base.apps.ensure_search_triggers)"""
+    from django.db import connections
+    from base.search import install_search_index
+    from .order_search import TABLE_SQL, TRIGGER_SQL
+    install_search_index(connections[using], create_tables=False, tables=TABLE_SQL, triggers=TRIGGER_SQL)
+
 
 class BizConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
@@ -6,4 +16,5 @@ class BizConfig(AppConfig):
     verbose_name = '03. 业务中心'
 
     def ready(self):
-        import biz.signals  # 必须写这行！
\ No newline at end of file
+        import biz.signals  # 必须写这行！
+        post_migrate.connect(ensure_order_search_triggers, sender=self)
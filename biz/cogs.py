@@ -0,0 +1,239 @@
+from decimal import Decimal
+import numpy as np
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, ExtractDay, ExtractMonth, ExtractYear, Round
+from base.models import Inventory, Medicine, StockMovement
+from .models import PurchaseDetail, SalesDetail, SalesReturnDetail, PurchaseReturnDetail
+from .reports import single_flight
+
+# ==========================================
+# 先进先出 (FIFO) 销售成本与毛利
+# ==========================================
+# 每个库存批次 (药品 + 批号) 的成本层按时间排列：期初库存 (启用流水前单据解释不了的部分) -> 各次进货 -> 兜底层 (按药品进价)。
+# 出库事件 (销售、采购退货为正，销售退货为负) 在批次内累计，得到每个事件前后的累计出库量 C。
+# 前 x 件的累计成本 F(x) 是成本层上的分段线性函数，事件成本 = F(C 后) - F(C 前)；
+# 销售退货因此按最近出库的那部分成本冲回。
+# 全部批次拼成一条数轴，F 用 cumsum + searchsorted 一次算完，没有逐行的 Python 循环。
+# 金额一律使用整数 "分" 计算，避免浮点误差。
+
+SALE, SALES_RETURN, PURCHASE_RETURN = 0, 1, 2
+
+
+def _cents(field):
+    """在数据库中把金额换算成整数分"""
+    return Cast(Round(F(field) * 100), IntegerField())
+
+
+def _day_number(prefix):
+    """年月日拼成整数 YYYYMMDD，便于按日期区间和月份筛选"""
+    return (
+        ExtractYear(prefix) * 10000 + ExtractMonth(prefix) * 100 + ExtractDay(prefix)
+    )
+
+
+def _events(end=None):
+    """
+    所有已审核的出库/退货事件，按发生时间排序 (一条 UNION 查询)。
+    列：(库存批次, 类型, 数量, 单价分, YYYYMMDD)
+    """
+    sources = [
+        (SalesDetail, SALE, 'actual_price', 'order__order_date'),
+        (SalesReturnDetail, SALES_RETURN, 'refund_price', 'order__return_date'),
+        (PurchaseReturnDetail, PURCHASE_RETURN, 'unit_price', 'order__return_date'),
+    ]
+    querysets = []
+    for model, kind, price_field, date_field in sources:
+        qs = model.objects.filter(order__status='approved', inventory__isnull=False)
+        if end is not None:
+            qs = qs.filter(**{f'{date_field}__date__lte': end})
+        querysets.append(
+            qs.annotate(
+                kind=Value(kind, output_field=IntegerField()),
+                price=_cents(price_field),
+                day=_day_number(date_field),
+                happened_at=F(date_field),
+            ).values_list('inventory_id', 'kind', 'quantity', 'price', 'day', 'happened_at')
+        )
+    rows = list(querysets[0].union(*querysets[1:], all=True).order_by('happened_at'))
+    if not rows:
+        return np.zeros((0, 5), dtype=np.int64)
+    return np.array([row[:5] for row in rows], dtype=np.int64)
+
+
+def _before_opening(model, date_field, **match):
+    """期初流水写入之前已审核明细的数量合计 (相关子查询，没有时为 0)"""
+    rows = (
+        model.objects.filter(order__status='approved', **{f'{date_field}__lt': OuterRef('created_at')}, **match)
+        .order_by().values('order__status').annotate(total=Sum('quantity')).values('total')[:1]
+    )
+    return Coalesce(Subquery(rows), 0)
+
+
+def _layers(end=None):
+    """
+    成本层 (库存批次, 数量, 单位成本分)，同一批次内按时间顺序：
+    期初库存在前，已审核进货按进货日期在后。
+    期初结存是启用流水那一刻的结余，其中启用前的进货和出库已经有单据，会分别作为进货层和出库事件参与匹配；
+    期初层只保留单据解释不了的部分 (期初数量 - 启用前进货 + 启用前净出库，不小于 0)，
+    成本取写流水时记下的单位成本，不读会变的药品进价。
+    """
+    opening = (
+        StockMovement.objects.filter(reason='opening')
+        .annotate(
+            cost=Cast(Round(Coalesce('unit_cost', 'inventory__medicine__buy_price') * 100), IntegerField()),
+            received=_before_opening(
+                PurchaseDetail, 'order__order_date',
+                medicine=OuterRef('inventory__medicine'), batch_number=OuterRef('inventory__batch_number'),
+            ),
+            sold=_before_opening(SalesDetail, 'order__order_date', inventory=OuterRef('inventory')),
+            returned=_before_opening(SalesReturnDetail, 'order__return_date', inventory=OuterRef('inventory')),
+            sent_back=_before_opening(PurchaseReturnDetail, 'order__return_date', inventory=OuterRef('inventory')),
+        )
+        .annotate(unexplained=F('quantity') - F('received') + F('sold') - F('returned') + F('sent_back'))
+        .filter(unexplained__gt=0)
+        .values_list('inventory_id', 'unexplained', 'cost')
+    )
+    receipts = PurchaseDetail.objects.filter(order__status='approved')
+    if end is not None:
+        receipts = receipts.filter(order__order_date__date__lte=end)
+    batch = Inventory.objects.filter(medicine=OuterRef('medicine'), batch_number=OuterRef('batch_number'))
+    receipts = list(
+        receipts.annotate(inventory_id=Subquery(batch.values('pk')[:1]), cost=_cents('unit_price'))
+        .filter(inventory_id__isnull=False)
+        .order_by('order__order_date', 'pk')
+        .values_list('inventory_id', 'quantity', 'cost')
+    )
+    return (
+        np.array(list(opening), dtype=np.int64).reshape(-1, 3),
+        np.array(receipts, dtype=np.int64).reshape(-1, 3),
+    )
+
+
+def _fifo_costs(events, opening, receipts, fallback_cost):
+    """
+    计算每个事件的 FIFO 成本 (分，销售退货为负)。
+    events: _events() 的结果；fallback_cost: {库存批次: 进价分}，成本层不够时使用。
+    """
+    inv_ids = np.unique(np.concatenate([events[:, 0], opening[:, 0], receipts[:, 0]]))
+    n_keys = len(inv_ids)
+
+    # 出库方向：销售、采购退货为正，销售退货为负
+    signed = np.where(events[:, 1] == SALES_RETURN, -events[:, 2], events[:, 2])
+    event_key = np.searchsorted(inv_ids, events[:, 0])
+
+    # 成本层：期初 (序号 -1) -> 进货 (按时间) -> 兜底层 (数量足够覆盖该批次所有出库)
+    overflow_qty = np.bincount(event_key, weights=np.abs(signed), minlength=n_keys).astype(np.int64) + 1
+    fallback = np.array([fallback_cost.get(int(pk), 0) for pk in inv_ids], dtype=np.int64)
+    layer_key = np.concatenate([
+        np.searchsorted(inv_ids, opening[:, 0]), np.searchsorted(inv_ids, receipts[:, 0]), np.arange(n_keys)
+    ])
+    layer_seq = np.concatenate([
+        np.full(len(opening), -1), np.arange(len(receipts)), np.full(n_keys, len(receipts))
+    ])
+    layer_qty = np.concatenate([opening[:, 1], receipts[:, 1], overflow_qty])
+    layer_cost = np.concatenate([opening[:, 2], receipts[:, 2], fallback])
+    order = np.lexsort((layer_seq, layer_key))
+    layer_key, layer_qty, layer_cost = layer_key[order], layer_qty[order], layer_cost[order]
+
+    # 所有批次的成本层拼成一条数轴
+    layer_end = np.cumsum(layer_qty)
+    layer_start = layer_end - layer_qty
+    value_end = np.cumsum(layer_qty * layer_cost)
+    value_start = value_end - layer_qty * layer_cost
+    first_layer = np.searchsorted(layer_key, np.arange(n_keys))
+    key_base, key_value_base = layer_start[first_layer], value_start[first_layer]
+
+    def cost_of_first(keys, x):
+        """批次 keys 中最先出库的 x 件的累计成本"""
+        position = key_base[keys] + np.maximum(x, 0)
+        layer = np.searchsorted(layer_start, position, side='right') - 1
+        return value_start[layer] + (position - layer_start[layer]) * layer_cost[layer] - key_value_base[keys]
+
+    # 批次内累计出库量 (事件已按时间排序，稳定排序保持批次内的时间顺序)
+    by_key = np.argsort(event_key, kind='stable')
+    sorted_keys, sorted_signed = event_key[by_key], signed[by_key]
+    running = np.cumsum(sorted_signed)
+    group_first = np.searchsorted(sorted_keys, sorted_keys)
+    after = running - (running[group_first] - sorted_signed[group_first])
+    before = after - sorted_signed
+
+    costs = np.empty(len(events), dtype=np.int64)
+    costs[by_key] = cost_of_first(sorted_keys, after) - cost_of_first(sorted_keys, before)
+    return costs
+
+
+def _to_yuan(cents):
+    return (Decimal(int(cents)) / 100).quantize(Decimal('0.01'))
+
+
+def _rows(index, revenue, cogs, quantity, labels):
+    rows = []
+    for i, label in enumerate(labels):
+        margin = revenue[i] - cogs[i]
+        rows.append({
+            'key': index[i],
+            'label': label,
+            'quantity': int(quantity[i]),
+            'revenue': _to_yuan(revenue[i]),
+            'cogs': _to_yuan(cogs[i]),
+            'margin': _to_yuan(margin),
+            'margin_pct': round(float(margin) * 100 / float(revenue[i]), 1) if revenue[i] else None,
+        })
+    return rows
+
+
+@single_flight()
+def gross_margin(start=None, end=None):
+    """
+    按 FIFO 成本计算 [start, end] 期间的毛利 (end 之前的全部历史参与成本匹配)。
+    返回 {'totals', 'by_medicine', 'by_period'}；收入 = 销售 - 销售退货，成本同理冲回。
+    """
+    events = _events(end)
+    opening, receipts = _layers(end)
+    empty = {'totals': _rows([None], [0], [0], [0], ['合计'])[0], 'by_medicine': [], 'by_period': []}
+    if not len(events):
+        return empty
+
+    inv_ids = np.unique(events[:, 0])
+    batches = dict(
+        (pk, (medicine_id, cost)) for pk, medicine_id, cost in
+        Inventory.objects.filter(pk__in=inv_ids.tolist())
+        .annotate(cost=_cents('medicine__buy_price'))
+        .values_list('pk', 'medicine_id', 'cost')
+    )
+    costs = _fifo_costs(events, opening, receipts, {pk: cost for pk, (m, cost) in batches.items()})
+
+    kind, qty, price, day = events[:, 1], events[:, 2], events[:, 3], events[:, 4]
+    in_range = np.ones(len(events), dtype=bool)
+    if start is not None:
+        in_range &= day >= start.year * 10000 + start.month * 100 + start.day
+    # 采购退货不计入销售收入和销售成本
+    selling = in_range & (kind != PURCHASE_RETURN)
+    if not selling.any():
+        return empty
+    sign = np.where(kind == SALES_RETURN, -1, 1)
+    revenue = (sign * qty * price)[selling]
+    cogs = costs[selling]
+    sold = (sign * qty)[selling]
+
+    medicine_of = np.array([batches[int(pk)][0] for pk in inv_ids], dtype=np.int64)
+    medicine = medicine_of[np.searchsorted(inv_ids, events[selling, 0])]
+    period = day[selling] // 100
+
+    def group(keys):
+        index, inverse = np.unique(keys, return_inverse=True)
+        sums = np.zeros((3, len(index)), dtype=np.int64)
+        for row, values in enumerate((revenue, cogs, sold)):
+            np.add.at(sums[row], inverse, values)
+        return index.tolist(), sums
+
+    med_index, med_sums = group(medicine)
+    names = dict(Medicine.objects.filter(pk__in=med_index).values_list('pk', 'common_name'))
+    by_medicine = _rows(med_index, *med_sums, [names.get(pk, pk) for pk in med_index])
+    by_medicine.sort(key=lambda row: row['margin'], reverse=True)
+
+    period_index, period_sums = group(period)
+    by_period = _rows(period_index, *period_sums, [f'{p // 100}-{p % 100:02d}' for p in period_index])
+
+    totals = _rows([None], [revenue.sum()], [cogs.sum()], [sold.sum()], ['合计'])[0]
+    return {'totals': totals, 'by_medicine': by_medicine, 'by_period': by_period}
@@ -0,0 +1,75 @@
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from base.models import Customer
+from .models import SalesOrder, Receipt
+
+# ==========================================
+# 客户信用额度
+# ==========================================
+# Customer.outstanding_balance 是冗余的未收余额 (已审核销售单金额 - 已收款)，
+# 由 biz/signals.py 在审核、撤销审核、修改已审核单据金额、登记/删除收款的同一事务中增量维护。
+# 审核时的额度检查与累加是同一条条件 UPDATE (单行)：
+#     UPDATE customer SET outstanding_balance = outstanding_balance + 金额
+#     WHERE id = ? AND (credit_limit IS NULL OR outstanding_balance + 金额 <= credit_limit)
+# 更新 0 行即超额，抛出 ValueError 使整个审核回滚；并发审核在这一行上排队，不会一起超额。
+# 审核和已审核单据的总金额增加 (重算总金额时) 会检查额度；撤销审核、金额减少、收款只调整余额。
+# 收款一经登记即冲减余额 (即使对应销售单之后被撤销审核，客户确实已经付过这笔钱)。
+
+
+def charge(customer_id, amount, enforce=False):
+    """未收余额增加 amount；enforce=True 时超出信用额度则抛出 ValueError"""
+    if not amount:
+        return
+    rows = Customer.objects.filter(pk=customer_id)
+    if enforce and amount > 0:
+        rows = rows.filter(
+            Q(credit_limit__isnull=True) | Q(credit_limit__gte=F('outstanding_balance') + amount)
+        )
+    if not rows.update(outstanding_balance=F('outstanding_balance') + amount) and enforce:
+        customer = Customer.objects.filter(pk=customer_id).values('name', 'credit_limit', 'outstanding_balance').first()
+        if customer is None:
+            raise ValueError("客户不存在")
+        raise ValueError(
+            f"超出信用额度：客户 {customer['name']} 额度 ¥{customer['credit_limit']}，"
+            f"未收余额 ¥{customer['outstanding_balance']}，本单 ¥{amount}"
+        )
+
+
+def release(customer_id, amount):
+    """未收余额减少 amount (撤销审核、收款等)"""
+    charge(customer_id, -amount)
+
+
+def adjust_totals(before, totals):
+    """
+    已审核单据总金额重算后同步未收余额；金额增加时检查额度，超额抛出 ValueError (整次保存回滚)。
+    before: {pk: (日期, 原金额)} (见 reports.approved_contributions)；totals: {pk: 新金额}
+    """
+    deltas = {pk: totals[pk] - amount for pk, (day, amount) in before.items() if totals[pk] != amount}
+    if not deltas:
+        return
+    changes = {}
+    for pk, customer_id in SalesOrder.objects.filter(pk__in=list(deltas)).values_list('pk', 'customer_id'):
+        changes[customer_id] = changes.get(customer_id, Decimal('0')) + deltas[pk]
+    for customer_id, amount in changes.items():
+        charge(customer_id, amount, enforce=True)
+
+
+def rebuild_outstanding():
+    """从已审核销售单和收款全量重算所有客户的未收余额 (一条 UPDATE)，返回更新的客户数"""
+    sales = (
+        SalesOrder.objects.filter(customer=OuterRef('pk'), status='approved')
+        .values('customer').annotate(total=Sum('total_amount')).values('total')
+    )
+    receipts = (
+        Receipt.objects.filter(order__customer=OuterRef('pk'))
+        .values('order__customer').annotate(total=Sum('amount')).values('total')
+    )
+    field = Customer._meta.get_field('outstanding_balance')
+    with transaction.atomic():
+        return Customer.objects.update(
+            outstanding_balance=Coalesce(Subquery(sales), Value(0), output_field=field)
+            - Coalesce(Subquery(receipts), Value(0), output_field=field)
+        )
@@ -0,0 +1,293 @@
+from datetime import date, datetime, time
+from decimal import Decimal
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, DateField, F, Max, Min, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncMonth
+from django.utils import timezone
+from base.models import Medicine
+from .models import SalesOrder, SalesDetail, SalesCube
+from .reports import bump_report_version
+
+# ==========================================
+# 销售多维汇总 (立方体)
+# ==========================================
+# 已审核销售明细按 (月份, 药品, 客户类型, 省份, 城市) 累计到 SalesCube，生产厂家随药品冗余存储：
+#   - 审核 / 撤销审核 / 删除已审核单据 / 修改已审核单据的日期或客户时，
+#     由 biz/signals.py 在同一事务中按单据前后的单元格差额增量更新 (apply_order_change)
+#   - 已审核单据的明细被修改时，重算该单据所在的切片 (月份 + 客户类型 + 省份 + 城市)
+#   - rebuild_sales_cube() 按月分块全量重建，每个月一个事务 (管理命令 rebuild_sales_cube)
+# 客户维度取审核时记在销售单上的客户类型和地址 (SalesOrder.customer_type 等)，
+# 之后修改客户资料不会改变已审核单据所在的单元格，重建也按单据上记下的值归类。
+# cube_query() 回答任意维度组合的上卷和切片，只查询立方体表。
+
+# 维度 -> (立方体字段, 名称)
+DIMENSIONS = {
+    'month': ('month', '月份'),
+    'manufacturer': ('manufacturer', '生产厂家'),
+    'medicine': ('medicine_id', '药品'),
+    'customer_type': ('customer_type', '客户类型'),
+    'province': ('province', '省份'),
+    'city': ('city', '城市'),
+}
+
+# 下钻路径：点击某一行后按哪个维度继续展开 (已筛选的维度跳过)
+DRILL_DOWN = {
+    'month': ['manufacturer', 'medicine'],
+    'manufacturer': ['medicine'],
+    'customer_type': ['province', 'city', 'medicine'],
+    'province': ['city', 'medicine'],
+    'city': ['customer_type', 'medicine'],
+    'medicine': ['month'],
+}
+
+CUSTOMER_TYPE_LABELS = {'wholesale': '批发', 'retail': '零售'}
+
+
+def _cells(details):
+    """
+    把明细在 SQL 中按立方体维度分组，返回
+    {(月份, 药品, 客户类型, 省份, 城市): [数量, 金额, 行数, 生产厂家]}
+    FEFO 分配后的明细以批次所属药品为准，未分配的以明细上的药品为准。
+    """
+    rows = (
+        details.annotate(
+            cube_month=TruncMonth('order__order_date', output_field=DateField()),
+            cube_medicine=Coalesce('inventory__medicine_id', 'medicine_id'),
+            cube_manufacturer=Coalesce('inventory__medicine__manufacturer', 'medicine__manufacturer'),
+        )
+        .values(
+            'cube_month', 'cube_medicine', 'cube_manufacturer',
+            'order__customer_type', 'order__customer_province', 'order__customer_city',
+        )
+        .annotate(qty=Sum('quantity'), amount=Sum('total_amount'), lines=Count('pk'))
+        .order_by()
+    )
+    cells = {}
+    for row in rows:
+        if row['cube_medicine'] is None:
+            continue
+        key = (
+            row['cube_month'], row['cube_medicine'], row['order__customer_type'],
+            row['order__customer_province'], row['order__customer_city'],
+        )
+        cell = cells.setdefault(key, [0, Decimal('0'), 0, row['cube_manufacturer']])
+        cell[0] += row['qty'] or 0
+        cell[1] += row['amount'] or Decimal('0')
+        cell[2] += row['lines']
+    return cells
+
+
+def order_cells(order_ids):
+    """已审核销售单当前对立方体的贡献 (未审核的单据不计)"""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return {}
+    return _cells(SalesDetail.objects.filter(order_id__in=order_ids, order__status='approved'))
+
+
+def apply_order_change(before, after):
+    """单据的贡献从 before 变为 after (均为 order_cells() 的结果) 时，把差额累加到立方体"""
+    deltas = {}
+    for cells, sign in ((before or {}, -1), (after or {}, 1)):
+        for key, (qty, amount, lines, manufacturer) in cells.items():
+            delta = deltas.setdefault(key, [0, Decimal('0'), 0, manufacturer])
+            delta[0] += sign * qty
+            delta[1] += sign * amount
+            delta[2] += sign * lines
+    deltas = {key: delta for key, delta in deltas.items() if delta[0] or delta[1] or delta[2]}
+    if not deltas:
+        return
+    transaction.on_commit(bump_report_version)
+
+    # 已有的单元格一条 UPDATE 批量累加，不存在的一次 bulk_create；查询数与单元格数量无关
+    match = Q()
+    for month, medicine_id, customer_type, province, city in deltas:
+        match |= Q(month=month, medicine_id=medicine_id, customer_type=customer_type, province=province, city=city)
+    existing = {
+        key[1:]: key[0] for key in SalesCube.objects.filter(match)
+        .values_list('pk', 'month', 'medicine_id', 'customer_type', 'province', 'city')
+    }
+    if existing:
+        def increment(field, index):
+            output = SalesCube._meta.get_field(field)
+            return Case(
+                *[When(pk=pk, then=F(field) + Value(deltas[key][index], output_field=output))
+                  for key, pk in existing.items()],
+                default=F(field), output_field=output,
+            )
+        SalesCube.objects.filter(pk__in=existing.values()).update(
+            quantity=increment('quantity', 0), amount=increment('amount', 1), line_count=increment('line_count', 2),
+        )
+    missing = [
+        SalesCube(
+            month=key[0], medicine_id=key[1], customer_type=key[2], province=key[3], city=key[4],
+            manufacturer=manufacturer or '', quantity=qty, amount=amount, line_count=lines,
+        )
+        for key, (qty, amount, lines, manufacturer) in deltas.items() if key not in existing
+    ]
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            SalesCube.objects.bulk_create(missing)
+    except IntegrityError:
+        # 并发事务刚刚插入了其中的单元格：逐个改为累加
+        for cell in missing:
+            rows = SalesCube.objects.filter(
+                month=cell.month, medicine_id=cell.medicine_id, customer_type=cell.customer_type,
+                province=cell.province, city=cell.city,
+            )
+            changes = {
+                'quantity': F('quantity') + cell.quantity,
+                'amount': F('amount') + cell.amount,
+                'line_count': F('line_count') + cell.line_count,
+            }
+            if not rows.update(**changes):
+                cell.save()
+
+
+def _month_range(month):
+    """月份 -> 该月的 [起, 止) 时间"""
+    next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    start = timezone.make_aware(datetime.combine(month, time.min))
+    end = timezone.make_aware(datetime.combine(next_month, time.min))
+    return start, end
+
+
+def _rebuild_slice(month, **customer):
+    """
+    从明细重算一个月 (可再限定客户类型/省份/城市) 的立方体单元格，返回写入的行数。
+    customer 的键为 customer_type / province / city。
+    """
+    start, end = _month_range(month)
+    details = SalesDetail.objects.filter(
+        order__status='approved', order__order_date__gte=start, order__order_date__lt=end
+    )
+    lookups = {'customer_type': 'customer_type', 'province': 'customer_province', 'city': 'customer_city'}
+    details = details.filter(**{f'order__{lookups[k]}': v for k, v in customer.items()})
+    cells = _cells(details)
+    with transaction.atomic():
+        SalesCube.objects.filter(month=month, **customer).delete()
+        SalesCube.objects.bulk_create([
+            SalesCube(
+                month=key[0], medicine_id=key[1], customer_type=key[2], province=key[3], city=key[4],
+                manufacturer=manufacturer or '', quantity=qty, amount=amount, line_count=lines,
+            )
+            for key, (qty, amount, lines, manufacturer) in cells.items()
+        ], batch_size=1000)
+        transaction.on_commit(bump_report_version)
+    return len(cells)
+
+
+def refresh_orders(order_ids):
+    """已审核单据的明细被修改后，重算这些单据所在的切片"""
+    slices = set(
+        (timezone.localdate(when).replace(day=1), customer_type, province, city)
+        for when, customer_type, province, city in
+        SalesOrder.objects.filter(pk__in=list(order_ids), status='approved')
+        .values_list('order_date', 'customer_type', 'customer_province', 'customer_city')
+    )
+    for month, customer_type, province, city in slices:
+        _rebuild_slice(month, customer_type=customer_type, province=province, city=city)
+
+
+def months_between(start, end):
+    """[start, end] 之间每个月的 1 日"""
+    month = start.replace(day=1)
+    while month <= end:
+        yield month
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def rebuild_sales_cube(start=None, end=None, progress=None):
+    """
+    按月分块重建立方体 (默认覆盖全部已审核销售单的月份)，每个月一条分组查询 + 一个事务，
+    重建期间其他月份照常读写。progress(月份, 行数) 用于输出进度。返回 (月数, 总行数)。
+    """
+    bounds = SalesOrder.objects.filter(status='approved').aggregate(first=Min('order_date'), last=Max('order_date'))
+    if start is None:
+        if bounds['first'] is None:
+            return 0, 0
+        start = timezone.localdate(bounds['first'])
+    if end is None:
+        end = timezone.localdate(bounds['last']) if bounds['last'] else start
+    months = total = 0
+    for month in months_between(start, end):
+        count = _rebuild_slice(month)
+        months += 1
+        total += count
+        if progress:
+            progress(month, count)
+    return months, total
+
+
+def _parse_filter(dimension, value):
+    if dimension == 'month':
+        year, month = value.split('-')
+        return date(int(year), int(month), 1)
+    if dimension == 'medicine':
+        return int(value)
+    return value
+
+
+def cube_query(group_by, filters=None):
+    """
+    上卷 / 切片：按 group_by (DIMENSIONS 中的一个或多个维度) 分组，filters 为 {维度: 值} 的切片条件
+    (月份写作 'YYYY-MM'，药品为主键)。只查询立方体表，药品名称另用一条主键查询补上。
+    返回按金额降序的 [{维度: 键, 'label', 'quantity', 'amount', 'line_count'}]。
+    """
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    conditions = {}
+    for dimension, value in (filters or {}).items():
+        conditions[DIMENSIONS[dimension][0]] = _parse_filter(dimension, value)
+    fields = [DIMENSIONS[dimension][0] for dimension in group_by]
+    rows = list(
+        SalesCube.objects.filter(**conditions)
+        .values(*fields)
+        .annotate(quantity=Sum('quantity'), amount=Sum('amount'), line_count=Sum('line_count'))
+        .order_by('-amount', *fields)
+    )
+
+    names = {}
+    if 'medicine' in group_by:
+        names = dict(Medicine.objects.filter(pk__in={row['medicine_id'] for row in rows}).values_list('pk', 'common_name'))
+
+    result = []
+    for row in rows:
+        item = {'quantity': row['quantity'], 'amount': row['amount'], 'line_count': row['line_count']}
+        labels = []
+        for dimension in group_by:
+            value = row[DIMENSIONS[dimension][0]]
+            if dimension == 'month':
+                item[dimension] = f'{value:%Y-%m}'
+                labels.append(item[dimension])
+            elif dimension == 'medicine':
+                item[dimension] = str(value)
+                labels.append(names.get(value, value))
+            elif dimension == 'customer_type':
+                item[dimension] = value
+                labels.append(CUSTOMER_TYPE_LABELS.get(value, value))
+            else:
+                item[dimension] = value
+                labels.append(value)
+        item['label'] = ' / '.join(str(label) for label in labels)
+        result.append(item)
+    return result
+
+
+def filter_label(dimension, value):
+    """切片条件的显示名称 (药品显示名称，客户类型显示中文)"""
+    if dimension == 'medicine':
+        return Medicine.objects.filter(pk=value).values_list('common_name', flat=True).first() or value
+    if dimension == 'customer_type':
+        return CUSTOMER_TYPE_LABELS.get(value, value)
+    return value
+
+
+def next_dimension(dimension, filters):
+    """从 dimension 的某一行下钻时展开的维度；没有可继续展开的维度时返回 None"""
+    for candidate in DRILL_DOWN.get(dimension, []):
+        if candidate not in filters and candidate != dimension:
+            return candidate
+    return None
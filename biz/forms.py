@@ -2,7 +2,8 @@ from django import forms
 from django.forms import inlineformset_factory
 from .models import (
     PurchaseOrder, SalesOrder, PurchaseDetail, SalesDetail,
-    PurchaseReturnOrder, SalesReturnOrder, PurchaseReturnDetail, SalesReturnDetail
+    PurchaseReturnOrder, SalesReturnOrder, PurchaseReturnDetail, SalesReturnDetail,
+    Receipt
 )
 
 class PurchaseOrderForm(forms.ModelForm):
@@ -49,7 +50,8 @@ class PurchaseDetailForm(forms.ModelForm):
 class SalesDetailForm(forms.ModelForm):
     class Meta:
         model = SalesDetail
-        fields = ['inventory', 'quantity', 'actual_price']
+        # 可以只选药品，审核时按先到期先出自动分配批次
+        fields = ['medicine', 'inventory', 'quantity', 'actual_price']
 
 class PurchaseReturnDetailForm(forms.ModelForm):
     class Meta:
@@ -61,6 +63,14 @@ class SalesReturnDetailForm(forms.ModelForm):
         model = SalesReturnDetail
         fields = ['inventory', 'quantity', 'refund_price']
 
+class ReceiptForm(forms.ModelForm):
+    class Meta:
+        model = Receipt
+        fields = ['amount', 'received_at', 'method', 'note']
+        widgets = {
+            'received_at': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
+        }
+
 PurchaseDetailFormSet = inlineformset_factory(
     PurchaseOrder, PurchaseDetail, form=PurchaseDetailForm,
     extra=1, can_delete=True
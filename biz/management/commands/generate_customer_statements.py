@@ -0,0 +1,36 @@
+from datetime import date
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from biz.receivables import write_statements
+
+class Command(BaseCommand):
+    help = 'Write the monthly statements of all customers as one CSV, streaming rows as they are read'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Statement month (YYYY-MM), defaults to last month')
+        parser.add_argument('--output', help='Output file, defaults to stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database per round trip')
+
+    def handle(self, *args, **options):
+        if options['month']:
+            # parse_date 格式不对时返回 None，格式对但日期不存在 (如 2026-13) 时抛出 ValueError
+            try:
+                month = parse_date(f"{options['month']}-01")
+            except ValueError:
+                month = None
+            if month is None:
+                raise CommandError(f"Invalid month: {options['month']} (expected YYYY-MM)")
+        else:
+            today = timezone.localdate()
+            month = date(today.year - (today.month == 1), (today.month - 2) % 12 + 1, 1)
+
+        if options['output']:
+            # utf-8-sig：Excel 直接打开中文不乱码
+            with open(options['output'], 'w', encoding='utf-8-sig', newline='') as stream:
+                customers = write_statements(month, stream, options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Statements for {month:%Y-%m} written to {options['output']}: {customers} customers."
+            ))
+        else:
+            write_statements(month, self.stdout, options['chunk_size'])
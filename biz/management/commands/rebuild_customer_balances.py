@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from biz.credit import rebuild_outstanding
+
+class Command(BaseCommand):
+    help = 'Recompute every customer outstanding balance from approved sales orders and receipts'
+
+    def handle(self, *args, **options):
+        count = rebuild_outstanding()
+        self.stdout.write(self.style.SUCCESS(f"Outstanding balances rebuilt for {count} customers."))
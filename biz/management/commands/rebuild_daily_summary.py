@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from biz.reports import rebuild_daily_summary
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily purchase/sales summary used by the finance report from the approved orders'
+
+    def handle(self, *args, **options):
+        count = rebuild_daily_summary()
+        self.stdout.write(self.style.SUCCESS(f"Daily summary rebuilt: {count} rows."))
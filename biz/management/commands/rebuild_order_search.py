@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from biz.order_search import rebuild_order_search
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-order search documents used by the order list searches'
+
+    def handle(self, *args, **options):
+        total = rebuild_order_search(progress=lambda kind, count: self.stdout.write(f"{kind}: {count} orders"))
+        self.stdout.write(self.style.SUCCESS(f"Order search rebuilt: {total} documents."))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from biz.cube import rebuild_sales_cube
+
+class Command(BaseCommand):
+    help = 'Rebuild the sales cube from approved sales orders, one month per transaction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help='First month to rebuild (YYYY-MM), defaults to the earliest sale')
+        parser.add_argument('--to', dest='end', help='Last month to rebuild (YYYY-MM), defaults to the latest sale')
+
+    def _month(self, value):
+        if not value:
+            return None
+        # parse_date 格式不对时返回 None，格式对但日期不存在 (如 2026-13) 时抛出 ValueError
+        try:
+            month = parse_date(f'{value}-01')
+        except ValueError:
+            month = None
+        if month is None:
+            raise CommandError(f"Invalid month: {value} (expected YYYY-MM)")
+        return month
+
+    def handle(self, *args, **options):
+        start, end = self._month(options['start']), self._month(options['end'])
+        months, rows = rebuild_sales_cube(
+            start, end, progress=lambda month, count: self.stdout.write(f"{month:%Y-%m}: {count} rows")
+        )
+        self.stdout.write(self.style.SUCCESS(f"Sales cube rebuilt: {months} months, {rows} rows."))
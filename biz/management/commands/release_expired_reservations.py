@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from biz.reservations import release_expired
+
+class Command(BaseCommand):
+    help = 'Release stock reservations of pending sales orders that have passed STOCK_RESERVATION_TTL_MINUTES'
+
+    def handle(self, *args, **options):
+        count = release_expired()
+        self.stdout.write(self.style.SUCCESS(f"Released expired reservations on {count} inventory batches."))
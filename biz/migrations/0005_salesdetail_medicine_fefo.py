@@ -0,0 +1,36 @@
+# Generated by Django 6.0 on 2026-10-17 03:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_sales_medicine(apps, schema_editor):
+    """已有销售明细：从库存批次回填药品"""
+    SalesDetail = apps.get_model('biz', 'SalesDetail')
+    Inventory = apps.get_model('base', 'Inventory')
+    SalesDetail.objects.filter(medicine__isnull=True, inventory__isnull=False).update(
+        medicine_id=Subquery(Inventory.objects.filter(pk=OuterRef('inventory_id')).values('medicine_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_inventory_idx_inv_medicine_expiry'),
+        ('biz', '0004_purchaseorder_idx_purch_sup_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='salesdetail',
+            name='medicine',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='base.medicine', verbose_name='药品'),
+        ),
+        migrations.AlterField(
+            model_name='salesdetail',
+            name='inventory',
+            field=models.ForeignKey(blank=True, help_text='留空则审核时按先到期先出自动分配批次', null=True, on_delete=django.db.models.deletion.CASCADE, to='base.inventory', verbose_name='源库存'),
+        ),
+        migrations.RunPython(backfill_sales_medicine, migrations.RunPython.noop),
+    ]
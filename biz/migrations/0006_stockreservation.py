@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-17 03:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_inventory_reserved'),
+        ('biz', '0005_salesdetail_medicine_fefo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(verbose_name='预留数量')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='预留时间')),
+                ('expires_at', models.DateTimeField(verbose_name='过期时间')),
+                ('inventory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='base.inventory', verbose_name='库存批次')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='biz.salesorder', verbose_name='销售单')),
+            ],
+            options={
+                'verbose_name': '库存预留',
+                'verbose_name_plural': '库存预留',
+                'indexes': [models.Index(fields=['expires_at'], name='idx_reservation_expires')],
+            },
+        ),
+    ]
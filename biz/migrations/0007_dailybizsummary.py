@@ -0,0 +1,57 @@
+# Generated by Django 6.0 on 2026-10-17 04:02
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def build_daily_summary(apps, schema_editor):
+    """按已有的已审核单据生成每日汇总"""
+    DailyBizSummary = apps.get_model('biz', 'DailyBizSummary')
+    sources = [
+        ('PurchaseOrder', 'purchase', 'order_date'),
+        ('SalesOrder', 'sales', 'order_date'),
+        ('SalesReturnOrder', 'sales_return', 'return_date'),
+        ('PurchaseReturnOrder', 'purchase_return', 'return_date'),
+    ]
+    rows = []
+    for model_name, doc_type, date_field in sources:
+        order_model = apps.get_model('biz', model_name)
+        for row in (
+            order_model.objects.filter(status='approved')
+            .annotate(day=TruncDate(date_field))
+            .values('day')
+            .annotate(order_count=Count('id'), amount=Sum('total_amount'))
+            .order_by()
+        ):
+            rows.append(DailyBizSummary(
+                day=row['day'], doc_type=doc_type,
+                order_count=row['order_count'], amount=row['amount'] or 0,
+            ))
+    DailyBizSummary.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biz', '0006_stockreservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyBizSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='日期')),
+                ('doc_type', models.CharField(choices=[('purchase', '采购'), ('sales', '销售'), ('sales_return', '销售退货'), ('purchase_return', '采购退货')], max_length=20, verbose_name='单据类型')),
+                ('order_count', models.IntegerField(default=0, verbose_name='单据笔数')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='金额')),
+            ],
+            options={
+                'verbose_name': '每日业务汇总',
+                'verbose_name_plural': '每日业务汇总',
+                'unique_together': {('day', 'doc_type')},
+            },
+        ),
+        migrations.RunPython(build_daily_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-17 04:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_inventory_expiry_in_stock_index'),
+        ('biz', '0007_dailybizsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesCube',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='当月 1 日', verbose_name='月份')),
+                ('manufacturer', models.CharField(max_length=100, verbose_name='生产厂家')),
+                ('customer_type', models.CharField(max_length=20, verbose_name='客户类型')),
+                ('province', models.CharField(max_length=50, verbose_name='省份')),
+                ('city', models.CharField(max_length=50, verbose_name='城市')),
+                ('quantity', models.IntegerField(default=0, verbose_name='销售数量')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='销售金额')),
+                ('line_count', models.IntegerField(default=0, verbose_name='明细行数')),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.medicine', verbose_name='药品')),
+            ],
+            options={
+                'verbose_name': '销售多维汇总',
+                'verbose_name_plural': '销售多维汇总',
+                'unique_together': {('month', 'medicine', 'customer_type', 'province', 'city')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 6.0 on 2026-10-17 04:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biz', '0008_salescube'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Receipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='收款金额')),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='收款日期')),
+                ('method', models.CharField(choices=[('transfer', '银行转账'), ('cash', '现金'), ('other', '其他')], default='transfer', max_length=20, verbose_name='收款方式')),
+                ('note', models.CharField(blank=True, max_length=200, verbose_name='备注')),
+                ('employee', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='经办人')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipts', to='biz.salesorder', verbose_name='销售单')),
+            ],
+            options={
+                'verbose_name': '销售收款',
+                'verbose_name_plural': '销售收款',
+                'ordering': ['-received_at'],
+                'indexes': [models.Index(fields=['received_at'], name='idx_receipt_date')],
+                'constraints': [models.CheckConstraint(condition=models.Q(('amount__gt', 0)), name='check_receipt_amount_positive')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 6.0 on 2026-10-17 04:20
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def build_outstanding(apps, schema_editor):
+    """按已有的已审核销售单和收款计算客户未收余额"""
+    Customer = apps.get_model('base', 'Customer')
+    SalesOrder = apps.get_model('biz', 'SalesOrder')
+    Receipt = apps.get_model('biz', 'Receipt')
+    sales = (
+        SalesOrder.objects.filter(customer=OuterRef('pk'), status='approved')
+        .values('customer').annotate(total=Sum('total_amount')).values('total')
+    )
+    receipts = (
+        Receipt.objects.filter(order__customer=OuterRef('pk'))
+        .values('order__customer').annotate(total=Sum('amount')).values('total')
+    )
+    field = Customer._meta.get_field('outstanding_balance')
+    Customer.objects.update(
+        outstanding_balance=Coalesce(Subquery(sales), Value(0), output_field=field)
+        - Coalesce(Subquery(receipts), Value(0), output_field=field)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_customer_credit_limit'),
+        ('biz', '0009_receipt'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_outstanding, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0 on 2026-10-17 04:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0009_customer_credit_limit'),
+        ('biz', '0010_backfill_customer_outstanding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SupplierMonthlyMetrics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='当月 1 日', verbose_name='月份')),
+                ('purchase_orders', models.IntegerField(default=0, verbose_name='进货单数')),
+                ('purchase_quantity', models.IntegerField(default=0, verbose_name='进货数量')),
+                ('purchase_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='进货金额')),
+                ('list_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='标准进价金额')),
+                ('shelf_life_days', models.BigIntegerField(default=0, verbose_name='效期天数合计')),
+                ('return_orders', models.IntegerField(default=0, verbose_name='退货单数')),
+                ('return_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='退货金额')),
+                ('supplier', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_metrics', to='base.supplier', verbose_name='供应商')),
+            ],
+            options={
+                'verbose_name': '供应商月度指标',
+                'verbose_name_plural': '供应商月度指标',
+                'unique_together': {('supplier', 'month')},
+            },
+        ),
+    ]
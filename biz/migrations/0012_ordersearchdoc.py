@@ -0,0 +1,107 @@
+# Generated by Django 6.0 on 2026-10-17 04:52
+
+from django.db import migrations, models
+
+# 单据检索文档的 FTS5 全文索引 (trigram 分词) 及同步触发器，说明见 biz/order_search.py。
+# 语句原样写在这里，不引用运行时代码；只在 SQLite 且支持 FTS5 trigram 分词时执行。
+
+CREATE_SQL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS biz_ordersearchdoc_fts USING fts5(
+        document, content='biz_ordersearchdoc', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS biz_ordersearchdoc_fts_ai
+    AFTER INSERT ON biz_ordersearchdoc BEGIN
+        INSERT INTO biz_ordersearchdoc_fts(rowid, document) VALUES (new.id, new.document);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS biz_ordersearchdoc_fts_ad
+    AFTER DELETE ON biz_ordersearchdoc BEGIN
+        INSERT INTO biz_ordersearchdoc_fts(biz_ordersearchdoc_fts, rowid, document) VALUES ('delete', old.id, old.document);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS biz_ordersearchdoc_fts_au
+    AFTER UPDATE OF document ON biz_ordersearchdoc BEGIN
+        INSERT INTO biz_ordersearchdoc_fts(biz_ordersearchdoc_fts, rowid, document) VALUES ('delete', old.id, old.document);
+        INSERT INTO biz_ordersearchdoc_fts(rowid, document) VALUES (new.id, new.document);
+    END""",
+    "INSERT INTO biz_ordersearchdoc_fts(biz_ordersearchdoc_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS biz_ordersearchdoc_fts_ai',
+    'DROP TRIGGER IF EXISTS biz_ordersearchdoc_fts_ad',
+    'DROP TRIGGER IF EXISTS biz_ordersearchdoc_fts_au',
+    'DROP TABLE IF EXISTS biz_ordersearchdoc_fts',
+]
+
+
+def build_order_search(apps, schema_editor):
+    """为已有单据生成检索文档"""
+    OrderSearchDoc = apps.get_model('biz', 'OrderSearchDoc')
+    sources = [
+        ('PurchaseOrder', 'PurchaseDetail', 'purchase', 'PO', 'supplier', 'medicine__common_name'),
+        ('SalesOrder', 'SalesDetail', 'sales', 'SO', 'customer', 'medicine__common_name'),
+        ('SalesReturnOrder', 'SalesReturnDetail', 'sales_return', 'SR', 'customer', 'inventory__medicine__common_name'),
+        ('PurchaseReturnOrder', 'PurchaseReturnDetail', 'purchase_return', 'PR', 'supplier', 'inventory__medicine__common_name'),
+    ]
+    for order_name, detail_name, kind, prefix, party, medicine_name in sources:
+        documents = {
+            pk: [f'{prefix}-{pk}', name or '']
+            for pk, name in apps.get_model('biz', order_name).objects.values_list('pk', f'{party}__name')
+        }
+        for order_id, name in (
+            apps.get_model('biz', detail_name).objects.values_list('order_id', medicine_name).order_by().distinct()
+        ):
+            if name:
+                documents[order_id].append(name)
+        OrderSearchDoc.objects.bulk_create([
+            OrderSearchDoc(kind=kind, order_id=pk, document=' '.join(parts)) for pk, parts in documents.items()
+        ], batch_size=1000)
+
+
+class FTS5RunSQL(migrations.RunSQL):
+    """只在 SQLite 且支持 FTS5 trigram 分词时执行的 RunSQL"""
+
+    @staticmethod
+    def supported(connection):
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(probe, tokenize='trigram')")
+            except Exception:
+                return False
+            cursor.execute('DROP TABLE temp.fts5_probe')
+        return True
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self.supported(schema_editor.connection):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'sqlite':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biz', '0011_suppliermonthlymetrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderSearchDoc',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('purchase', '进货单'), ('sales', '销售单'), ('sales_return', '销售退货单'), ('purchase_return', '采购退货单')], max_length=20, verbose_name='单据类型')),
+                ('order_id', models.BigIntegerField(verbose_name='单据ID')),
+                ('document', models.TextField(verbose_name='检索文本')),
+            ],
+            options={
+                'verbose_name': '单据检索文档',
+                'verbose_name_plural': '单据检索文档',
+                'unique_together': {('kind', 'order_id')},
+            },
+        ),
+        migrations.RunPython(build_order_search, migrations.RunPython.noop),
+        FTS5RunSQL(CREATE_SQL, DROP_SQL),
+    ]
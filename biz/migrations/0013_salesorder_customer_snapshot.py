@@ -0,0 +1,42 @@
+# Generated by Django 6.0 on 2026-10-17 05:05
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def snapshot_customers(apps, schema_editor):
+    """已审核的销售单按客户当前资料补记 (与之前立方体的归类一致)"""
+    SalesOrder = apps.get_model('biz', 'SalesOrder')
+    Customer = apps.get_model('base', 'Customer')
+    customer = Customer.objects.filter(pk=OuterRef('customer_id'))
+    SalesOrder.objects.filter(status='approved').update(
+        customer_type=Subquery(customer.values('type')[:1]),
+        customer_province=Subquery(customer.values('province')[:1]),
+        customer_city=Subquery(customer.values('city')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biz', '0012_ordersearchdoc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='salesorder',
+            name='customer_city',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='城市(审核时)'),
+        ),
+        migrations.AddField(
+            model_name='salesorder',
+            name='customer_province',
+            field=models.CharField(blank=True, default='', editable=False, max_length=50, verbose_name='省份(审核时)'),
+        ),
+        migrations.AddField(
+            model_name='salesorder',
+            name='customer_type',
+            field=models.CharField(blank=True, default='', editable=False, max_length=20, verbose_name='客户类型(审核时)'),
+        ),
+        migrations.RunPython(snapshot_customers, migrations.RunPython.noop),
+    ]
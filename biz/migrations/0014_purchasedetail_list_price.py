@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-17 05:07
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def stamp_list_prices(apps, schema_editor):
+    """已审核进货单的明细按当前指导进价补记 (与之前指标表的累计一致)"""
+    PurchaseDetail = apps.get_model('biz', 'PurchaseDetail')
+    Medicine = apps.get_model('base', 'Medicine')
+    buy_price = Medicine.objects.filter(pk=OuterRef('medicine_id')).values('buy_price')[:1]
+    PurchaseDetail.objects.filter(order__status='approved').update(list_price=Subquery(buy_price))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biz', '0013_salesorder_customer_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchasedetail',
+            name='list_price',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=10, null=True, verbose_name='标准进价(审核时)'),
+        ),
+        migrations.RunPython(stamp_list_prices, migrations.RunPython.noop),
+    ]
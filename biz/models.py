@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils import timezone
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db.models import CheckConstraint, Q, F
 
 # 状态常量
@@ -10,12 +11,51 @@ STATUS_CHOICES = [
     ('cancelled', '已作废'),
 ]
 
+class StatusTrackedModel(models.Model):
+    """
+    单据状态跟踪 (抽象基类)：记住从数据库加载时的 status 和往来单位 (party_field)，
+    保存时的状态变更检测、检索文档维护 (biz/signals.py) 因此不必再查一次数据库。
+    """
+    # 往来单位外键 (供应商 / 客户)，由子类指定
+    party_field = None
+
+    # 新建对象或字段未加载 (如 .only()) 时为 None
+    _loaded_status = None
+    _loaded_party_id = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        instance._loaded_party_id = instance.__dict__.get(f'{cls.party_field}_id')
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None or 'status' in fields:
+            self._loaded_status = self.__dict__.get('status')
+        if fields is None or self.party_field in fields:
+            self._loaded_party_id = self.__dict__.get(f'{self.party_field}_id')
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'status' in update_fields:
+            self._loaded_status = self.status
+        if update_fields is None or self.party_field in update_fields:
+            self._loaded_party_id = getattr(self, f'{self.party_field}_id')
+
 # ==========================================
 # 1. 进货业务 (Purchase)
 # ==========================================
 
-class PurchaseOrder(models.Model):
+class PurchaseOrder(StatusTrackedModel):
     """进货单头"""
+    party_field = 'supplier'
+
     supplier = models.ForeignKey('base.Supplier', on_delete=models.CASCADE, verbose_name="供应商")
     employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, verbose_name="经办人")
     
@@ -53,6 +93,8 @@ class PurchaseDetail(models.Model):
     quantity = models.PositiveIntegerField("数量", default=0)
     unit_price = models.DecimalField("实际进价", max_digits=10, decimal_places=2, default=0)
     total_amount = models.DecimalField("小计", max_digits=12, decimal_places=2, editable=False, default=0)
+    # 审核时药品的指导进价 (供应商月度指标的标准进价，biz/scorecard.py 记录)
+    list_price = models.DecimalField("标准进价(审核时)", max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = "进货明细"
@@ -84,8 +126,10 @@ class PurchaseDetail(models.Model):
 # 2. 销售业务 (Sales)
 # ==========================================
 
-class SalesOrder(models.Model):
+class SalesOrder(StatusTrackedModel):
     """销售单头"""
+    party_field = 'customer'
+
     customer = models.ForeignKey('base.Customer', on_delete=models.CASCADE, verbose_name="客户")
     employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, verbose_name="销售员")
     
@@ -93,6 +137,11 @@ class SalesOrder(models.Model):
     total_amount = models.DecimalField("总金额", max_digits=12, decimal_places=2, default=0)
     status = models.CharField("状态", max_length=20, choices=STATUS_CHOICES, default='pending')
 
+    # 审核时客户的类型和地址 (biz/signals.py 记录)，销售多维汇总按它归类，之后修改客户资料不影响已审核单据
+    customer_type = models.CharField("客户类型(审核时)", max_length=20, blank=True, default='', editable=False)
+    customer_province = models.CharField("省份(审核时)", max_length=50, blank=True, default='', editable=False)
+    customer_city = models.CharField("城市(审核时)", max_length=50, blank=True, default='', editable=False)
+
     class Meta:
         verbose_name = "销售单"
         verbose_name_plural = verbose_name
@@ -112,7 +161,10 @@ class SalesDetail(models.Model):
     order = models.ForeignKey(SalesOrder, on_delete=models.CASCADE, related_name='details', verbose_name="关联单据")
     
     # 核心：销售连 Inventory (有的放矢)
-    inventory = models.ForeignKey('base.Inventory', on_delete=models.CASCADE, verbose_name="源库存")
+    # 也可以只指定药品，审核时按 "先到期先出" (FEFO) 自动分配批次并拆分明细
+    inventory = models.ForeignKey('base.Inventory', on_delete=models.CASCADE, null=True, blank=True, verbose_name="源库存",
+                                  help_text="留空则审核时按先到期先出自动分配批次")
+    medicine = models.ForeignKey('base.Medicine', on_delete=models.CASCADE, null=True, blank=True, verbose_name="药品")
     
     # 冗余存储批号，防止 Inventory 记录被物理删除后查不到历史
     batch_number_snapshot = models.CharField("批号快照", max_length=50, blank=True)
@@ -125,6 +177,12 @@ class SalesDetail(models.Model):
         verbose_name = "销售明细"
         verbose_name_plural = verbose_name
 
+    def clean(self):
+        if not self.inventory_id and not self.medicine_id:
+            raise ValidationError("请选择药品或具体库存批次")
+        if self.inventory_id and self.medicine_id and self.inventory.medicine_id != self.medicine_id:
+            raise ValidationError({'inventory': "所选批次不属于该药品"})
+
     def save(self, *args, **kwargs):
         # 修正：增加空值判断
         qty = self.quantity or 0
@@ -139,18 +197,47 @@ class SalesDetail(models.Model):
                 self.batch_number_snapshot = self.inventory.batch_number
             except:
                 pass
+
+        # 冗余药品，按药品统计/分配时不必经过库存表
+        if self.inventory_id and not self.medicine_id:
+            self.medicine_id = self.inventory.medicine_id
         
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"Out: {self.inventory.medicine} * {self.quantity}"
+        medicine = self.inventory.medicine if self.inventory_id else self.medicine
+        return f"Out: {medicine} * {self.quantity}"
+
+class StockReservation(models.Model):
+    """
+    库存预留：待审核销售单保存时占用批次库存，审核时转为实际扣减，作废/过期时释放。
+    每个批次的预留合计冗余在 Inventory.reserved 中，查询可用库存无需汇总本表。
+    """
+    order = models.ForeignKey(SalesOrder, on_delete=models.CASCADE, related_name='reservations', verbose_name="销售单")
+    inventory = models.ForeignKey('base.Inventory', on_delete=models.CASCADE, related_name='reservations', verbose_name="库存批次")
+    quantity = models.PositiveIntegerField("预留数量")
+    created_at = models.DateTimeField("预留时间", default=timezone.now)
+    expires_at = models.DateTimeField("过期时间")
+
+    class Meta:
+        verbose_name = "库存预留"
+        verbose_name_plural = verbose_name
+        indexes = [
+            # 定期释放过期预留
+            models.Index(fields=['expires_at'], name='idx_reservation_expires'),
+        ]
+
+    def __str__(self):
+        return f"SO-{self.order_id} 预留 {self.inventory_id} * {self.quantity}"
 
 # ==========================================
 # 3. 销售退货业务 (Sales Return)
 # ==========================================
 
-class SalesReturnOrder(models.Model):
+class SalesReturnOrder(StatusTrackedModel):
     """销售退货单 (顾客退给药店)"""
+    party_field = 'customer'
+
     customer = models.ForeignKey('base.Customer', on_delete=models.CASCADE, verbose_name="退货客户")
     employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, verbose_name="经办人")
     
@@ -200,8 +287,10 @@ class SalesReturnDetail(models.Model):
 # 4. 采购退货业务 (Purchase Return)
 # ==========================================
 
-class PurchaseReturnOrder(models.Model):
+class PurchaseReturnOrder(StatusTrackedModel):
     """采购退货单 (药店退给供应商)"""
+    party_field = 'supplier'
+
     supplier = models.ForeignKey('base.Supplier', on_delete=models.CASCADE, verbose_name="供应商")
     employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, verbose_name="经办人")
     
@@ -245,4 +334,150 @@ class PurchaseReturnDetail(models.Model):
         super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"Deduct: {self.inventory.medicine} * {self.quantity}"
\ No newline at end of file
+        return f"Deduct: {self.inventory.medicine} * {self.quantity}"
+
+# ==========================================
+# 5. 报表汇总 (Rollup)
+# ==========================================
+
+class DailyBizSummary(models.Model):
+    """
+    每日业务汇总：按 (日期, 单据类型) 累计已审核单据的笔数和金额。
+    由 biz/reports.py 在审核 (及撤销审核、修改已审核单据) 的同一事务中增量维护，
+    财务报表只读本表，查询成本与历史订单数量无关。
+    """
+    DOC_TYPE_CHOICES = [
+        ('purchase', '采购'),
+        ('sales', '销售'),
+        ('sales_return', '销售退货'),
+        ('purchase_return', '采购退货'),
+    ]
+    day = models.DateField("日期")
+    doc_type = models.CharField("单据类型", max_length=20, choices=DOC_TYPE_CHOICES)
+    order_count = models.IntegerField("单据笔数", default=0)
+    amount = models.DecimalField("金额", max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('day', 'doc_type')
+        verbose_name = "每日业务汇总"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f"{self.day} {self.get_doc_type_display()}: {self.order_count} 笔 / ¥{self.amount}"
+
+
+class SalesCube(models.Model):
+    """
+    销售多维汇总 (立方体)：按 (月份, 药品, 客户类型, 省份, 城市) 累计已审核销售明细的数量和金额，
+    生产厂家随药品冗余存储。由 biz/cube.py 在审核的同一事务中增量维护，可按月分块重建；
+    任意维度的上卷 / 切片只查询本表，不再关联销售明细、库存、药品和客户。
+    """
+    month = models.DateField("月份", help_text="当月 1 日")
+    medicine = models.ForeignKey('base.Medicine', on_delete=models.CASCADE, verbose_name="药品")
+    manufacturer = models.CharField("生产厂家", max_length=100)
+    customer_type = models.CharField("客户类型", max_length=20)
+    province = models.CharField("省份", max_length=50)
+    city = models.CharField("城市", max_length=50)
+    quantity = models.IntegerField("销售数量", default=0)
+    amount = models.DecimalField("销售金额", max_digits=14, decimal_places=2, default=0)
+    line_count = models.IntegerField("明细行数", default=0)
+
+    class Meta:
+        unique_together = ('month', 'medicine', 'customer_type', 'province', 'city')
+        verbose_name = "销售多维汇总"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.medicine_id} {self.province}{self.city}: ¥{self.amount}"
+
+
+class Receipt(models.Model):
+    """销售收款：客户针对已审核销售单的付款，一张销售单可以分多次收款"""
+    METHOD_CHOICES = [
+        ('transfer', '银行转账'),
+        ('cash', '现金'),
+        ('other', '其他'),
+    ]
+    order = models.ForeignKey(SalesOrder, on_delete=models.CASCADE, related_name='receipts', verbose_name="销售单")
+    amount = models.DecimalField("收款金额", max_digits=12, decimal_places=2)
+    received_at = models.DateTimeField("收款日期", default=timezone.now)
+    method = models.CharField("收款方式", max_length=20, choices=METHOD_CHOICES, default='transfer')
+    employee = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="经办人")
+    note = models.CharField("备注", max_length=200, blank=True)
+
+    class Meta:
+        verbose_name = "销售收款"
+        verbose_name_plural = verbose_name
+        ordering = ['-received_at']
+        indexes = [
+            # 对账单按月份取收款
+            models.Index(fields=['received_at'], name='idx_receipt_date'),
+        ]
+        constraints = [
+            CheckConstraint(condition=Q(amount__gt=0), name='check_receipt_amount_positive'),
+        ]
+
+    def clean(self):
+        if self.amount is not None and self.amount <= 0:
+            raise ValidationError({'amount': "收款金额必须大于 0"})
+        if self.order_id and self.order.status != 'approved':
+            raise ValidationError({'order': "只能对已审核的销售单收款"})
+
+    def __str__(self):
+        return f"SO-{self.order_id} 收款 ¥{self.amount}"
+
+
+class SupplierMonthlyMetrics(models.Model):
+    """
+    供应商月度指标：按 (供应商, 月份) 累计已审核进货单和采购退货单。
+    由 biz/scorecard.py 在审核 (及撤销审核、修改已审核单据) 的同一事务中增量维护，
+    供应商评分页只读本表。比率类指标 (退货率、价格偏差、平均效期) 由累计值在查询时相除得到。
+    """
+    supplier = models.ForeignKey('base.Supplier', on_delete=models.CASCADE, related_name='monthly_metrics', verbose_name="供应商")
+    month = models.DateField("月份", help_text="当月 1 日")
+    purchase_orders = models.IntegerField("进货单数", default=0)
+    purchase_quantity = models.IntegerField("进货数量", default=0)
+    purchase_amount = models.DecimalField("进货金额", max_digits=14, decimal_places=2, default=0)
+    # 同样数量按药品标准进价 (Medicine.buy_price，审核时的值) 计算的金额，价格偏差 = 进货金额 / 标准金额 - 1
+    list_amount = models.DecimalField("标准进价金额", max_digits=14, decimal_places=2, default=0)
+    # 各批次 (有效期 - 生产日期) 天数 * 数量之和，平均效期 = 本字段 / 进货数量
+    shelf_life_days = models.BigIntegerField("效期天数合计", default=0)
+    return_orders = models.IntegerField("退货单数", default=0)
+    return_amount = models.DecimalField("退货金额", max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('supplier', 'month')
+        verbose_name = "供应商月度指标"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return f"{self.supplier_id} {self.month:%Y-%m}: ¥{self.purchase_amount}"
+
+
+# ==========================================
+# 6. 单据检索 (Search)
+# ==========================================
+
+class OrderSearchDoc(models.Model):
+    """
+    单据检索文档：每张单据一行，冗余存放单号 (如 SO-12)、往来单位名称和明细中的药品名称。
+    由 biz/order_search.py 在单据或明细变化时维护，单据列表的搜索只查本表 (SQLite 下另有 FTS5 索引)，
+    不再把单据、明细、药品连起来再 DISTINCT。
+    """
+    KIND_CHOICES = (
+        ('purchase', '进货单'),
+        ('sales', '销售单'),
+        ('sales_return', '销售退货单'),
+        ('purchase_return', '采购退货单'),
+    )
+    kind = models.CharField("单据类型", max_length=20, choices=KIND_CHOICES)
+    order_id = models.BigIntegerField("单据ID")
+    document = models.TextField("检索文本")
+
+    class Meta:
+        unique_together = ('kind', 'order_id')
+        verbose_name = "单据检索文档"
+        verbose_name_plural = verbose_name
+
+    def __str__(self):
+        return self.document[:50]
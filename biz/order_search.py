@@ -0,0 +1,175 @@
+import re
+from django.db import transaction
+from django.db.models import F
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from base.search import fts_available, match_expression
+from .models import (
+    PurchaseOrder, SalesOrder, SalesReturnOrder, PurchaseReturnOrder, OrderSearchDoc
+)
+
+# ==========================================
+# 单据检索文档
+# ==========================================
+# 每张单据在 OrderSearchDoc 中有一行检索文本：单号 (如 SO-12)、往来单位名称、明细中的药品名称。
+#   - 新建单据、修改往来单位、明细增删改时 (biz/signals.py)，重写该单据的文档 (refresh_documents)
+#   - 供应商/客户/药品改名时，重写涉及的单据 (refresh_for_party / refresh_for_medicine)
+#   - rebuild_order_search() 全量重建 (管理命令 rebuild_order_search)
+# 单据列表的搜索只查文档表：SQLite 下走 FTS5 trigram 索引 biz_ordersearchdoc_fts
+# (由文档表上的触发器同步，建表和补建触发器见 base/search.py)，否则对文档表 icontains。
+# 输入的是已存在的单号 (SO-12 / so12 / 12) 时直接按主键取这一张单据。
+
+ORDER_FTS = 'biz_ordersearchdoc_fts'
+
+# 单据模型 -> (文档类型, 单号前缀, 药品名称在明细上的路径)
+KINDS = {
+    PurchaseOrder: ('purchase', 'PO', ['medicine__common_name']),
+    SalesOrder: ('sales', 'SO', ['medicine__common_name', 'inventory__medicine__common_name']),
+    SalesReturnOrder: ('sales_return', 'SR', ['inventory__medicine__common_name']),
+    PurchaseReturnOrder: ('purchase_return', 'PR', ['inventory__medicine__common_name']),
+}
+
+# 每次重写的单据数
+CHUNK_SIZE = 500
+
+
+def build_documents(order_model, order_ids):
+    """单据当前的检索文本 {pk: 文本} (两条查询；已删除的单据不在结果中)"""
+    kind, prefix, name_paths = KINDS[order_model]
+    party = order_model.party_field
+    documents = {}
+    for pk, party_name in order_model.objects.filter(pk__in=order_ids).values_list('pk', f'{party}__name'):
+        documents[pk] = [f'{prefix}-{pk}', party_name or '']
+
+    detail_model = order_model.details.rel.related_model
+    name = Coalesce(*name_paths) if len(name_paths) > 1 else F(name_paths[0])
+    seen = set()
+    for order_id, medicine_name in (
+        detail_model.objects.filter(order_id__in=list(documents))
+        .annotate(search_name=name).values_list('order_id', 'search_name').order_by('order_id', 'pk')
+    ):
+        if medicine_name and (order_id, medicine_name) not in seen:
+            seen.add((order_id, medicine_name))
+            documents[order_id].append(medicine_name)
+    return {pk: ' '.join(parts) for pk, parts in documents.items()}
+
+
+def refresh_documents(order_model, order_ids):
+    """重写这些单据的检索文档 (不存在的单据删除其文档)"""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    kind = KINDS[order_model][0]
+    documents = build_documents(order_model, order_ids)
+    with transaction.atomic():
+        OrderSearchDoc.objects.filter(kind=kind, order_id__in=order_ids).delete()
+        OrderSearchDoc.objects.bulk_create([
+            OrderSearchDoc(kind=kind, order_id=pk, document=text) for pk, text in documents.items()
+        ])
+
+
+def remove_documents(order_model, order_ids):
+    OrderSearchDoc.objects.filter(kind=KINDS[order_model][0], order_id__in=list(order_ids)).delete()
+
+
+def _refresh_in_chunks(order_model, order_ids):
+    order_ids = list(order_ids)
+    for start in range(0, len(order_ids), CHUNK_SIZE):
+        refresh_documents(order_model, order_ids[start:start + CHUNK_SIZE])
+
+
+def refresh_for_party(party_model, party_id):
+    """供应商/客户改名后，重写其单据的文档"""
+    for order_model in KINDS:
+        party = order_model._meta.get_field(order_model.party_field)
+        if party.related_model is party_model:
+            _refresh_in_chunks(order_model, order_model.objects.filter(**{party.attname: party_id}).values_list('pk', flat=True))
+
+
+def refresh_for_medicine(medicine_id):
+    """药品改名后，重写明细中有这个药品的单据的文档"""
+    for order_model, (kind, prefix, name_paths) in KINDS.items():
+        detail_model = order_model.details.rel.related_model
+        order_ids = set()
+        for path in name_paths:
+            medicine_path = path[:-len('__common_name')]
+            order_ids.update(detail_model.objects.filter(**{medicine_path: medicine_id}).values_list('order_id', flat=True))
+        _refresh_in_chunks(order_model, sorted(order_ids))
+
+
+def rebuild_order_search(progress=None):
+    """
+    按主键分块重建全部单据的检索文档 (每块一个事务)，progress(类型, 该类型已处理单数) 用于输出进度。
+    返回文档总数。
+    """
+    total = 0
+    for order_model, (kind, prefix, name_paths) in KINDS.items():
+        OrderSearchDoc.objects.filter(kind=kind).delete()
+        last_pk = done = 0
+        while True:
+            order_ids = list(
+                order_model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:CHUNK_SIZE]
+            )
+            if not order_ids:
+                break
+            refresh_documents(order_model, order_ids)
+            done += len(order_ids)
+            last_pk = order_ids[-1]
+            if progress:
+                progress(kind, done)
+        total += done
+    return total
+
+
+def parse_order_number(query, prefix):
+    """'SO-12' / 'so12' / '12' -> 12 (前缀须与单据类型一致)，不是单号时返回 None"""
+    match = re.fullmatch(rf'(?:{prefix}-?)?(\d{{1,18}})', query.strip(), re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+def search_orders(order_model, queryset, query):
+    """
+    在 queryset 中按单号、往来单位名称、药品名称检索单据。
+    已存在的单号直接返回按主键过滤的 queryset，否则按检索文档过滤 (单据表上只剩一个 pk IN 子查询)。
+    """
+    kind, prefix, name_paths = KINDS[order_model]
+    number = parse_order_number(query, prefix)
+    if number is not None and queryset.filter(pk=number).exists():
+        return queryset.filter(pk=number)
+
+    documents = OrderSearchDoc.objects.filter(kind=kind)
+    expression = match_expression(query) if fts_available(ORDER_FTS) else None
+    if expression is not None:
+        documents = documents.filter(pk__in=RawSQL(f'SELECT rowid FROM {ORDER_FTS} WHERE {ORDER_FTS} MATCH %s', [expression]))
+    else:
+        documents = documents.filter(document__icontains=query.strip())
+    return queryset.filter(pk__in=documents.values('order_id'))
+
+
+# ==========================================
+# FTS 表与触发器 (迁移 0012 建立；post_migrate 时由 base.search.install_search_index 补建丢失的触发器)
+# ==========================================
+
+TABLE_SQL = {
+    ORDER_FTS: """CREATE VIRTUAL TABLE IF NOT EXISTS biz_ordersearchdoc_fts USING fts5(
+        document, content='biz_ordersearchdoc', content_rowid='id', tokenize='trigram'
+    )""",
+}
+
+TRIGGER_SQL = {
+    ORDER_FTS: {
+        'biz_ordersearchdoc_fts_ai': """CREATE TRIGGER IF NOT EXISTS biz_ordersearchdoc_fts_ai
+        AFTER INSERT ON biz_ordersearchdoc BEGIN
+            INSERT INTO biz_ordersearchdoc_fts(rowid, document) VALUES (new.id, new.document);
+        END""",
+        'biz_ordersearchdoc_fts_ad': """CREATE TRIGGER IF NOT EXISTS biz_ordersearchdoc_fts_ad
+        AFTER DELETE ON biz_ordersearchdoc BEGIN
+            INSERT INTO biz_ordersearchdoc_fts(biz_ordersearchdoc_fts, rowid, document) VALUES ('delete', old.id, old.document);
+        END""",
+        'biz_ordersearchdoc_fts_au': """CREATE TRIGGER IF NOT EXISTS biz_ordersearchdoc_fts_au
+        AFTER UPDATE OF document ON biz_ordersearchdoc BEGIN
+            INSERT INTO biz_ordersearchdoc_fts(biz_ordersearchdoc_fts, rowid, document) VALUES ('delete', old.id, old.document);
+            INSERT INTO biz_ordersearchdoc_fts(rowid, document) VALUES (new.id, new.document);
+        END""",
+    },
+}
@@ -0,0 +1,91 @@
+import base64
+import binascii
+from datetime import datetime
+from django.db.models import Q, prefetch_related_objects
+
+# ==========================================
+# 单据列表的游标分页 (keyset pagination)
+# ==========================================
+# 单据列表按 (日期, id) 倒序排列，翻页不用 OFFSET，而是带上当前页首/尾一行的 (日期, id) 作为游标：
+#     下一页: WHERE 日期 < d OR (日期 = d AND id < i) ORDER BY 日期 DESC, id DESC LIMIT n + 1
+#     上一页: WHERE 日期 > d OR (日期 = d AND id > i) ORDER BY 日期 ASC, id ASC LIMIT n + 1 (取回后倒序)
+# 条件和排序都沿日期索引 (索引项自带主键) 定位，无论翻到多深，每页的代价都相同；
+# 翻页期间新增或删除单据也不会让行重复或漏掉。多取的一行用来判断是否还有下一页/上一页。
+# 明细只对当前页的单据预取 (prefetch_related_objects)，不随历史数据增长。
+
+PAGE_SIZE = 20
+
+
+def encode_cursor(when, pk):
+    """(日期, id) -> URL 安全的游标字符串"""
+    raw = f'{when.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """游标字符串 -> (日期, id)；无法解析时返回 None (按第一页处理)"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        when, pk = raw.split('|')
+        return datetime.fromisoformat(when), int(pk)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+class KeysetPage:
+    """一页单据及前后翻页的游标"""
+
+    def __init__(self, items, date_field, has_next, has_previous):
+        self.items = items
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = self.previous_cursor = ''
+        if items:
+            first, last = items[0], items[-1]
+            if has_next:
+                self.next_cursor = encode_cursor(getattr(last, date_field), last.pk)
+            if has_previous:
+                self.previous_cursor = encode_cursor(getattr(first, date_field), first.pk)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+
+def keyset_page(queryset, date_field, after=None, before=None, prefetch=(), per_page=PAGE_SIZE):
+    """
+    按 (date_field, id) 倒序取一页。after / before 为上一页尾行 / 下一页首行的游标，都没有时为第一页。
+    prefetch 为只对这一页的单据执行的 prefetch_related 路径。返回 KeysetPage。
+    """
+    after, before = decode_cursor(after), decode_cursor(before)
+    if before is not None:
+        when, pk = before
+        rows = list(
+            queryset.filter(Q(**{f'{date_field}__gt': when}) | Q(**{date_field: when, 'pk__gt': pk}))
+            .order_by(date_field, 'pk')[:per_page + 1]
+        )
+        if len(rows) <= per_page:
+            # 已经回到最前面 (期间可能有单据新增或删除)：直接取第一页，保证第一页总是满页
+            return keyset_page(queryset, date_field, prefetch=prefetch, per_page=per_page)
+        items = rows[:per_page][::-1]
+        has_next = has_previous = True
+    else:
+        if after is not None:
+            when, pk = after
+            queryset = queryset.filter(Q(**{f'{date_field}__lt': when}) | Q(**{date_field: when, 'pk__lt': pk}))
+        rows = list(queryset.order_by(f'-{date_field}', '-pk')[:per_page + 1])
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_previous = after is not None
+
+    if prefetch:
+        prefetch_related_objects(items, *prefetch)
+    return KeysetPage(items, date_field, has_next, has_previous)
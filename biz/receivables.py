@@ -0,0 +1,221 @@
+import csv
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from django.db.models import (
+    CharField, DecimalField, ExpressionWrapper, F, IntegerField, OuterRef, Q, Subquery, Sum, Value
+)
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from base.models import Customer
+from .models import SalesOrder, Receipt
+
+# ==========================================
+# 应收账款 (账龄、对账单)
+# ==========================================
+# 应收余额 = 已审核销售单总金额 - 该单已收款合计 (Receipt)。
+#   - 账龄 (aging_report)：所有客户、所有账龄区间在一条分组查询中算出，收款合计是相关子查询
+#   - 对账单 (iter_statement_rows)：期初余额两条分组查询，本月的销售和收款按客户排序
+#     一条 UNION 查询流式读取，与客户逐一合并，不再对每个客户单独查询
+# 销售退货单未关联原销售单，暂不冲减应收。
+
+ZERO = Decimal('0')
+CENT = Decimal('0.01')
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+# 账龄区间：(编码, 名称, 账龄天数上限)；超过最后一档为 "90 天以上"
+AGING_BUCKETS = [
+    ('current', '30 天内', 30),
+    ('d30', '31-60 天', 60),
+    ('d60', '61-90 天', 90),
+]
+OVERDUE_BUCKET = ('d90', '90 天以上')
+
+
+def _end_of(day):
+    """某天结束 (次日零点)"""
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def paid_amount(as_of=None):
+    """相关子查询：销售单截至 as_of (含当天) 的已收款合计"""
+    receipts = Receipt.objects.filter(order=OuterRef('pk'))
+    if as_of is not None:
+        receipts = receipts.filter(received_at__lt=_end_of(as_of))
+    return Coalesce(
+        Subquery(receipts.values('order').annotate(total=Sum('amount')).values('total'), output_field=MONEY),
+        Value(ZERO, output_field=MONEY),
+    )
+
+
+def open_orders(as_of=None):
+    """截至 as_of 仍有未收余额的已审核销售单，附加 paid 和 open_balance"""
+    orders = SalesOrder.objects.filter(status='approved')
+    if as_of is not None:
+        orders = orders.filter(order_date__lt=_end_of(as_of))
+    return (
+        orders.annotate(paid=paid_amount(as_of))
+        .annotate(open_balance=ExpressionWrapper(F('total_amount') - F('paid'), output_field=MONEY))
+        .filter(open_balance__gt=0)
+    )
+
+
+def order_balance(order):
+    """一张销售单当前的未收余额"""
+    paid = order.receipts.aggregate(total=Sum('amount'))['total'] or ZERO
+    return (order.total_amount or ZERO) - paid
+
+
+def aging_report(as_of=None):
+    """
+    按客户统计未收余额及账龄分布 (一条分组查询)，账龄按销售日期计算。
+    返回 (rows, totals)：rows 为 [{'customer_id', 'customer__name', 'customer__type', 'total', 各区间编码...}]，
+    按未收余额从高到低排列；totals 为各列合计。
+    """
+    as_of = as_of or timezone.localdate()
+    buckets = {}
+    newer = None
+    for code, label, days in AGING_BUCKETS:
+        # 账龄 <= days 天：销售日期不早于 as_of - days 当天零点
+        since = _end_of(as_of - timedelta(days=days + 1))
+        condition = Q(order_date__gte=since)
+        if newer is not None:
+            condition &= ~Q(order_date__gte=newer)
+        buckets[code] = Sum('open_balance', filter=condition)
+        newer = since
+    buckets[OVERDUE_BUCKET[0]] = Sum('open_balance', filter=Q(order_date__lt=newer))
+
+    rows = list(
+        open_orders(as_of)
+        .values('customer_id', 'customer__name', 'customer__type')
+        .annotate(total=Sum('open_balance'), **buckets)
+        .order_by('-total', 'customer_id')
+    )
+    codes = ['total'] + [code for code, label, days in AGING_BUCKETS] + [OVERDUE_BUCKET[0]]
+    totals = dict.fromkeys(codes, ZERO)
+    for row in rows:
+        for code in codes:
+            row[code] = row[code] or ZERO
+            totals[code] += row[code]
+    return rows, totals
+
+
+def bucket_columns():
+    """账龄区间的 (编码, 名称)，供模板和 CSV 表头使用"""
+    return [(code, label) for code, label, days in AGING_BUCKETS] + [OVERDUE_BUCKET]
+
+
+# ==========================================
+# 客户对账单
+# ==========================================
+
+SALE, RECEIPT = 'sale', 'receipt'
+
+
+def _month_bounds(month):
+    next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return (
+        timezone.make_aware(datetime.combine(month, time.min)),
+        timezone.make_aware(datetime.combine(next_month, time.min)),
+    )
+
+
+def _opening_balances(start):
+    """期初余额 {客户: 金额}：start 之前的销售合计减去收款合计 (两条分组查询)"""
+    balances = {}
+    for customer_id, total in (
+        SalesOrder.objects.filter(status='approved', order_date__lt=start)
+        .values('customer_id').annotate(total=Sum('total_amount')).values_list('customer_id', 'total')
+    ):
+        balances[customer_id] = total or ZERO
+    for customer_id, total in (
+        Receipt.objects.filter(order__status='approved', received_at__lt=start)
+        .values('order__customer_id').annotate(total=Sum('amount')).values_list('order__customer_id', 'total')
+    ):
+        balances[customer_id] = balances.get(customer_id, ZERO) - (total or ZERO)
+    return balances
+
+
+def _activity(start, end, chunk_size):
+    """本月的销售和收款，按 (客户, 日期) 排序的一条 UNION 查询，流式读取 (两个模型自带的默认排序需去掉)"""
+    sales = (
+        SalesOrder.objects.filter(status='approved', order_date__gte=start, order_date__lt=end)
+        .annotate(
+            customer_key=F('customer_id'), happened_at=F('order_date'),
+            kind=Value(SALE, output_field=CharField()), order_key=F('pk'),
+            debit=F('total_amount'), credit=Value(ZERO, output_field=MONEY),
+            seq=Value(0, output_field=IntegerField()),
+        )
+        .values_list('customer_key', 'happened_at', 'seq', 'kind', 'order_key', 'debit', 'credit')
+        .order_by()
+    )
+    receipts = (
+        Receipt.objects.filter(order__status='approved', received_at__gte=start, received_at__lt=end)
+        .annotate(
+            customer_key=F('order__customer_id'), happened_at=F('received_at'),
+            kind=Value(RECEIPT, output_field=CharField()), order_key=F('order_id'),
+            debit=Value(ZERO, output_field=MONEY), credit=F('amount'),
+            seq=Value(1, output_field=IntegerField()),
+        )
+        .values_list('customer_key', 'happened_at', 'seq', 'kind', 'order_key', 'debit', 'credit')
+        .order_by()
+    )
+    return sales.union(receipts, all=True).order_by('customer_key', 'happened_at', 'seq').iterator(chunk_size=chunk_size)
+
+
+def iter_statement_rows(month, chunk_size=2000):
+    """
+    生成 month (当月 1 日) 所有客户的对账单行，按客户依次输出：期初余额、本月销售/收款明细、期末余额。
+    期初为 0 且本月没有往来的客户跳过。每行为 dict：
+    {'customer_id', 'customer', 'date', 'summary', 'order', 'debit', 'credit', 'balance'}
+    """
+    start, end = _month_bounds(month)
+    opening = _opening_balances(start)
+    activity = _activity(start, end, chunk_size)
+    pending = next(activity, None)
+
+    for customer_id, name in Customer.objects.order_by('pk').values_list('pk', 'name').iterator(chunk_size=chunk_size):
+        balance = opening.get(customer_id, ZERO)
+        # UNION 结果与客户列表按同一顺序排列，逐个合并
+        lines = []
+        while pending is not None and pending[0] <= customer_id:
+            if pending[0] == customer_id:
+                lines.append(pending)
+            pending = next(activity, None)
+        if not lines and not balance:
+            continue
+
+        base = {'customer_id': customer_id, 'customer': name}
+        yield {**base, 'date': month, 'summary': '期初余额', 'order': '', 'debit': '', 'credit': '', 'balance': balance}
+        for _, happened_at, seq, kind, order_id, debit, credit in lines:
+            balance += (debit or ZERO) - (credit or ZERO)
+            yield {
+                **base,
+                'date': timezone.localdate(happened_at),
+                'summary': '销售' if kind == SALE else '收款',
+                'order': f'SO-{order_id}',
+                'debit': debit or '',
+                'credit': credit or '',
+                'balance': balance,
+            }
+        yield {**base, 'date': end.date() - timedelta(days=1), 'summary': '期末余额', 'order': '', 'debit': '', 'credit': '', 'balance': balance}
+
+
+STATEMENT_HEADER = [
+    ('customer_id', '客户编号'), ('customer', '客户'), ('date', '日期'), ('summary', '摘要'),
+    ('order', '单号'), ('debit', '应收'), ('credit', '已收'), ('balance', '余额'),
+]
+
+
+def write_statements(month, stream, chunk_size=2000):
+    """把 month 的客户对账单以 CSV 写入 stream (逐行写出，内存占用与客户数无关)，返回客户数"""
+    writer = csv.writer(stream)
+    writer.writerow([label for key, label in STATEMENT_HEADER])
+    customers = 0
+    for row in iter_statement_rows(month, chunk_size):
+        if row['summary'] == '期初余额':
+            customers += 1
+        for key in ('debit', 'credit', 'balance'):
+            if row[key] != '':
+                row[key] = Decimal(row[key]).quantize(CENT)
+        writer.writerow([row[key] for key, label in STATEMENT_HEADER])
+    return customers
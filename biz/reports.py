@@ -0,0 +1,241 @@
+import functools
+import hashlib
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .models import (
+    PurchaseOrder, SalesOrder,
+    SalesReturnOrder, PurchaseReturnOrder,
+    DailyBizSummary
+)
+
+# ==========================================
+# 每日业务汇总 (财务报表的数据来源)
+# ==========================================
+# 已审核单据按 (日期, 单据类型) 累计到 DailyBizSummary：
+#   - 审核 / 撤销审核 / 删除已审核单据 / 修改已审核单据的金额或日期时，
+#     由 biz/signals.py 在同一事务中调用 record_change() 增量更新
+#   - rebuild_daily_summary() 从原始单据全量重建 (管理命令 rebuild_daily_summary)
+# 报表只查询汇总表，查询 7 天还是 1 年、历史有 1 万还是 1000 万张单据，成本都一样。
+
+# 单据模型 -> (汇总类型, 日期字段)
+ROLLUP_SOURCES = {
+    PurchaseOrder: ('purchase', 'order_date'),
+    SalesOrder: ('sales', 'order_date'),
+    SalesReturnOrder: ('sales_return', 'return_date'),
+    PurchaseReturnOrder: ('purchase_return', 'return_date'),
+}
+
+
+def order_contribution(order):
+    """单据对汇总表的贡献 (日期, 金额)；未审核的单据返回 None"""
+    if order.status != 'approved':
+        return None
+    date_field = ROLLUP_SOURCES[type(order)][1]
+    return (timezone.localdate(getattr(order, date_field)), order.total_amount or Decimal('0'))
+
+
+def approved_contributions(order_model, pks):
+    """从数据库读取已审核单据当前的贡献，返回 {pk: (日期, 金额)}"""
+    date_field = ROLLUP_SOURCES[order_model][1]
+    return {
+        pk: (timezone.localdate(when), amount or Decimal('0'))
+        for pk, when, amount in order_model.objects.filter(pk__in=list(pks), status='approved')
+        .values_list('pk', date_field, 'total_amount')
+    }
+
+
+def _apply(doc_type, deltas):
+    """把 {日期: [笔数变化, 金额变化]} 累加到汇总表 (UPDATE，行不存在时 INSERT)"""
+    deltas = {day: change for day, change in deltas.items() if change[0] or change[1]}
+    if deltas:
+        # 汇总变了，报表缓存随之失效 (事务提交后才生效，回滚则不影响缓存)
+        transaction.on_commit(bump_report_version)
+    for day, (count, amount) in deltas.items():
+        rows = DailyBizSummary.objects.filter(day=day, doc_type=doc_type)
+        changes = {'order_count': F('order_count') + count, 'amount': F('amount') + amount}
+        if rows.update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                DailyBizSummary.objects.create(day=day, doc_type=doc_type, order_count=count, amount=amount)
+        except IntegrityError:
+            # 并发事务刚刚插入了这一天的汇总行
+            rows.update(**changes)
+
+
+def record_change(order_model, before, after):
+    """单据的贡献从 before 变为 after (均可为 None) 时更新汇总表"""
+    if before == after:
+        return
+    deltas = {}
+    if before is not None:
+        entry = deltas.setdefault(before[0], [0, Decimal('0')])
+        entry[0] -= 1
+        entry[1] -= before[1]
+    if after is not None:
+        entry = deltas.setdefault(after[0], [0, Decimal('0')])
+        entry[0] += 1
+        entry[1] += after[1]
+    _apply(ROLLUP_SOURCES[order_model][0], deltas)
+
+
+def record_total_changes(order_model, before, totals):
+    """
+    批量重算总金额后调整汇总金额 (笔数不变)。
+    before: 重算前已审核单据的贡献 {pk: (日期, 金额)}；totals: 重算后的 {pk: 总金额}
+    """
+    deltas = {}
+    for pk, (day, amount) in before.items():
+        entry = deltas.setdefault(day, [0, Decimal('0')])
+        entry[1] += totals[pk] - amount
+    _apply(ROLLUP_SOURCES[order_model][0], deltas)
+
+
+def rebuild_daily_summary():
+    """从原始单据全量重建汇总表，返回汇总行数 (同时使报表缓存失效)"""
+    rows = []
+    for order_model, (doc_type, date_field) in ROLLUP_SOURCES.items():
+        for row in (
+            order_model.objects.filter(status='approved')
+            .annotate(day=TruncDate(date_field))
+            .values('day')
+            .annotate(order_count=Count('id'), amount=Sum('total_amount'))
+            .order_by()
+        ):
+            rows.append(DailyBizSummary(
+                day=row['day'], doc_type=doc_type,
+                order_count=row['order_count'], amount=row['amount'] or 0,
+            ))
+    with transaction.atomic():
+        DailyBizSummary.objects.all().delete()
+        DailyBizSummary.objects.bulk_create(rows, batch_size=1000)
+        transaction.on_commit(bump_report_version)
+    return len(rows)
+
+
+def summarize(start, end):
+    """
+    读取 [start, end] 日期区间的汇总 (两条查询)，返回：
+    {'totals': {单据类型: {'total_orders', 'total_amount'}}, 'daily': {单据类型: [{'date', 'amount'}]}}
+    """
+    rows = DailyBizSummary.objects.filter(day__gte=start, day__lte=end)
+    totals = {doc_type: {'total_orders': 0, 'total_amount': Decimal('0')}
+              for doc_type, label in DailyBizSummary.DOC_TYPE_CHOICES}
+    for row in rows.values('doc_type').annotate(orders=Sum('order_count'), amount=Sum('amount')).order_by():
+        totals[row['doc_type']] = {'total_orders': row['orders'] or 0, 'total_amount': row['amount'] or Decimal('0')}
+
+    daily = {doc_type: [] for doc_type in totals}
+    for day, doc_type, amount in rows.filter(order_count__gt=0).order_by('day').values_list('day', 'doc_type', 'amount'):
+        daily[doc_type].append({'date': day, 'amount': amount})
+    return {'totals': totals, 'daily': daily}
+
+
+def recent_range(days):
+    """最近 days 天 (含今天) 的日期区间"""
+    today = timezone.localdate()
+    return today - timedelta(days=days - 1), today
+
+
+# ==========================================
+# 报表缓存 (版本号失效)
+# ==========================================
+# 报表结果以 "报表名 + 版本号 + 参数" 为键缓存。单据审核或撤销审核 (以及已审核单据金额变化) 会改动
+# 每日汇总，_apply() 在事务提交后把版本号加一，旧版本的缓存自然不再命中，无需逐个删除。
+# 两次审核之间反复打开报表不会执行任何汇总查询。
+# 版本号存放在各进程共享的缓存 (settings.CACHES['shared']，数据库缓存表) 中，某个进程审核单据后
+# 其他进程的下一次请求就会用新版本号；报表结果本身仍放在本进程的 default 缓存中，按版本号区分。
+
+REPORT_VERSION_KEY = 'biz:report-version'
+REPORT_VERSION_CACHE = 'shared'
+
+
+def report_version():
+    """当前报表版本号；缓存中没有时以当前时间 (毫秒) 初始化，不会与被淘汰前的旧版本号重复"""
+    versions = caches[REPORT_VERSION_CACHE]
+    return versions.get_or_set(REPORT_VERSION_KEY, lambda: int(time.time() * 1000), timeout=None)
+
+
+def bump_report_version():
+    """使所有报表缓存失效 (所有进程)"""
+    versions = caches[REPORT_VERSION_CACHE]
+    try:
+        versions.incr(REPORT_VERSION_KEY)
+    except ValueError:
+        # 版本号已被淘汰，重新初始化即可
+        versions.set(REPORT_VERSION_KEY, int(time.time() * 1000), timeout=None)
+
+
+def cached_report(name, params, build):
+    """
+    按版本号缓存报表上下文：命中直接返回，否则调用 build() 计算并写入缓存。
+    build() 的结果必须可以 pickle (查询集请先转换成 list)。
+    """
+    # 参数可能含中文和空格 (如按省份切片)，取摘要作为键，兼容 Memcached 的键限制
+    digest = hashlib.md5(repr(tuple(params)).encode('utf-8')).hexdigest()
+    key = f"biz:report:{name}:{report_version()}:{digest}"
+    result = cache.get(key)
+    if result is None:
+        result = build()
+        cache.set(key, result, getattr(settings, 'REPORT_CACHE_TIMEOUT', 3600))
+    return result
+
+
+# ==========================================
+# 单飞 (single-flight)：相同参数的并发计算只执行一次
+# ==========================================
+# 月结时多位财务同时打开报表，缓存刚失效，每个请求都会各自跑一遍同样的汇总查询。
+# 用 @single_flight() 装饰报表的计算函数 (而不是整个视图：渲染结果里有当前用户信息，不能共用)：
+# 同一进程内参数相同的并发调用只有第一个真正执行，其余等待并共享它的结果；
+# 等待超过 timeout 秒则不再等待，自己计算一次，避免被一个卡住的请求拖住。
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(timeout=30):
+    """装饰器：参数必须可哈希；计算函数抛出的异常同样会传给正在等待的调用方"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+            with _flights_lock:
+                flight = _flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _flights[key] = _Flight()
+
+            if not leader:
+                if not flight.done.wait(timeout):
+                    return func(*args, **kwargs)
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+
+            try:
+                flight.result = func(*args, **kwargs)
+                return flight.result
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with _flights_lock:
+                    del _flights[key]
+                flight.done.set()
+        return wrapper
+    return decorator
@@ -0,0 +1,110 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Sum, IntegerField
+from django.utils import timezone
+from base.models import Inventory
+from .models import StockReservation
+
+# ==========================================
+# 待审核销售单的库存预留
+# ==========================================
+# - 待审核销售单保存后调用 reserve_order()：按明细占用批次库存 (Inventory.reserved 增量维护)
+# - 审核时 convert_reservations()：在同一事务里释放本单预留，随后由 stock_out 实际扣减
+# - 作废/删除时 release_order()；超过 STOCK_RESERVATION_TTL_MINUTES 的预留由 release_expired() 释放
+# 只指定药品、未指定批次的明细不做预留，审核时再按 FEFO 分配。
+# 分片批次 (base/shards.py) 不做预留：预留记在主行上，审核时回退会让并发审核重新在主行上排队，
+# 抵消分片的作用。这类明细与只指定药品的明细一样，审核时由条件扣减检查库存，不保证预留时的可用量。
+
+
+def _reservation_ttl():
+    return timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_TTL_MINUTES', 24 * 60))
+
+
+def _release(reservations):
+    """释放一组预留：一条分组查询 + 一条 UPDATE 回退 Inventory.reserved + 一条 DELETE"""
+    totals = {
+        row['inventory_id']: row['total']
+        for row in reservations.values('inventory_id').annotate(total=Sum('quantity')).order_by()
+    }
+    if not totals:
+        return {}
+    Inventory.objects.filter(pk__in=list(totals)).update(
+        reserved=Case(
+            *[When(pk=pk, then=F('reserved') - qty) for pk, qty in totals.items()],
+            default=F('reserved'),
+            output_field=IntegerField(),
+        )
+    )
+    reservations.delete()
+    return totals
+
+
+def release_order(order):
+    """释放一张销售单的全部预留，返回 {inventory_id: 数量}"""
+    with transaction.atomic():
+        return _release(StockReservation.objects.filter(order_id=order.pk))
+
+
+def release_expired(now=None):
+    """释放所有已过期的预留，返回释放的批次数"""
+    with transaction.atomic():
+        return len(_release(StockReservation.objects.filter(expires_at__lte=now or timezone.now())))
+
+
+def reserve_order(order):
+    """
+    按待审核销售单当前的明细重新预留库存。
+    一条条件 UPDATE 同时完成 "可用量检查 + 增加预留"，可用量不足时整单回滚并抛出 ValueError。
+    """
+    if order.status != 'pending':
+        return
+    with transaction.atomic():
+        release_expired()
+        _release(StockReservation.objects.filter(order_id=order.pk))
+
+        needed = {}
+        for inventory_id, qty in (
+            order.details.filter(inventory__isnull=False, inventory__is_sharded=False)
+            .values_list('inventory_id', 'quantity')
+        ):
+            needed[inventory_id] = needed.get(inventory_id, 0) + qty
+        needed = {pk: qty for pk, qty in needed.items() if qty}
+        if not needed:
+            return
+
+        condition = Q()
+        for pk, qty in needed.items():
+            # 与开启分片 (base/shards.enable_sharding) 并发时，已改为分片的批次不再预留
+            condition |= Q(pk=pk, is_sharded=False, quantity__gte=F('reserved') + qty)
+        updated = Inventory.objects.filter(condition).update(
+            reserved=Case(
+                *[When(pk=pk, then=F('reserved') + qty) for pk, qty in needed.items()],
+                default=F('reserved'),
+                output_field=IntegerField(),
+            )
+        )
+        if updated != len(needed):
+            short = [
+                f"{inv.medicine.common_name} [{inv.batch_number}] 当前可用: {inv.available}, 需要: {needed[inv.pk]}"
+                for inv in Inventory.objects.with_live_quantity().select_related('medicine')
+                .filter(pk__in=list(needed)).order_by('pk')
+                if inv.available < needed[inv.pk]
+            ]
+            # 抛出异常回滚本次预留 (调用方的事务同样会回滚)
+            raise ValueError("可用库存不足，无法预留！" + "；".join(short))
+
+        now = timezone.now()
+        StockReservation.objects.bulk_create([
+            StockReservation(order_id=order.pk, inventory_id=pk, quantity=qty,
+                             created_at=now, expires_at=now + _reservation_ttl())
+            for pk, qty in needed.items()
+        ])
+
+
+def convert_reservations(order):
+    """
+    审核时转换预留：释放本单预留，使其数量回到可用库存，
+    紧接着在同一事务中由 stock_out 扣减，已预留的明细因此一定能扣减成功。
+    """
+    return release_order(order)
@@ -0,0 +1,217 @@
+from datetime import date, datetime, time
+from decimal import Decimal
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from base.models import Medicine
+from .models import PurchaseOrder, PurchaseDetail, PurchaseReturnOrder, SupplierMonthlyMetrics
+from .reports import bump_report_version
+
+# ==========================================
+# 供应商月度指标 (供应商评分)
+# ==========================================
+# 已审核进货单和采购退货单按 (供应商, 月份) 累计到 SupplierMonthlyMetrics：
+#   - 审核 / 撤销审核 / 删除已审核单据 / 修改已审核单据的供应商或日期时，
+#     由 biz/signals.py 在同一事务中按单据前后的贡献差额增量更新 (record_change)
+#   - 已审核单据的明细被修改时，重算该单据所在的 (供应商, 月份) (refresh_orders)
+#   - rebuild_supplier_metrics() 按月分块全量重建 (管理命令 rebuild_supplier_metrics)
+# 标准进价在审核 (或修改已审核单据的明细) 时记到进货明细上 (PurchaseDetail.list_price)，
+# 增量更新和重建都用记下的进价，之后药品进价变动时撤销审核减掉的仍是当初累加的金额。
+
+# 单据模型 -> 日期字段
+SOURCES = {
+    PurchaseOrder: 'order_date',
+    PurchaseReturnOrder: 'return_date',
+}
+
+COUNTERS = [
+    'purchase_orders', 'purchase_quantity', 'purchase_amount', 'list_amount',
+    'shelf_life_days', 'return_orders', 'return_amount',
+]
+
+
+def _empty():
+    return {
+        'purchase_orders': 0, 'purchase_quantity': 0, 'purchase_amount': Decimal('0'),
+        'list_amount': Decimal('0'), 'shelf_life_days': 0,
+        'return_orders': 0, 'return_amount': Decimal('0'),
+    }
+
+
+def contributions(order_model, orders):
+    """
+    已审核单据对指标的贡献 {(供应商, 月份): {计数器: 值}}，orders 为该模型的查询集。
+    进货单两条查询 (单据 + 明细)，退货单一条查询。
+    """
+    date_field = SOURCES[order_model]
+    cells = {}
+    keys = {}
+    for pk, supplier_id, when, amount in (
+        orders.filter(status='approved').order_by().values_list('pk', 'supplier_id', date_field, 'total_amount')
+    ):
+        key = keys[pk] = (supplier_id, timezone.localdate(when).replace(day=1))
+        cell = cells.setdefault(key, _empty())
+        if order_model is PurchaseReturnOrder:
+            cell['return_orders'] += 1
+            cell['return_amount'] += amount or Decimal('0')
+        else:
+            cell['purchase_orders'] += 1
+            cell['purchase_amount'] += amount or Decimal('0')
+
+    if order_model is PurchaseOrder and keys:
+        for order_id, quantity, list_price, produce_date, expiry_date in (
+            PurchaseDetail.objects.filter(order_id__in=list(keys))
+            .annotate(price=Coalesce('list_price', 'medicine__buy_price'))
+            .values_list('order_id', 'quantity', 'price', 'produce_date', 'expiry_date')
+            .iterator(chunk_size=2000)
+        ):
+            cell = cells[keys[order_id]]
+            cell['purchase_quantity'] += quantity
+            cell['list_amount'] += quantity * (list_price or Decimal('0'))
+            cell['shelf_life_days'] += quantity * (expiry_date - produce_date).days
+    return cells
+
+
+def stamp_list_prices(order_ids):
+    """把药品当前的指导进价记到这些进货单的明细上 (一条 UPDATE)"""
+    buy_price = Medicine.objects.filter(pk=OuterRef('medicine_id')).values('buy_price')[:1]
+    PurchaseDetail.objects.filter(order_id__in=list(order_ids)).update(list_price=Subquery(buy_price))
+
+
+def order_contribution(order_model, pk):
+    """一张单据当前 (数据库中) 的贡献，未审核的单据为空"""
+    return contributions(order_model, order_model.objects.filter(pk=pk))
+
+
+def _apply(deltas):
+    """把 {(供应商, 月份): {计数器: 变化}} 累加到指标表 (UPDATE，行不存在时 INSERT)"""
+    deltas = {key: change for key, change in deltas.items() if any(change.values())}
+    if deltas:
+        transaction.on_commit(bump_report_version)
+    for (supplier_id, month), change in deltas.items():
+        rows = SupplierMonthlyMetrics.objects.filter(supplier_id=supplier_id, month=month)
+        updates = {name: F(name) + value for name, value in change.items() if value}
+        if rows.update(**updates):
+            continue
+        try:
+            with transaction.atomic():
+                SupplierMonthlyMetrics.objects.create(supplier_id=supplier_id, month=month, **change)
+        except IntegrityError:
+            # 并发事务刚刚插入了这个月的指标行
+            rows.update(**updates)
+
+
+def record_change(before, after):
+    """单据的贡献从 before 变为 after (均为 contributions() 的结果) 时更新指标表"""
+    if before == after:
+        return
+    deltas = {}
+    for cells, sign in ((before or {}, -1), (after or {}, 1)):
+        for key, cell in cells.items():
+            delta = deltas.setdefault(key, _empty())
+            for name in COUNTERS:
+                delta[name] += sign * cell[name]
+    _apply(deltas)
+
+
+def _month_range(month):
+    next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return (
+        timezone.make_aware(datetime.combine(month, time.min)),
+        timezone.make_aware(datetime.combine(next_month, time.min)),
+    )
+
+
+def _rebuild(month, supplier_id=None):
+    """从原始单据重算一个月 (可限定供应商) 的指标行，返回写入的行数"""
+    start, end = _month_range(month)
+    cells = {}
+    for order_model, date_field in SOURCES.items():
+        orders = order_model.objects.filter(**{f'{date_field}__gte': start, f'{date_field}__lt': end})
+        if supplier_id is not None:
+            orders = orders.filter(supplier_id=supplier_id)
+        for key, cell in contributions(order_model, orders).items():
+            merged = cells.setdefault(key, _empty())
+            for name in COUNTERS:
+                merged[name] += cell[name]
+    with transaction.atomic():
+        existing = SupplierMonthlyMetrics.objects.filter(month=month)
+        if supplier_id is not None:
+            existing = existing.filter(supplier_id=supplier_id)
+        existing.delete()
+        SupplierMonthlyMetrics.objects.bulk_create([
+            SupplierMonthlyMetrics(supplier_id=key[0], month=key[1], **cell) for key, cell in cells.items()
+        ], batch_size=1000)
+        transaction.on_commit(bump_report_version)
+    return len(cells)
+
+
+def refresh_orders(order_model, order_ids):
+    """已审核单据的明细被修改后，重算这些单据所在的 (供应商, 月份)"""
+    date_field = SOURCES[order_model]
+    cells = set(
+        (supplier_id, timezone.localdate(when).replace(day=1))
+        for supplier_id, when in order_model.objects.filter(pk__in=list(order_ids), status='approved')
+        .values_list('supplier_id', date_field)
+    )
+    if order_model is PurchaseOrder:
+        stamp_list_prices(order_ids)
+    for supplier_id, month in cells:
+        _rebuild(month, supplier_id)
+
+
+def rebuild_supplier_metrics(start=None, end=None, progress=None):
+    """
+    按月分块重建供应商指标 (默认覆盖全部已审核单据的月份)，每个月一个事务。
+    progress(月份, 行数) 用于输出进度。返回 (月数, 总行数)。
+    """
+    firsts, lasts = [], []
+    for order_model, date_field in SOURCES.items():
+        bounds = order_model.objects.filter(status='approved').aggregate(first=Min(date_field), last=Max(date_field))
+        if bounds['first'] is not None:
+            firsts.append(timezone.localdate(bounds['first']))
+            lasts.append(timezone.localdate(bounds['last']))
+    if start is None:
+        if not firsts:
+            return 0, 0
+        start = min(firsts)
+    end = end or (max(lasts) if lasts else start)
+
+    months = total = 0
+    month = start.replace(day=1)
+    while month <= end:
+        count = _rebuild(month)
+        months += 1
+        total += count
+        if progress:
+            progress(month, count)
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return months, total
+
+
+def scorecard(start, end, supplier_id=None):
+    """
+    [start, end] 月份区间内各供应商的评分 (只查询指标表)，按进货金额降序：
+    进货金额/数量/单数、退货金额、退货率 (%)、价格偏差 (%)、平均效期 (天)。
+    指定 supplier_id 时改为该供应商逐月的明细。
+    """
+    rows = SupplierMonthlyMetrics.objects.filter(month__gte=start.replace(day=1), month__lte=end)
+    if supplier_id is not None:
+        rows = rows.filter(supplier_id=supplier_id).values('month').order_by('month')
+    else:
+        rows = rows.values('supplier_id', 'supplier__name').order_by()
+    rows = list(rows.annotate(**{name: Sum(name) for name in COUNTERS}))
+
+    for row in rows:
+        purchased = row['purchase_amount'] or Decimal('0')
+        row['return_rate'] = round(float(row['return_amount'] * 100 / purchased), 1) if purchased else None
+        row['price_drift'] = (
+            round(float((purchased / row['list_amount'] - 1) * 100), 1) if row['list_amount'] else None
+        )
+        row['avg_shelf_life'] = (
+            round(row['shelf_life_days'] / row['purchase_quantity']) if row['purchase_quantity'] else None
+        )
+    if supplier_id is None:
+        rows.sort(key=lambda row: row['purchase_amount'], reverse=True)
+    return rows
@@ -1,14 +1,21 @@
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
 from django.db import transaction
-from django.db.models import F, Sum
+from django.db.models import Case, When, F, Sum, Value
 from django.dispatch import receiver
-from django.db.models.signals import pre_save, post_save, post_delete
-from django.utils import timezone
-from base.models import Inventory
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from .stock import stock_in, stock_out, allocate_fefo
+from .reservations import convert_reservations, release_order
+from .reports import approved_contributions, order_contribution, record_change, record_total_changes
+from . import credit, cube, order_search, scorecard
+from base.models import Customer, Medicine, Supplier
 from .models import (
     PurchaseOrder, PurchaseDetail,
     SalesOrder, SalesDetail,
     SalesReturnOrder, SalesReturnDetail,
-    PurchaseReturnOrder, PurchaseReturnDetail
+    PurchaseReturnOrder, PurchaseReturnDetail,
+    Receipt
 )
 
 # ==========================================
@@ -19,163 +26,390 @@ from .models import (
 @receiver(pre_save, sender=SalesOrder)
 @receiver(pre_save, sender=SalesReturnOrder)
 @receiver(pre_save, sender=PurchaseReturnOrder)
-def check_status_transition(sender, instance, **kwargs):
+def check_status_transition(sender, instance, update_fields=None, **kwargs):
     """
     检查单据是否是从 '其他状态' 变成了 'approved'。
+    原状态取自加载时记住的 _loaded_status (见 StatusTrackedModel)，不再额外查库；
+    update_fields 不含 status 的保存 (如只更新总金额) 不可能改变状态，直接跳过。
     """
-    if not instance.pk:
-        instance._is_newly_approved = (instance.status == 'approved')
-    else:
-        try:
-            old_instance = sender.objects.get(pk=instance.pk)
-            instance._is_newly_approved = (old_instance.status != 'approved' and instance.status == 'approved')
-        except sender.DoesNotExist:
-            instance._is_newly_approved = False
-
-# ==========================================
-# 2. 并发安全的核心库存操作函数
-# ==========================================
+    if update_fields is not None and 'status' not in update_fields:
+        instance._is_newly_approved = False
+        return
 
-def _safe_add_inventory(detail_item):
-    """
-    【并发安全】增加库存
-    适用：进货、销售退货
-    修复：自动兼容 PurchaseDetail (直连药品) 和 SalesReturnDetail (连接库存)
-    """
-    # 1. 动态获取 Medicine 和 BatchNumber
-    # 如果是 SalesReturnDetail，它有 inventory 外键
-    if hasattr(detail_item, 'inventory') and detail_item.inventory:
-        target_medicine = detail_item.inventory.medicine
-        # 优先用明细里记录的批号（如果有），否则用库存对象的批号
-        target_batch = getattr(detail_item, 'batch_number', detail_item.inventory.batch_number)
-        # 对于退货，有效期通常沿用原库存的
-        target_expiry = detail_item.inventory.expiry_date
-    
-    # 如果是 PurchaseDetail，它直接有 medicine 外键
-    elif hasattr(detail_item, 'medicine'):
-        target_medicine = detail_item.medicine
-        target_batch = detail_item.batch_number
-        # 进货必须有有效期
-        target_expiry = getattr(detail_item, 'expiry_date', timezone.now().date())
-    
+    if instance._state.adding:
+        old_status = None
     else:
-        raise ValueError(f"未知明细类型: {type(detail_item)}，无法获取药品信息")
-
-    # 2. 开始事务逻辑
-    with transaction.atomic():
-        # 尝试查询并锁定
-        inventory_qs = Inventory.objects.select_for_update().filter(
-            medicine=target_medicine,
-            batch_number=target_batch
-        )
-        
-        if inventory_qs.exists():
-            inventory = inventory_qs.first()
-        else:
-            # 如果不存在（比如新进货，或者库存被物理删除后退货回来），创建新记录
-            inventory = Inventory.objects.create(
-                medicine=target_medicine,
-                batch_number=target_batch,
-                expiry_date=target_expiry,
-                quantity=0
-            )
-            # 重新加锁读取
-            inventory = Inventory.objects.select_for_update().get(pk=inventory.pk)
-        
-        # 3. 原子加法
-        inventory.quantity = F('quantity') + detail_item.quantity
-        inventory.save()
-        
-        inventory.refresh_from_db()
-        print(f"【并发安全加】{target_medicine.common_name} [{target_batch}] 库存变为: {inventory.quantity}")
-
-def _safe_deduct_inventory(detail_item):
-    """
-    【并发安全】扣减库存
-    适用：销售、采购退货
-    原理：select_for_update 锁定 -> 检查余额 -> F表达式扣减
-    """
-    with transaction.atomic():
-        # 1. 极其重要：不能直接使用 detail_item.inventory
-        # 因为 detail_item.inventory 是内存里的缓存对象，没有锁。
-        # 我们必须用 ID 重新去数据库里【锁定】这行记录。
-        try:
-            inventory = Inventory.objects.select_for_update().get(pk=detail_item.inventory.pk)
-        except Inventory.DoesNotExist:
-            raise ValueError(f"库存记录不存在: {detail_item.inventory}")
-
-        # 2. 在锁的保护下检查库存（此时没人能修改它）
-        if inventory.quantity < detail_item.quantity:
-            # 抛出异常会触发事务回滚，单据状态保存会被撤销
-            raise ValueError(
-                f"并发拦截：库存不足！商品: {inventory.medicine.common_name}, "
-                f"当前余: {inventory.quantity}, 需要: {detail_item.quantity}"
-            )
-
-        # 3. 原子扣减
-        inventory.quantity = F('quantity') - detail_item.quantity
-        inventory.save()
-        
-        inventory.refresh_from_db()
-        print(f"【并发安全减】{inventory.medicine.common_name} [{inventory.batch_number}] 库存变为: {inventory.quantity}")
-
+        old_status = instance._loaded_status
+        if old_status is None:
+            # status 字段未加载 (如 .only()/.defer())，退回查库
+            old_status = sender.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+    instance._is_newly_approved = (old_status != 'approved' and instance.status == 'approved')
 
 # ==========================================
-# 3. 信号监听器 (调用上面的安全函数)
+# 2. 信号监听器 (调用 stock.py 中的批量过账引擎)
 # ==========================================
 
 # --- 1. 进货审核 -> 增加库存 ---
 @receiver(post_save, sender=PurchaseOrder)
 def stock_in_purchase(sender, instance, **kwargs):
     if getattr(instance, '_is_newly_approved', False):
-        # 遍历所有明细，依次执行安全加法
-        for item in instance.details.all():
-            _safe_add_inventory(item)
+        # 整单一次性过账
+        stock_in(instance.details.all(), 'purchase', instance.pk)
 
 # --- 2. 销售审核 -> 扣减库存 ---
 @receiver(post_save, sender=SalesOrder)
 def stock_out_sales(sender, instance, **kwargs):
     if getattr(instance, '_is_newly_approved', False):
-        # 遍历所有明细，依次执行安全扣减
-        for item in instance.details.all():
-            _safe_deduct_inventory(item)
+        # 先转换本单的库存预留，再为只指定药品的明细按 FEFO 分配批次，最后整单一次性过账
+        with transaction.atomic():
+            convert_reservations(instance)
+            details = allocate_fefo(instance.details.all())
+            stock_out(details, 'sales', instance.pk)
+    elif instance.status == 'cancelled' and instance._loaded_status != 'cancelled':
+        # 刚作废的销售单释放预留 (已作废的单据再次保存时没有预留可释放)
+        release_order(instance)
+
+@receiver(pre_delete, sender=SalesOrder)
+def release_sales_reservations(sender, instance, **kwargs):
+    release_order(instance)
 
 # --- 3. 销售退货审核 -> 增加库存 (回滚) ---
 @receiver(post_save, sender=SalesReturnOrder)
 def stock_in_sales_return(sender, instance, **kwargs):
     if getattr(instance, '_is_newly_approved', False):
-        for item in instance.details.all():
-            _safe_add_inventory(item)
+        stock_in(instance.details.all(), 'sales_return', instance.pk)
 
 # --- 4. 采购退货审核 -> 扣减库存 ---
 @receiver(post_save, sender=PurchaseReturnOrder)
 def stock_out_purchase_return(sender, instance, **kwargs):
     if getattr(instance, '_is_newly_approved', False):
-        for item in instance.details.all():
-            _safe_deduct_inventory(item)
+        stock_out(instance.details.all(), 'purchase_return', instance.pk)
 
 # ==========================================
-# 4. 自动计算总金额 (保持原有逻辑)
+# 3. 自动计算总金额
 # ==========================================
+# 默认：每保存/删除一行明细，立即重算该单据总金额。
+# 延迟模式：在 defer_order_totals() 内，明细变动只把单据标记为 "脏"，
+# 退出时用一条分组 SUM + 一条 UPDATE 统一重算，保存 N 行明细的额外开销为 O(1)。
+
+_deferred = threading.local()
+
+@contextmanager
+def defer_order_totals():
+    """
+    延迟重算单据总金额，通常与 transaction.atomic() 一起包住表单集保存：
+        with transaction.atomic(), defer_order_totals():
+            formset.save()
+    嵌套使用时由最外层统一重算；块内抛出异常则不重算 (事务会回滚)。
+    """
+    if getattr(_deferred, 'orders', None) is not None:
+        yield
+        return
+    _deferred.orders = {}
+    try:
+        yield
+        for order_model, order_ids in _deferred.orders.items():
+            recalculate_order_totals(order_model, order_ids)
+    finally:
+        _deferred.orders = None
+
+def recalculate_order_totals(order_model, order_ids):
+    """
+    批量重算多张单据的总金额：一条分组 SUM 查询 + 一条 UPDATE。
+    使用 queryset.update()，不会触发单据的 pre_save/post_save 信号。
+    返回 {order_id: 总金额}。
+    """
+    order_ids = list(order_ids)
+    if not order_ids:
+        return {}
+    detail_model = order_model.details.rel.related_model
+    totals = {pk: Decimal('0') for pk in order_ids}
+    for row in (
+        detail_model.objects.filter(order_id__in=order_ids)
+        .values('order_id')
+        .annotate(total=Sum('total_amount'))
+    ):
+        totals[row['order_id']] = row['total'] or Decimal('0')
+
+    # 已审核单据金额变化时同步调整每日汇总
+    approved_before = approved_contributions(order_model, order_ids)
+    amount_field = order_model._meta.get_field('total_amount')
+    order_model.objects.filter(pk__in=order_ids).update(
+        total_amount=Case(
+            *[When(pk=pk, then=Value(total, output_field=amount_field)) for pk, total in totals.items()],
+            default=F('total_amount'),
+            output_field=amount_field,
+        )
+    )
+    record_total_changes(order_model, approved_before, totals)
+    if order_model is SalesOrder and approved_before:
+        # 已审核销售单的明细变了，重算其所在的立方体切片，并同步客户未收余额
+        cube.refresh_orders(approved_before)
+        credit.adjust_totals(approved_before, totals)
+    if order_model in scorecard.SOURCES and approved_before:
+        # 已审核进货/采购退货单的明细变了，重算其供应商当月指标
+        scorecard.refresh_orders(order_model, approved_before)
+    # 明细中的药品可能变了，重写单据的检索文档
+    order_search.refresh_documents(order_model, order_ids)
+    return totals
+
+def update_order_total(order_model, detail_instance, origin=None):
+    """明细变动后维护单据总金额 (延迟模式下只做标记)"""
+    # 删除单据时级联删除的明细：单据本身即将删除，不需要重算
+    if isinstance(origin, order_model) or getattr(origin, 'model', None) is order_model:
+        return
+    pending = getattr(_deferred, 'orders', None)
+    if pending is not None:
+        pending.setdefault(order_model, set()).add(detail_instance.order_id)
+        return
 
-def update_order_total(order_model, order_instance):
-    """通用函数：计算一张单据的总金额"""
-    total = order_instance.details.aggregate(total=Sum('total_amount'))['total'] or 0
-    order_instance.total_amount = total
-    order_instance.save(update_fields=['total_amount'])
+    total = recalculate_order_totals(order_model, [detail_instance.order_id])[detail_instance.order_id]
+    # 同步内存中已加载的单据对象
+    if type(detail_instance).order.is_cached(detail_instance):
+        detail_instance.order.total_amount = total
 
 @receiver([post_save, post_delete], sender=PurchaseDetail)
 def update_purchase_total(sender, instance, **kwargs):
-    update_order_total(PurchaseOrder, instance.order)
+    update_order_total(PurchaseOrder, instance, kwargs.get('origin'))
 
 @receiver([post_save, post_delete], sender=SalesDetail)
 def update_sales_total(sender, instance, **kwargs):
-    update_order_total(SalesOrder, instance.order)
+    update_order_total(SalesOrder, instance, kwargs.get('origin'))
 
 @receiver([post_save, post_delete], sender=SalesReturnDetail)
 def update_sales_return_total(sender, instance, **kwargs):
-    update_order_total(SalesReturnOrder, instance.order)
+    update_order_total(SalesReturnOrder, instance, kwargs.get('origin'))
 
 @receiver([post_save, post_delete], sender=PurchaseReturnDetail)
 def update_purchase_return_total(sender, instance, **kwargs):
-    update_order_total(PurchaseReturnOrder, instance.order)
\ No newline at end of file
+    update_order_total(PurchaseReturnOrder, instance, kwargs.get('origin'))
+
+
+# ==========================================
+# 4. 每日业务汇总 (biz/reports.py)
+# ==========================================
+# 与审核在同一事务中维护：保存前记下单据原来的贡献，保存后按新状态/金额/日期调整差额。
+
+@receiver(pre_save, sender=PurchaseOrder)
+@receiver(pre_save, sender=SalesOrder)
+@receiver(pre_save, sender=SalesReturnOrder)
+@receiver(pre_save, sender=PurchaseReturnOrder)
+def remember_summary_contribution(sender, instance, **kwargs):
+    # 加载时不是已审核的单据原本没有贡献，无需查库
+    if instance._state.adding or instance._loaded_status not in ('approved', None):
+        instance._summary_before = None
+    else:
+        instance._summary_before = approved_contributions(sender, [instance.pk]).get(instance.pk)
+
+@receiver(post_save, sender=PurchaseOrder)
+@receiver(post_save, sender=SalesOrder)
+@receiver(post_save, sender=SalesReturnOrder)
+@receiver(post_save, sender=PurchaseReturnOrder)
+def update_daily_summary(sender, instance, **kwargs):
+    record_change(sender, getattr(instance, '_summary_before', None), order_contribution(instance))
+
+@receiver(pre_delete, sender=PurchaseOrder)
+@receiver(pre_delete, sender=SalesOrder)
+@receiver(pre_delete, sender=SalesReturnOrder)
+@receiver(pre_delete, sender=PurchaseReturnOrder)
+def remove_from_daily_summary(sender, instance, **kwargs):
+    record_change(sender, approved_contributions(sender, [instance.pk]).get(instance.pk), None)
+
+
+# ==========================================
+# 5. 销售多维汇总 (biz/cube.py)
+# ==========================================
+# 与每日汇总相同：保存前记下已审核单据原来的单元格，保存后按新状态/日期/客户调整差额。
+# 必须注册在 stock_out_sales 之后：审核时先按 FEFO 分配批次，再按分配后的药品累计。
+
+@receiver(pre_save, sender=SalesOrder)
+def remember_cube_cells(sender, instance, **kwargs):
+    if instance._state.adding or instance._loaded_status not in ('approved', None):
+        instance._cube_before = None
+    else:
+        instance._cube_before = cube.order_cells([instance.pk])
+
+@receiver(pre_save, sender=SalesOrder)
+def snapshot_customer(sender, instance, update_fields=None, **kwargs):
+    """
+    审核 (或修改已审核单据的客户) 时把客户当前的类型和地址记到单据上。
+    注册在 remember_cube_cells 之后，那里取到的仍是原来的单元格。
+    """
+    if instance.status != 'approved':
+        return
+    if instance._loaded_status == 'approved' and instance.customer_id == instance._loaded_party_id:
+        return
+    customer = Customer.objects.filter(pk=instance.customer_id).values_list('type', 'province', 'city').first()
+    values = dict(zip(['customer_type', 'customer_province', 'customer_city'], customer or ('', '', '')))
+    for field, value in values.items():
+        setattr(instance, field, value)
+    if update_fields is not None and not instance._state.adding:
+        # 只保存部分字段 (如审核只保存 status) 时单独写入
+        SalesOrder.objects.filter(pk=instance.pk).update(**values)
+
+@receiver(post_save, sender=SalesOrder)
+def update_sales_cube(sender, instance, **kwargs):
+    before = getattr(instance, '_cube_before', None)
+    if before is None and instance.status != 'approved':
+        return
+    after = cube.order_cells([instance.pk]) if instance.status == 'approved' else None
+    cube.apply_order_change(before, after)
+
+@receiver(pre_delete, sender=SalesOrder)
+def remove_from_sales_cube(sender, instance, **kwargs):
+    if instance._loaded_status not in ('approved', None):
+        return
+    cube.apply_order_change(cube.order_cells([instance.pk]), None)
+
+
+# ==========================================
+# 6. 客户信用额度与未收余额 (biz/credit.py)
+# ==========================================
+# 审核销售单时在 pre_save 中检查额度并累加余额：超额立即失败，不必先做库存过账再回滚。
+# 已审核单据的明细改动使总金额增加时，在重算总金额时检查额度 (credit.adjust_totals)。
+# 其余变化 (撤销审核、修改已审核单据的客户、删除) 在保存后按前后差额调整。
+
+@receiver(pre_save, sender=SalesOrder)
+def charge_customer_credit(sender, instance, **kwargs):
+    if instance._state.adding or instance._loaded_status not in ('approved', None):
+        instance._credit_before = None
+    else:
+        instance._credit_before = (
+            SalesOrder.objects.filter(pk=instance.pk, status='approved')
+            .values_list('customer_id', 'total_amount').first()
+        )
+    if getattr(instance, '_is_newly_approved', False):
+        # 按数据库中的总金额检查：审核只保存 status，内存中的金额可能还是明细修改之前的
+        amount = instance.total_amount
+        if not instance._state.adding:
+            amount = SalesOrder.objects.filter(pk=instance.pk).values_list('total_amount', flat=True).first()
+        credit.charge(instance.customer_id, amount or Decimal('0'), enforce=True)
+
+@receiver(post_save, sender=SalesOrder)
+def update_customer_outstanding(sender, instance, **kwargs):
+    if getattr(instance, '_is_newly_approved', False):
+        return
+    before = getattr(instance, '_credit_before', None)
+    after = (instance.customer_id, instance.total_amount or Decimal('0')) if instance.status == 'approved' else None
+    if before == after:
+        return
+    if before is not None:
+        credit.release(*before)
+    if after is not None:
+        credit.charge(*after)
+
+@receiver(pre_delete, sender=SalesOrder)
+def release_customer_outstanding(sender, instance, **kwargs):
+    if instance._loaded_status not in ('approved', None):
+        return
+    before = (
+        SalesOrder.objects.filter(pk=instance.pk, status='approved')
+        .values_list('customer_id', 'total_amount').first()
+    )
+    if before is not None:
+        credit.release(*before)
+
+# --- 收款冲减未收余额 ---
+def _receipt_customer(receipt):
+    if Receipt.order.is_cached(receipt):
+        return receipt.order.customer_id
+    return SalesOrder.objects.filter(pk=receipt.order_id).values_list('customer_id', flat=True).first()
+
+@receiver(pre_save, sender=Receipt)
+def remember_receipt(sender, instance, **kwargs):
+    instance._receipt_before = None
+    if not instance._state.adding:
+        instance._receipt_before = (
+            Receipt.objects.filter(pk=instance.pk).values_list('order__customer_id', 'amount').first()
+        )
+
+@receiver(post_save, sender=Receipt)
+def apply_receipt(sender, instance, **kwargs):
+    before = getattr(instance, '_receipt_before', None)
+    if before is not None:
+        credit.charge(*before)
+    credit.release(_receipt_customer(instance), instance.amount)
+
+@receiver(pre_delete, sender=Receipt)
+def revert_receipt(sender, instance, **kwargs):
+    credit.charge(_receipt_customer(instance), instance.amount)
+
+
+# ==========================================
+# 7. 供应商月度指标 (biz/scorecard.py)
+# ==========================================
+# 与每日汇总相同：保存前记下已审核单据原来的贡献，保存后按新状态/供应商/日期调整差额。
+
+@receiver(pre_save, sender=PurchaseOrder)
+@receiver(pre_save, sender=PurchaseReturnOrder)
+def remember_supplier_metrics(sender, instance, **kwargs):
+    if instance._state.adding or instance._loaded_status not in ('approved', None):
+        instance._metrics_before = None
+    else:
+        instance._metrics_before = scorecard.order_contribution(sender, instance.pk)
+
+@receiver(post_save, sender=PurchaseOrder)
+@receiver(post_save, sender=PurchaseReturnOrder)
+def update_supplier_metrics(sender, instance, **kwargs):
+    before = getattr(instance, '_metrics_before', None)
+    if before is None and instance.status != 'approved':
+        return
+    if sender is PurchaseOrder and before is None:
+        # 审核时记下标准进价，撤销审核时按同样的进价减回
+        scorecard.stamp_list_prices([instance.pk])
+    after = scorecard.order_contribution(sender, instance.pk) if instance.status == 'approved' else None
+    scorecard.record_change(before, after)
+
+@receiver(pre_delete, sender=PurchaseOrder)
+@receiver(pre_delete, sender=PurchaseReturnOrder)
+def remove_supplier_metrics(sender, instance, **kwargs):
+    if instance._loaded_status not in ('approved', None):
+        return
+    scorecard.record_change(scorecard.order_contribution(sender, instance.pk), None)
+
+
+# ==========================================
+# 8. 单据检索文档 (biz/order_search.py)
+# ==========================================
+# 明细变化时在 recalculate_order_totals 中重写 (与总金额同一时机，延迟模式下也只重写一次)；
+# 这里处理新建单据、修改往来单位 (延迟模式下并入块结束时的那一次重写)、删除单据，以及供应商/客户/药品改名。
+
+@receiver(post_save, sender=PurchaseOrder)
+@receiver(post_save, sender=SalesOrder)
+@receiver(post_save, sender=SalesReturnOrder)
+@receiver(post_save, sender=PurchaseReturnOrder)
+def update_order_search_doc(sender, instance, created, update_fields=None, **kwargs):
+    if not created:
+        if update_fields is not None and sender.party_field not in update_fields:
+            return
+        # 原往来单位取自加载时记住的 _loaded_party_id (见 StatusTrackedModel)
+        if getattr(instance, f'{sender.party_field}_id') == instance._loaded_party_id:
+            return
+    # 延迟模式下 (表单集保存) 只做标记，块结束时与明细一起重写一次
+    pending = getattr(_deferred, 'orders', None)
+    if pending is not None:
+        pending.setdefault(sender, set()).add(instance.pk)
+        return
+    order_search.refresh_documents(sender, [instance.pk])
+
+@receiver(post_delete, sender=PurchaseOrder)
+@receiver(post_delete, sender=SalesOrder)
+@receiver(post_delete, sender=SalesReturnOrder)
+@receiver(post_delete, sender=PurchaseReturnOrder)
+def remove_order_search_doc(sender, instance, **kwargs):
+    order_search.remove_documents(sender, [instance.pk])
+
+@receiver(post_save, sender=Supplier)
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Medicine)
+def update_search_name(sender, instance, created, update_fields=None, **kwargs):
+    field = sender.name_field
+    if created or (update_fields is not None and field not in update_fields):
+        return
+    # 原名称取自加载时记住的 _loaded_name (见 base.models.NameTrackedModel)；未加载时按改名处理
+    if instance._loaded_name is not None and instance._loaded_name == getattr(instance, field):
+        return
+    if sender is Medicine:
+        order_search.refresh_for_medicine(instance.pk)
+    else:
+        order_search.refresh_for_party(sender, instance.pk)
@@ -0,0 +1,307 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, F, Q, IntegerField
+from django.utils import timezone
+from base.models import Inventory
+from base.ledger import record_movements
+from base.shards import sharded_ids, take_from_shards
+from base import counters
+
+# ==========================================
+# 库存过账引擎 (整单批量处理)
+# ==========================================
+# 一张单据审核时，所有明细一次性处理：
+#   1. 一条 SQL 取出并按主键顺序锁定涉及的所有库存行 (固定加锁顺序，避免两张单据互相死锁)
+#   2. 一次性检查所有明细是否库存不足
+#   3. 一条 UPDATE (CASE WHEN) 写回所有库存变化
+#   扣减默认走 "条件 UPDATE"：检查和扣减合并成一条语句 (见 _deduct_conditional)
+#   开启分片计数的热销批次先从分片扣减，不锁主行 (见 base/shards.py)
+#   4. 一条 INSERT 追加库存流水 (base/ledger.py)
+# 无论单据有多少行明细，数据库往返次数都是固定的。
+
+
+def _line_key(detail_item):
+    """
+    返回明细对应的库存定位方式：
+    - ('pk', inventory_id)：明细直连库存 (销售、销售退货、采购退货)
+    - ('batch', (medicine_id, batch_number))：明细直连药品 (进货)
+    """
+    if getattr(detail_item, 'inventory_id', None):
+        return ('pk', detail_item.inventory_id)
+    if getattr(detail_item, 'medicine_id', None):
+        return ('batch', (detail_item.medicine_id, detail_item.batch_number))
+    raise ValueError(f"未知明细类型: {type(detail_item)}，无法获取药品信息")
+
+
+def _collect(details):
+    """把明细按库存行合并数量 (同一批号出现多行时合并)"""
+    lines = {}
+    expiry = {}
+    for item in details:
+        key = _line_key(item)
+        lines[key] = lines.get(key, 0) + (item.quantity or 0)
+        if key[0] == 'batch' and key not in expiry:
+            # 进货必须有有效期
+            expiry[key] = getattr(item, 'expiry_date', None) or timezone.now().date()
+    return lines, expiry
+
+
+def _lock_rows(lines):
+    """一条 SQL 取出所有涉及的库存行，并按主键顺序加锁"""
+    pk_ids = [ref for kind, ref in lines if kind == 'pk']
+    batches = [ref for kind, ref in lines if kind == 'batch']
+
+    condition = Q(pk__in=pk_ids) if pk_ids else Q()
+    for medicine_id, batch_number in batches:
+        condition |= Q(medicine_id=medicine_id, batch_number=batch_number)
+    if not condition:
+        return []
+
+    return list(
+        Inventory.objects.select_for_update(of=('self',))
+        .select_related('medicine')
+        .filter(condition)
+        .order_by('pk')
+    )
+
+
+def _resolve(lines, expiry, create_missing):
+    """
+    把合并后的明细映射到库存行，返回 {inventory_pk: (inventory, 数量)}。
+    create_missing=True 时，不存在的批号 (新进货) 会被批量创建。
+    """
+    rows = _lock_rows(lines)
+    by_pk = {inv.pk: inv for inv in rows}
+    by_batch = {(inv.medicine_id, inv.batch_number): inv for inv in rows}
+
+    missing = [key for key in lines if key[0] == 'batch' and key[1] not in by_batch]
+    if missing and create_missing:
+        Inventory.objects.bulk_create([
+            Inventory(medicine_id=key[1][0], batch_number=key[1][1],
+                      expiry_date=expiry[key], quantity=0)
+            for key in missing
+        ])
+        # bulk_create 不发信号，手工累加库存表的行数计数 (base/counters.py)
+        counters.add(Inventory, len(missing))
+        # 新建的行也需要加锁并拿到主键，再查一次
+        for inv in _lock_rows(missing):
+            by_pk[inv.pk] = inv
+            by_batch[(inv.medicine_id, inv.batch_number)] = inv
+
+    postings = {}
+    for key, qty in lines.items():
+        kind, ref = key
+        inv = by_pk.get(ref) if kind == 'pk' else by_batch.get(ref)
+        if inv is None:
+            raise ValueError(f"库存记录不存在: {ref}")
+        current = postings.get(inv.pk, (inv, 0))[1]
+        postings[inv.pk] = (inv, current + qty)
+    return postings
+
+
+def _apply(postings, sign):
+    """一条 UPDATE 写回所有库存行的变化量 (F 表达式原子加减)"""
+    if not postings:
+        return
+    Inventory.objects.filter(pk__in=list(postings)).update(
+        quantity=Case(
+            *[When(pk=pk, then=F('quantity') + sign * qty) for pk, (inv, qty) in postings.items()],
+            default=F('quantity'),
+            output_field=IntegerField(),
+        )
+    )
+    for inv, qty in postings.values():
+        inv.quantity += sign * qty
+
+
+def stock_in(details, reason, source_id=None):
+    """
+    【并发安全】批量增加库存
+    适用：进货 (PurchaseDetail 直连药品)、销售退货 (SalesReturnDetail 连接库存)
+    reason/source_id 写入库存流水，标明是哪张单据引起的变动
+    """
+    lines, expiry = _collect(details)
+    if not lines:
+        return
+    with transaction.atomic():
+        postings = _resolve(lines, expiry, create_missing=True)
+        _apply(postings, +1)
+        record_movements([(inv, qty) for inv, qty in postings.values()], reason, source_id)
+    for inv, qty in postings.values():
+        print(f"【并发安全加】{inv.medicine.common_name} [{inv.batch_number}] 库存变为: {inv.total_quantity}")
+
+
+def _shortfall_error(postings):
+    """根据当前库存生成 "库存不足" 异常，postings: {inventory_pk: 需要数量}"""
+    shortfalls = [
+        f"{inv.medicine.common_name} [{inv.batch_number}] 当前可用: {inv.available}, 需要: {postings[inv.pk]}"
+        for inv in Inventory.objects.with_live_quantity().select_related('medicine')
+        .filter(pk__in=list(postings)).order_by('pk')
+        if inv.available < postings[inv.pk]
+    ]
+    return ValueError("并发拦截：库存不足！" + "；".join(shortfalls))
+
+
+class _Shortfall(Exception):
+    """条件扣减影响行数不足，用于回滚到保存点后再生成错误信息"""
+
+
+def _deduct_locked(lines, expiry):
+    """
+    悲观扣减：按主键顺序加锁读取 -> 一次性检查余额 -> 单条 UPDATE 扣减
+    分片批次不支持加锁路径 (锁主行就失去了分片的意义)，统一走条件扣减。
+    """
+    if sharded_ids([ref for kind, ref in lines if kind == 'pk']):
+        return _deduct_conditional(lines)
+    postings = _resolve(lines, expiry, create_missing=False)
+
+    # 在锁的保护下一次性检查所有明细，抛出异常会触发事务回滚
+    shortfalls = [
+        f"{inv.medicine.common_name} [{inv.batch_number}] 当前可用: {inv.available}, 需要: {qty}"
+        for pk, (inv, qty) in sorted(postings.items())
+        if inv.available < qty
+    ]
+    if shortfalls:
+        raise ValueError("并发拦截：库存不足！" + "；".join(shortfalls))
+
+    _apply(postings, -1)
+    return postings
+
+
+def _deduct_conditional(lines):
+    """
+    乐观扣减：一条带条件的 UPDATE 同时完成 "检查 + 扣减"
+        UPDATE ... SET quantity = quantity - n WHERE (id = ? AND quantity >= reserved + n) OR ...
+    已被其他待审核销售单预留的数量 (reserved) 不能被扣走。
+    影响行数少于涉及的库存行数，说明有批次库存不足，整单回滚。
+    不依赖 select_for_update (SQLite 下它本来就被忽略)，在任何数据库上都能防止超卖。
+    分片批次先从分片扣减 (take_from_shards)，分片不够的部分再从主行扣减。
+    """
+    needed = {}
+    for (kind, ref), qty in lines.items():
+        if kind != 'pk':
+            raise ValueError(f"扣减库存必须指定库存批次: {ref}")
+        needed[ref] = needed.get(ref, 0) + qty
+
+    try:
+        with transaction.atomic():
+            from_main = dict(needed)
+            sharded = sharded_ids(needed)
+            if sharded:
+                for pk in sharded:
+                    del from_main[pk]
+                from_main.update(take_from_shards({pk: needed[pk] for pk in sharded}))
+
+            condition = Q()
+            for pk, qty in from_main.items():
+                condition |= Q(pk=pk, quantity__gte=F('reserved') + qty)
+            updated = Inventory.objects.filter(condition).update(
+                quantity=Case(
+                    *[When(pk=pk, then=F('quantity') - qty) for pk, qty in from_main.items()],
+                    default=F('quantity'),
+                    output_field=IntegerField(),
+                )
+            ) if from_main else 0
+            if updated != len(from_main):
+                raise _Shortfall()
+    except _Shortfall:
+        # 已回滚到保存点，此时读到的是扣减前的库存
+        raise _shortfall_error(needed)
+
+    # 扣减后的结余 (用于流水和日志)；本事务已持有这些行的写锁，读到的就是自己写入的值
+    rows = Inventory.objects.with_live_quantity().select_related('medicine').filter(pk__in=list(needed))
+    return {inv.pk: (inv, needed[inv.pk]) for inv in rows}
+
+
+def stock_out(details, reason, source_id=None, strategy=None):
+    """
+    【并发安全】批量扣减库存
+    适用：销售、采购退货
+    strategy：
+      - 'conditional' (默认)：单条条件 UPDATE，整单 1 次往返完成检查和扣减
+      - 'locked'：select_for_update 加锁读取后检查再扣减 (仅用于对比测试)
+    默认值可通过 settings.STOCK_DEDUCT_STRATEGY 修改。
+    """
+    strategy = strategy or getattr(settings, 'STOCK_DEDUCT_STRATEGY', 'conditional')
+    lines, expiry = _collect(details)
+    if not lines:
+        return
+    with transaction.atomic():
+        if strategy == 'locked':
+            postings = _deduct_locked(lines, expiry)
+        else:
+            postings = _deduct_conditional(lines)
+        record_movements([(inv, -qty) for inv, qty in postings.values()], reason, source_id)
+    for inv, qty in postings.values():
+        print(f"【并发安全减】{inv.medicine.common_name} [{inv.batch_number}] 库存变为: {inv.total_quantity}")
+
+
+# ==========================================
+# 先到期先出 (FEFO) 自动分配批次
+# ==========================================
+
+def allocate_fefo(details):
+    """
+    把只指定了药品、没有指定批次的销售明细，按 "先到期先出" 分配到具体批次。
+    一条按 (药品, 有效期, 主键) 排序并加锁的查询取出候选批次 (走 idx_inv_medicine_expiry)，
+    一行明细跨多个批次时拆分成多行 SalesDetail (原行改为第一个批次，其余批量新建)。
+    返回分配后的全部明细列表，可直接交给 stock_out()。
+    """
+    details = list(details)
+    pending = [d for d in details if not d.inventory_id]
+    if not pending:
+        return details
+
+    today = timezone.localdate()
+    batches = (
+        Inventory.objects.select_for_update(of=('self',)).with_live_quantity()
+        .filter(medicine_id__in={d.medicine_id for d in pending}, expiry_date__gt=today, live_quantity__gt=F('reserved'))
+        .order_by('medicine_id', 'expiry_date', 'pk')
+    )
+    # 同一张单据里已经指定批次的明细先占用对应数量
+    claimed = {}
+    for d in details:
+        if d.inventory_id:
+            claimed[d.inventory_id] = claimed.get(d.inventory_id, 0) + d.quantity
+    available = {}
+    for inv in batches:
+        free = inv.available - claimed.get(inv.pk, 0)
+        if free > 0:
+            available.setdefault(inv.medicine_id, []).append([inv, free])
+
+    detail_model = type(pending[0])
+    changed, created, shortfalls = [], [], []
+    for line in pending:
+        remaining = line.quantity
+        chunks = []
+        for slot in available.get(line.medicine_id, []):
+            if remaining == 0:
+                break
+            take = min(slot[1], remaining)
+            if take:
+                chunks.append((slot[0], take))
+                slot[1] -= take
+                remaining -= take
+        if remaining:
+            shortfalls.append(f"{line.medicine} 可用批次不足，还差: {remaining}")
+            continue
+
+        for index, (inv, take) in enumerate(chunks):
+            target = line if index == 0 else detail_model(
+                order_id=line.order_id, medicine_id=line.medicine_id, actual_price=line.actual_price
+            )
+            target.inventory = inv
+            target.quantity = take
+            target.batch_number_snapshot = inv.batch_number
+            target.total_amount = take * (line.actual_price or 0)
+            (changed if index == 0 else created).append(target)
+
+    if shortfalls:
+        raise ValueError("并发拦截：库存不足！" + "；".join(shortfalls))
+
+    # 拆分前后金额之和不变，不需要重算单据总金额
+    if changed:
+        detail_model.objects.bulk_update(changed, ['inventory', 'quantity', 'batch_number_snapshot', 'total_amount'])
+    if created:
+        detail_model.objects.bulk_create(created)
+    return [d for d in details if d.inventory_id] + created
@@ -0,0 +1,177 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from .approval import approve_order, approve_orders
+
+# ==========================================
+# 组提交库存写入服务 (可选，主要用于 SQLite 部署)
+# ==========================================
+# SQLite 整个数据库只有一把写锁，每次审核都单独提交 (一次 fsync)，并发审核基本都在排队。
+# 开启后，审核请求放入队列，由唯一的写入线程攒够 MAX_BATCH 个或等满 MAX_WAIT_MS 毫秒后，
+# 在一个事务里依次处理 (每个请求一个保存点，互不影响)，一次提交。
+# 每个调用方通过 Future 拿到自己的结果：成功返回 True，库存不足等错误抛出 ValueError。
+# 所有审核入口 (单据编辑页、列表页批量审核、Admin) 都经由 submit_approval / submit_approvals，
+# 未开启时它们直接在当前线程过账。开启时写入线程使用自己的数据库连接，只能看到已提交的数据，
+# 调用方必须先提交单据和明细的保存，再提交审核请求。
+#
+# settings.STOCK_WRITER = {'ENABLED': True, 'MAX_BATCH': 50, 'MAX_WAIT_MS': 5}
+
+_STOP = object()
+
+
+class _ApprovalRequest:
+    def __init__(self, order_model, pk):
+        self.order_model = order_model
+        self.pk = pk
+        self.future = Future()
+
+
+class StockWriter:
+    """单线程组提交写入器"""
+
+    def __init__(self, max_batch=50, max_wait_ms=5):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='stock-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """处理完已排队的请求后停止写入线程"""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(_STOP)
+                self._thread.join()
+                self._thread = None
+
+    def submit(self, order_model, pk):
+        """提交一个审核请求，返回 Future"""
+        self.start()
+        request = _ApprovalRequest(order_model, pk)
+        self._queue.put(request)
+        return request.future
+
+    def approve(self, order_model, pk, timeout=None):
+        """提交审核请求并等待结果"""
+        return self.submit(order_model, pk).result(timeout)
+
+    def _next_batch(self):
+        """阻塞等待第一个请求，然后最多再等 max_wait 秒凑满一批；返回 (批次, 是否收到停止信号)"""
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        try:
+            stopping = False
+            while not stopping:
+                batch, stopping = self._next_batch()
+                if batch:
+                    close_old_connections()
+                    self.apply_batch(batch)
+        finally:
+            connection.close()
+
+    def apply_batch(self, batch):
+        """一个事务处理一批审核请求，每个请求一个保存点；提交成功后才通知调用方"""
+        outcomes = []
+        try:
+            with transaction.atomic():
+                for request in batch:
+                    try:
+                        order = request.order_model.objects.get(pk=request.pk)
+                        approve_order(order)
+                        outcomes.append((request, None))
+                    except Exception as e:
+                        # 保存点已回滚，只影响这一个请求
+                        outcomes.append((request, e))
+        except Exception as e:
+            # 整批提交失败 (如数据库错误)，所有调用方都收到该异常
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        for request, error in outcomes:
+            if error is None:
+                request.future.set_result(True)
+            else:
+                request.future.set_exception(error)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_stock_writer():
+    """按 settings.STOCK_WRITER 返回进程内唯一的写入器；未开启时返回 None"""
+    global _writer
+    config = getattr(settings, 'STOCK_WRITER', {})
+    if not config.get('ENABLED'):
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = StockWriter(config.get('MAX_BATCH', 50), config.get('MAX_WAIT_MS', 5))
+        return _writer
+
+
+def submit_approval(order):
+    """
+    审核单据：开启组提交时交给写入线程并等待结果，否则直接在当前线程审核。
+    成功后内存中的 order.status 为 approved；失败抛出 ValueError。
+    """
+    writer = get_stock_writer()
+    if writer is None:
+        approve_order(order)
+        return
+    writer.approve(type(order), order.pk)
+    order.refresh_from_db(fields=['status'])
+
+
+def submit_approvals(order_model, pks):
+    """
+    批量审核，返回 [(order, 错误信息或 None)]，按单号排序，只处理待审核的单据。
+    开启组提交时所有请求一起放入队列，由写入线程合并提交；否则走 approve_orders (整批一次加锁、逐单过账)。
+    """
+    writer = get_stock_writer()
+    if writer is None:
+        return approve_orders(order_model, pks)
+    orders = list(order_model.objects.filter(pk__in=pks, status='pending').order_by('pk'))
+    futures = [writer.submit(order_model, order.pk) for order in orders]
+    results = []
+    for order, future in zip(orders, futures):
+        try:
+            future.result()
+        except ValueError as e:
+            results.append((order, str(e)))
+        except DatabaseError as e:
+            results.append((order, f"数据库错误：{e}"))
+        except Exception as e:
+            # 写入线程里的其他异常同样按单报告，已提交的单据不受影响
+            results.append((order, f"审核出错：{e}"))
+        else:
+            order.status = order._loaded_status = 'approved'
+            results.append((order, None))
+    return results
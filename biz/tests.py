@@ -1,13 +1,14 @@
 from django.test import TestCase
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from base.models import Supplier, Medicine, Customer, Inventory
+from base.models import Supplier, Medicine, Customer, Inventory, StockMovement
 from biz.models import (
     PurchaseOrder, PurchaseDetail,
     SalesOrder, SalesDetail,
     SalesReturnOrder, SalesReturnDetail,
     PurchaseReturnOrder, PurchaseReturnDetail
 )
+import time
 from datetime import timedelta
 
 User = get_user_model()
@@ -141,4 +142,1471 @@ class BizModelTests(TestCase):
         )
 
         self.assertEqual(detail.total_amount, 50.00)
-        self.assertEqual(str(detail), f"Deduct: {self.medicine} * 5")
\ No newline at end of file
+        self.assertEqual(str(detail), f"Deduct: {self.medicine} * 5")
+
+class StockPostingTests(TestCase):
+    """库存过账引擎测试：整单批量过账，数据库往返次数与明细行数无关"""
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(
+            name='Posting Supplier', contact_person='A', license_no='L1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.customer = Customer.objects.create(
+            name='Posting Customer', type='wholesale', phone='1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.medicines = [
+            Medicine.objects.create(
+                common_name=f'Med{i}', specification='1g', manufacturer='M',
+                approval_number=f'HP{i}', buy_price=1, sell_price=2
+            )
+            for i in range(20)
+        ]
+        self.expiry = timezone.now().date() + timedelta(days=365)
+
+    def _purchase(self, count):
+        po = PurchaseOrder.objects.create(supplier=self.supplier, status='pending')
+        for med in self.medicines[:count]:
+            PurchaseDetail.objects.create(
+                order=po, medicine=med, batch_number='B1',
+                produce_date=timezone.now().date(), expiry_date=self.expiry,
+                quantity=10, unit_price=1
+            )
+        return po
+
+    def _sale(self, count, quantity=3):
+        so = SalesOrder.objects.create(customer=self.customer, status='pending')
+        for inv in Inventory.objects.order_by('pk')[:count]:
+            SalesDetail.objects.create(order=so, inventory=inv, quantity=quantity, actual_price=2)
+        return so
+
+    def _approve_queries(self, order):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        order.status = 'approved'
+        with CaptureQueriesContext(connection) as ctx:
+            order.save()
+        return len(ctx.captured_queries)
+
+    def test_purchase_approval_creates_batches(self):
+        po = self._purchase(3)
+        po.status = 'approved'
+        po.save()
+        self.assertEqual(Inventory.objects.filter(batch_number='B1').count(), 3)
+        self.assertTrue(all(inv.quantity == 10 for inv in Inventory.objects.filter(batch_number='B1')))
+
+    def test_sales_approval_deducts_all_lines(self):
+        po = self._purchase(5)
+        po.status = 'approved'
+        po.save()
+        so = self._sale(5)
+        so.status = 'approved'
+        so.save()
+        self.assertEqual(sorted(Inventory.objects.values_list('quantity', flat=True)), [7] * 5)
+        # 每个批次各有一条进货流水和一条销售流水
+        self.assertEqual(StockMovement.objects.filter(reason='purchase', source_id=po.pk).count(), 5)
+        self.assertEqual(
+            set(StockMovement.objects.filter(reason='sales', source_id=so.pk).values_list('quantity', 'balance')),
+            {(-3, 7)}
+        )
+
+    def test_shortfall_rolls_back_whole_order(self):
+        po = self._purchase(2)
+        po.status = 'approved'
+        po.save()
+        so = self._sale(2, quantity=5)
+        SalesDetail.objects.create(order=so, inventory=Inventory.objects.order_by('pk').first(),
+                                   quantity=6, actual_price=2)
+        so.status = 'approved'
+        with self.assertRaises(ValueError):
+            so.save()
+        self.assertEqual(sorted(Inventory.objects.values_list('quantity', flat=True)), [10, 10])
+
+    def test_conditional_deduction_reports_only_short_batches(self):
+        po = self._purchase(2)
+        po.status = 'approved'
+        po.save()
+        first, second = Inventory.objects.order_by('pk')
+        so = SalesOrder.objects.create(customer=self.customer, status='pending')
+        SalesDetail.objects.create(order=so, inventory=first, quantity=10, actual_price=2)
+        SalesDetail.objects.create(order=so, inventory=second, quantity=11, actual_price=2)
+        so.status = 'approved'
+        with self.assertRaises(ValueError) as ctx:
+            so.save()
+        self.assertIn('Med1 [B1] 当前可用: 10, 需要: 11', str(ctx.exception))
+        self.assertNotIn('Med0', str(ctx.exception))
+        self.assertEqual(sorted(Inventory.objects.values_list('quantity', flat=True)), [10, 10])
+
+    def test_locked_and_conditional_strategies_agree(self):
+        from biz.stock import stock_out
+        po = self._purchase(3)
+        po.status = 'approved'
+        po.save()
+        so = self._sale(3, quantity=4)
+        stock_out(so.details.all(), 'sales', so.pk, strategy='locked')
+        stock_out(so.details.all(), 'sales', so.pk, strategy='conditional')
+        self.assertEqual(sorted(Inventory.objects.values_list('quantity', flat=True)), [2, 2, 2])
+        for strategy in ('locked', 'conditional'):
+            with self.assertRaises(ValueError):
+                stock_out(so.details.all(), 'sales', so.pk, strategy=strategy)
+        self.assertEqual(sorted(Inventory.objects.values_list('quantity', flat=True)), [2, 2, 2])
+
+    def test_sharded_batch_approval_leaves_main_row_alone(self):
+        from base.shards import enable_sharding
+        po = self._purchase(1)
+        po.status = 'approved'
+        po.save()
+        inv = Inventory.objects.get()
+        enable_sharding(inv.pk, shards=4)
+        main_before = Inventory.objects.get(pk=inv.pk).quantity
+        so = self._sale(1, quantity=2)
+        so.status = 'approved'
+        so.save()
+        inv = Inventory.objects.with_live_quantity().get(pk=inv.pk)
+        self.assertEqual((inv.quantity, inv.live_quantity), (main_before, 8))
+        self.assertEqual(StockMovement.objects.get(reason='sales').balance, 8)
+
+    def test_approval_query_count_is_constant(self):
+        # 先审核一张空单据，当天的汇总行已存在，之后的审核都只需 UPDATE 汇总
+        for warmup in (self._purchase(0), self._sale(0)):
+            warmup.status = 'approved'
+            warmup.save()
+        small_po = self._purchase(2)
+        large_po = self._purchase(20)
+        self.assertEqual(self._approve_queries(small_po), self._approve_queries(large_po))
+        # 同理，先让销售立方体中各药品的单元格都存在
+        warmup = self._sale(20, quantity=1)
+        warmup.status = 'approved'
+        warmup.save()
+        small_so = self._sale(2, quantity=1)
+        large_so = self._sale(20, quantity=1)
+        self.assertEqual(self._approve_queries(small_so), self._approve_queries(large_so))
+
+
+class OrderTotalTests(TestCase):
+    """单据总金额维护测试"""
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(
+            name='Total Supplier', contact_person='A', license_no='L1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.medicine = Medicine.objects.create(
+            common_name='Total Med', specification='1g', manufacturer='M',
+            approval_number='HT1', buy_price=1, sell_price=2
+        )
+
+    def _add_lines(self, order, count):
+        for i in range(count):
+            PurchaseDetail.objects.create(
+                order=order, medicine=self.medicine, batch_number=f'T{i}',
+                produce_date=timezone.now().date(),
+                expiry_date=timezone.now().date() + timedelta(days=30),
+                quantity=2, unit_price=5
+            )
+
+    def test_immediate_total(self):
+        """默认模式下每行明细保存后总金额立即更新"""
+        po = PurchaseOrder.objects.create(supplier=self.supplier)
+        self._add_lines(po, 3)
+        po.refresh_from_db()
+        self.assertEqual(po.total_amount, 30)
+
+    def test_deferred_total_is_constant_cost(self):
+        """延迟模式下，除了明细 INSERT 外总金额维护的查询数与行数无关"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from biz.signals import defer_order_totals
+
+        counts = []
+        for lines in (2, 10):
+            po = PurchaseOrder.objects.create(supplier=self.supplier)
+            with CaptureQueriesContext(connection) as ctx, defer_order_totals():
+                self._add_lines(po, lines)
+            counts.append(len(ctx.captured_queries) - lines)
+            po.refresh_from_db()
+            self.assertEqual(po.total_amount, lines * 10)
+        self.assertEqual(counts[0], counts[1])
+
+
+class StatusTrackingTests(TestCase):
+    """单据状态跟踪测试：状态变更检测不再额外查库"""
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(
+            name='Status Supplier', contact_person='A', license_no='L1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.order = PurchaseOrder.objects.create(supplier=self.supplier)
+
+    def test_loaded_status_is_remembered(self):
+        order = PurchaseOrder.objects.get(pk=self.order.pk)
+        self.assertEqual(order._loaded_status, 'pending')
+        order.status = 'cancelled'
+        order.save()
+        self.assertEqual(order._loaded_status, 'cancelled')
+
+    def test_save_without_status_change_needs_no_select(self):
+        order = PurchaseOrder.objects.get(pk=self.order.pk)
+        with self.assertNumQueries(1):
+            order.save()
+        with self.assertNumQueries(1):
+            order.save(update_fields=['total_amount'])
+
+    def test_newly_approved_detection(self):
+        order = PurchaseOrder.objects.get(pk=self.order.pk)
+        order.status = 'approved'
+        order.save()
+        self.assertTrue(order._is_newly_approved)
+        order.save()
+        self.assertFalse(order._is_newly_approved)
+
+    def test_deferred_status_falls_back_to_query(self):
+        PurchaseOrder.objects.filter(pk=self.order.pk).update(status='approved')
+        order = PurchaseOrder.objects.only('id', 'supplier').get(pk=self.order.pk)
+        order.status = 'approved'
+        order.save()
+        self.assertFalse(order._is_newly_approved)
+
+
+class FefoAllocationTests(TestCase):
+    """先到期先出 (FEFO) 自动分配批次测试"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            name='FEFO Customer', type='retail', phone='1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.medicine = Medicine.objects.create(
+            common_name='FEFO Med', specification='1g', manufacturer='M',
+            approval_number='HF1', buy_price=1, sell_price=2
+        )
+        today = timezone.now().date()
+        self.expired = Inventory.objects.create(medicine=self.medicine, batch_number='OLD', expiry_date=today - timedelta(days=1), quantity=50)
+        self.late = Inventory.objects.create(medicine=self.medicine, batch_number='LATE', expiry_date=today + timedelta(days=300), quantity=50)
+        self.early = Inventory.objects.create(medicine=self.medicine, batch_number='EARLY', expiry_date=today + timedelta(days=30), quantity=5)
+
+    def test_medicine_only_line_is_split_by_expiry(self):
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, medicine=self.medicine, quantity=8, actual_price=3)
+        so.status = 'approved'
+        so.save()
+
+        lines = sorted(so.details.values_list('batch_number_snapshot', 'quantity', 'total_amount'))
+        self.assertEqual(lines, [('EARLY', 5, 15), ('LATE', 3, 9)])
+        so.refresh_from_db()
+        self.assertEqual(so.total_amount, 24)
+        self.early.refresh_from_db()
+        self.late.refresh_from_db()
+        self.expired.refresh_from_db()
+        self.assertEqual((self.early.quantity, self.late.quantity, self.expired.quantity), (0, 47, 50))
+
+    def test_explicit_batch_lines_are_claimed_first(self):
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=self.early, quantity=4, actual_price=3)
+        SalesDetail.objects.create(order=so, medicine=self.medicine, quantity=2, actual_price=3)
+        so.status = 'approved'
+        so.save()
+        self.assertEqual(
+            sorted(so.details.values_list('batch_number_snapshot', 'quantity')),
+            [('EARLY', 1), ('EARLY', 4), ('LATE', 1)]
+        )
+
+    def test_not_enough_unexpired_stock(self):
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, medicine=self.medicine, quantity=60, actual_price=3)
+        so.status = 'approved'
+        with self.assertRaises(ValueError):
+            so.save()
+        self.assertEqual(so.details.get().inventory_id, None)
+
+
+class StockReservationTests(TestCase):
+    """待审核销售单库存预留测试"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            name='Reserve Customer', type='retail', phone='1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        medicine = Medicine.objects.create(
+            common_name='Reserve Med', specification='1g', manufacturer='M',
+            approval_number='HR1', buy_price=1, sell_price=2
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=medicine, batch_number='R1',
+            expiry_date=timezone.now().date() + timedelta(days=100), quantity=10
+        )
+
+    def _pending_order(self, quantity):
+        from biz.reservations import reserve_order
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=self.inventory, quantity=quantity, actual_price=2)
+        reserve_order(so)
+        return so
+
+    def test_reservation_reduces_available(self):
+        so = self._pending_order(6)
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.quantity, self.inventory.reserved, self.inventory.available), (10, 6, 4))
+        self.assertEqual(so.reservations.get().quantity, 6)
+
+    def test_cannot_reserve_more_than_available(self):
+        self._pending_order(6)
+        with self.assertRaises(ValueError):
+            self._pending_order(5)
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.reserved, 6)
+
+    def test_approval_converts_reservation(self):
+        so = self._pending_order(6)
+        so.status = 'approved'
+        so.save()
+        self.inventory.refresh_from_db()
+        self.assertEqual((self.inventory.quantity, self.inventory.reserved), (4, 0))
+        self.assertFalse(so.reservations.exists())
+
+    def test_unreserved_sale_cannot_take_reserved_stock(self):
+        self._pending_order(6)
+        other = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=other, inventory=self.inventory, quantity=5, actual_price=2)
+        other.status = 'approved'
+        with self.assertRaises(ValueError):
+            other.save()
+
+    def test_cancel_and_expiry_release(self):
+        from biz.reservations import release_expired
+        so = self._pending_order(6)
+        so.status = 'cancelled'
+        so.save()
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.reserved, 0)
+
+        self._pending_order(3)
+        release_expired(timezone.now() + timedelta(days=2))
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.reserved, 0)
+
+    def test_sharded_batches_are_not_reserved(self):
+        from base.shards import enable_sharding
+        enable_sharding(self.inventory.pk, shards=2)
+        so = self._pending_order(6)
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.reserved, 0)
+        self.assertFalse(so.reservations.exists())
+        # 审核时从分片条件扣减，不更新主行的 reserved
+        so.status = 'approved'
+        so.save()
+        self.assertEqual(Inventory.objects.with_live_quantity().get(pk=self.inventory.pk).live_quantity, 4)
+
+    def test_resaving_cancelled_order_skips_release(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        so = self._pending_order(6)
+        so.status = 'cancelled'
+        so.save()
+        with CaptureQueriesContext(connection) as queries:
+            so.save()
+        self.assertFalse([q for q in queries.captured_queries if 'biz_stockreservation' in q['sql']])
+
+    def test_admin_reports_short_stock(self):
+        so = self._pending_order(6)
+        detail = so.details.get()
+        admin_user = User.objects.create_superuser(username='root', password='password')
+        self.client.force_login(admin_user)
+        url = f'/admin/biz/salesorder/{so.pk}/change/'
+        response = self.client.post(url, {
+            'customer': self.customer.pk, 'employee': admin_user.pk, 'status': 'pending',
+            'order_date_0': so.order_date.strftime('%Y-%m-%d'), 'order_date_1': so.order_date.strftime('%H:%M:%S'),
+            'details-TOTAL_FORMS': 1, 'details-INITIAL_FORMS': 1, 'details-MIN_NUM_FORMS': 0, 'details-MAX_NUM_FORMS': 1000,
+            'details-0-id': detail.pk, 'details-0-order': so.pk, 'details-0-inventory': self.inventory.pk,
+            'details-0-medicine': '', 'details-0-batch_number_snapshot': '', 'details-0-quantity': 20,
+            'details-0-actual_price': 2,
+        })
+        self.assertRedirects(response, url, fetch_redirect_response=False)
+        self.assertIn('可用库存不足', [str(m) for m in response.wsgi_request._messages][0])
+        # 整次保存回滚：明细数量和原预留都不变
+        detail.refresh_from_db()
+        self.inventory.refresh_from_db()
+        self.assertEqual((detail.quantity, self.inventory.reserved), (6, 6))
+
+
+class StockWriterTests(TestCase):
+    """组提交写入器测试 (直接调用 apply_batch，不启动后台线程)"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            name='Writer Customer', type='retail', phone='1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        medicine = Medicine.objects.create(
+            common_name='Writer Med', specification='1g', manufacturer='M',
+            approval_number='HW1', buy_price=1, sell_price=2
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=medicine, batch_number='W1',
+            expiry_date=timezone.now().date() + timedelta(days=100), quantity=5
+        )
+
+    def _order(self, quantity):
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=self.inventory, quantity=quantity, actual_price=2)
+        return so
+
+    def test_each_request_gets_its_own_result(self):
+        from biz.stock_writer import StockWriter, _ApprovalRequest
+        orders = [self._order(3), self._order(3), self._order(2)]
+        batch = [_ApprovalRequest(SalesOrder, so.pk) for so in orders]
+        StockWriter().apply_batch(batch)
+
+        self.assertTrue(batch[0].future.result())
+        with self.assertRaises(ValueError):
+            batch[1].future.result()
+        self.assertTrue(batch[2].future.result())
+
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 0)
+        statuses = dict(SalesOrder.objects.filter(pk__in=[so.pk for so in orders]).values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[so.pk] for so in orders], ['approved', 'pending', 'approved']
+        )
+
+    def test_submit_approval_without_writer(self):
+        from biz.stock_writer import submit_approval
+        so = self._order(6)
+        with self.assertRaises(ValueError):
+            submit_approval(so)
+        self.assertEqual(so.status, 'pending')
+        self.assertEqual(SalesOrder.objects.get(pk=so.pk).status, 'pending')
+
+    def test_submit_approvals_reports_writer_errors_per_order(self):
+        from unittest import mock
+        from django.db import OperationalError
+        from django.test import override_settings
+        from biz import stock_writer
+        first, second = self._order(2), self._order(2)
+
+        class FailingWriter(stock_writer.StockWriter):
+            """第二张单据整批提交失败 (如数据库被锁)，第一张正常提交"""
+            def submit(self, order_model, pk):
+                request = stock_writer._ApprovalRequest(order_model, pk)
+                if pk == second.pk:
+                    request.future.set_exception(OperationalError('database is locked'))
+                else:
+                    self.apply_batch([request])
+                return request.future
+
+        with override_settings(STOCK_WRITER={'ENABLED': True}), \
+                mock.patch.object(stock_writer, '_writer', FailingWriter()):
+            results = stock_writer.submit_approvals(SalesOrder, [first.pk, second.pk])
+        self.assertEqual(
+            [(order.pk, error) for order, error in results],
+            [(first.pk, None), (second.pk, '数据库错误：database is locked')]
+        )
+        self.assertEqual(SalesOrder.objects.get(pk=first.pk).status, 'approved')
+
+    def test_views_send_approvals_to_writer(self):
+        from unittest import mock
+        from django.test import override_settings
+        from biz import stock_writer
+
+        class InlineWriter(stock_writer.StockWriter):
+            """在当前线程处理请求 (测试运行在事务中，后台线程看不到未提交的数据)"""
+            def __init__(self):
+                super().__init__()
+                self.received = []
+
+            def submit(self, order_model, pk):
+                request = stock_writer._ApprovalRequest(order_model, pk)
+                self.received.append((order_model, pk))
+                self.apply_batch([request])
+                return request.future
+
+        writer = InlineWriter()
+        self.client.force_login(User.objects.create_user(username='approver', password='password', position='sales'))
+        so, other = self._order(3), self._order(2)
+        detail = so.details.get()
+        with override_settings(STOCK_WRITER={'ENABLED': True}), mock.patch.object(stock_writer, '_writer', writer):
+            self.client.post(f'/sales/{so.pk}/edit/', {
+                'customer': self.customer.pk, 'order_date': so.order_date.strftime('%Y-%m-%dT%H:%M'), 'status': 'approved',
+                'details-TOTAL_FORMS': 1, 'details-INITIAL_FORMS': 1, 'details-MIN_NUM_FORMS': 0, 'details-MAX_NUM_FORMS': 1000,
+                'details-0-id': detail.pk, 'details-0-order': so.pk, 'details-0-medicine': '',
+                'details-0-inventory': self.inventory.pk, 'details-0-quantity': 3, 'details-0-actual_price': 2,
+            })
+            self.client.post('/sales/approve/', {'order_ids': [other.pk]})
+
+        self.assertEqual(writer.received, [(SalesOrder, so.pk), (SalesOrder, other.pk)])
+        statuses = dict(SalesOrder.objects.filter(pk__in=[so.pk, other.pk]).values_list('pk', 'status'))
+        self.assertEqual(statuses, {so.pk: 'approved', other.pk: 'approved'})
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 0)
+
+
+class BulkApprovalTests(TestCase):
+    """批量审核测试"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            name='Bulk Customer', type='retail', phone='1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.supplier = Supplier.objects.create(
+            name='Bulk Supplier', contact_person='A', license_no='L2',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.medicine = Medicine.objects.create(
+            common_name='Bulk Med', specification='1g', manufacturer='M',
+            approval_number='HB1', buy_price=1, sell_price=2
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=self.medicine, batch_number='BK1',
+            expiry_date=timezone.now().date() + timedelta(days=100), quantity=5
+        )
+
+    def _sale(self, quantity):
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=self.inventory, quantity=quantity, actual_price=2)
+        return so
+
+    def test_failures_do_not_roll_back_successes(self):
+        from biz.approval import approve_orders
+        orders = [self._sale(3), self._sale(3), self._sale(2)]
+        results = approve_orders(SalesOrder, [so.pk for so in orders])
+
+        self.assertEqual([order.pk for order, error in results], [so.pk for so in orders])
+        self.assertEqual([error is None for order, error in results], [True, False, True])
+        self.assertIn('库存不足', results[1][1])
+        self.assertEqual(
+            list(SalesOrder.objects.order_by('pk').values_list('status', flat=True)),
+            ['approved', 'pending', 'approved']
+        )
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 0)
+
+    def test_database_errors_do_not_roll_back_successes(self):
+        from django.db import IntegrityError
+        from django.db.models.signals import pre_save
+        from biz.approval import approve_orders
+        orders = [self._sale(1), self._sale(1), self._sale(1)]
+
+        def fail_second(sender, instance, **kwargs):
+            if instance.pk == orders[1].pk:
+                raise IntegrityError('simulated')
+
+        pre_save.connect(fail_second, sender=SalesOrder)
+        try:
+            results = approve_orders(SalesOrder, [so.pk for so in orders])
+        finally:
+            pre_save.disconnect(fail_second, sender=SalesOrder)
+        self.assertEqual([error for order, error in results], [None, '数据库错误：simulated', None])
+        self.assertEqual(
+            list(SalesOrder.objects.order_by('pk').values_list('status', flat=True)),
+            ['approved', 'pending', 'approved']
+        )
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 3)
+
+    def test_only_pending_orders_are_approved(self):
+        from biz.approval import approve_orders
+        po = PurchaseOrder.objects.create(supplier=self.supplier)
+        PurchaseDetail.objects.create(
+            order=po, medicine=self.medicine, batch_number='BK1',
+            produce_date=timezone.now().date(), expiry_date=self.inventory.expiry_date,
+            quantity=10, unit_price=1
+        )
+        cancelled = PurchaseOrder.objects.create(supplier=self.supplier, status='cancelled')
+        results = approve_orders(PurchaseOrder, [po.pk, cancelled.pk])
+        self.assertEqual([(order.pk, error) for order, error in results], [(po.pk, None)])
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 15)
+
+
+class DailySummaryTests(TestCase):
+    """每日业务汇总 (财务报表数据源) 测试"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.supplier = Supplier.objects.create(
+            name='Summary Supplier', contact_person='A', license_no='L3',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.medicine = Medicine.objects.create(
+            common_name='Summary Med', specification='1g', manufacturer='M',
+            approval_number='HS1', buy_price=1, sell_price=2
+        )
+
+    def _purchase(self, quantity, unit_price=2):
+        po = PurchaseOrder.objects.create(supplier=self.supplier)
+        PurchaseDetail.objects.create(
+            order=po, medicine=self.medicine, batch_number=f'DS{po.pk}',
+            produce_date=timezone.now().date(), expiry_date=timezone.now().date() + timedelta(days=100),
+            quantity=quantity, unit_price=unit_price
+        )
+        po.refresh_from_db()
+        return po
+
+    def _row(self):
+        from biz.models import DailyBizSummary
+        return DailyBizSummary.objects.filter(doc_type='purchase').values_list('order_count', 'amount').first()
+
+    def test_summary_follows_approval_changes(self):
+        po = self._purchase(5)
+        self.assertIsNone(self._row())
+        po.status = 'approved'
+        po.save()
+        self.assertEqual(self._row(), (1, 10))
+
+        # 修改已审核单据的明细，金额差额计入汇总
+        PurchaseDetail.objects.create(
+            order=po, medicine=self.medicine, batch_number='DS-extra',
+            produce_date=timezone.now().date(), expiry_date=timezone.now().date() + timedelta(days=100),
+            quantity=1, unit_price=3
+        )
+        self.assertEqual(self._row(), (1, 13))
+
+        po.refresh_from_db()
+        po.status = 'cancelled'
+        po.save()
+        self.assertEqual(self._row(), (0, 0))
+
+    def test_delete_and_rebuild(self):
+        from biz.models import DailyBizSummary
+        from biz.reports import rebuild_daily_summary
+        first, second = self._purchase(1), self._purchase(4)
+        for po in (first, second):
+            po.status = 'approved'
+            po.save()
+        second.delete()
+        self.assertEqual(self._row(), (1, 2))
+
+        incremental = list(DailyBizSummary.objects.filter(order_count__gt=0).values_list('day', 'doc_type', 'order_count', 'amount'))
+        rebuild_daily_summary()
+        self.assertEqual(list(DailyBizSummary.objects.values_list('day', 'doc_type', 'order_count', 'amount')), incremental)
+
+    def test_finance_report_reads_summary(self):
+        po = self._purchase(5)
+        po.status = 'approved'
+        po.save()
+        User.objects.create_user(username='finance', password='password')
+        self.client.login(username='finance', password='password')
+        today = timezone.localdate().isoformat()
+        response = self.client.get('/finance-report/', {'start': today, 'end': today})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['purchase_stats'], {'total_orders': 1, 'total_amount': 10})
+        self.assertEqual(response.context['profit'], -10)
+
+
+class GrossMarginTests(TestCase):
+    """FIFO 销售成本与毛利测试"""
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(
+            name='Cogs Supplier', contact_person='A', license_no='L4',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.customer = Customer.objects.create(
+            name='Cogs Customer', type='retail', phone='1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.medicine = Medicine.objects.create(
+            common_name='Cogs Med', specification='1g', manufacturer='M',
+            approval_number='HC1', buy_price=1, sell_price=5
+        )
+
+    def _approve(self, order):
+        order.status = 'approved'
+        order.save()
+
+    def _receive(self, quantity, unit_price):
+        po = PurchaseOrder.objects.create(supplier=self.supplier)
+        PurchaseDetail.objects.create(
+            order=po, medicine=self.medicine, batch_number='C1',
+            produce_date=timezone.now().date(), expiry_date=timezone.now().date() + timedelta(days=100),
+            quantity=quantity, unit_price=unit_price
+        )
+        self._approve(po)
+
+    def test_fifo_layers_and_returns(self):
+        from biz.cogs import gross_margin
+        self._receive(10, 2)
+        self._receive(10, 3)
+        inventory = Inventory.objects.get()
+
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=inventory, quantity=15, actual_price=5)
+        self._approve(so)
+        # 15 件 = 10 件 * 2 元 + 5 件 * 3 元
+        result = gross_margin()
+        self.assertEqual((result['totals']['revenue'], result['totals']['cogs']), (75, 35))
+
+        # 退回的 5 件按最近出库的成本 (3 元) 冲回
+        sr = SalesReturnOrder.objects.create(customer=self.customer)
+        SalesReturnDetail.objects.create(order=sr, inventory=inventory, quantity=5, refund_price=5)
+        self._approve(sr)
+        result = gross_margin()
+        self.assertEqual((result['totals']['revenue'], result['totals']['cogs'], result['totals']['margin']), (50, 20, 30))
+        self.assertEqual(result['totals']['quantity'], 10)
+        self.assertEqual([row['label'] for row in result['by_medicine']], ['Cogs Med'])
+        self.assertEqual(len(result['by_period']), 1)
+
+        # 再卖 10 件：5 件 3 元 (退回的) + 5 件 3 元
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=inventory, quantity=10, actual_price=5)
+        self._approve(so)
+        self.assertEqual(gross_margin()['totals']['cogs'], 50)
+
+    def test_sales_without_receipts_use_buy_price(self):
+        from biz.cogs import gross_margin
+        inventory = Inventory.objects.create(
+            medicine=self.medicine, batch_number='OPEN', expiry_date=timezone.now().date() + timedelta(days=100), quantity=4
+        )
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=inventory, quantity=4, actual_price=5)
+        self._approve(so)
+        totals = gross_margin()['totals']
+        self.assertEqual((totals['revenue'], totals['cogs'], totals['margin_pct']), (20, 4, 80.0))
+        self.assertEqual(gross_margin(start=timezone.localdate() + timedelta(days=1))['by_medicine'], [])
+
+    def test_history_before_ledger(self):
+        from biz.cogs import gross_margin
+        # 启用库存流水之前：进货 100 件 10 元，卖出 60 件
+        self._receive(100, 10)
+        inventory = Inventory.objects.get()
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=inventory, quantity=60, actual_price=15)
+        self._approve(so)
+        PurchaseOrder.objects.update(order_date=timezone.now() - timedelta(days=1))
+        SalesOrder.objects.update(order_date=timezone.now() - timedelta(days=1))
+        # 启用流水 (同 base/migrations/0004、0013)：剩余 40 件记为期初，之后药品进价变动
+        StockMovement.objects.all().delete()
+        StockMovement.objects.create(inventory=inventory, reason='opening', quantity=40, balance=40, unit_cost=10)
+        Medicine.objects.filter(pk=self.medicine.pk).update(buy_price=50)
+        self.assertEqual(gross_margin()['totals']['cogs'], 600)
+
+        # 之后进货 50 件 12 元，再卖 80 件：40 件 10 元 + 40 件 12 元
+        self._receive(50, 12)
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=inventory, quantity=80, actual_price=15)
+        self._approve(so)
+        self.assertEqual(gross_margin()['totals']['cogs'], 600 + 400 + 480)
+
+
+class ReportCacheTests(TestCase):
+    """财务报表版本号缓存测试"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.supplier = Supplier.objects.create(
+            name='Cache Supplier', contact_person='A', license_no='L5',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        User.objects.create_user(username='cache', password='password')
+        self.client.login(username='cache', password='password')
+
+    def _report_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/finance-report/', {'days': 7})
+        self.assertEqual(response.status_code, 200)
+        return response, [q['sql'] for q in ctx.captured_queries if 'biz_' in q['sql']]
+
+    def test_cached_until_approval(self):
+        response, queries = self._report_queries()
+        self.assertTrue(queries)
+        self.assertEqual(response.context['purchase_stats']['total_orders'], 0)
+
+        # 两次审核之间再次访问不执行任何报表查询
+        response, queries = self._report_queries()
+        self.assertEqual(queries, [])
+
+        # 待审核单据的保存不会使缓存失效
+        po = PurchaseOrder.objects.create(supplier=self.supplier)
+        response, queries = self._report_queries()
+        self.assertEqual(queries, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            po.status = 'approved'
+            po.save()
+        response, queries = self._report_queries()
+        self.assertTrue(queries)
+        self.assertEqual(response.context['purchase_stats']['total_orders'], 1)
+
+
+    def test_version_is_shared_between_processes(self):
+        from django.core.cache import cache
+        from biz.reports import bump_report_version, report_version
+        version = report_version()
+        # 本进程的缓存清空 (相当于另一个 worker)，版本号仍从共享缓存表读到
+        cache.clear()
+        self.assertEqual(report_version(), version)
+        bump_report_version()
+        cache.clear()
+        self.assertEqual(report_version(), version + 1)
+
+
+class SingleFlightTests(TestCase):
+    """报表单飞计算测试 (不访问数据库)"""
+
+    def test_concurrent_calls_share_one_computation(self):
+        import threading
+        from biz.reports import single_flight
+        release = threading.Event()
+        calls = []
+
+        @single_flight(timeout=5)
+        def compute(x):
+            calls.append(x)
+            release.wait(5)
+            return {'value': x * 2}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(compute(21))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        # 等所有线程都进入等待后再放行第一个计算
+        while not calls:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [{'value': 42}] * 5)
+
+    def test_waiters_fall_back_after_timeout(self):
+        import threading
+        from biz.reports import single_flight
+        release = threading.Event()
+        calls = []
+
+        @single_flight(timeout=0.05)
+        def compute():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(5)
+            return len(calls)
+
+        leader = threading.Thread(target=compute)
+        leader.start()
+        while not calls:
+            time.sleep(0.01)
+        # 第一个计算卡住，等待超时后自己计算
+        self.assertEqual(compute(), 2)
+        release.set()
+        leader.join()
+
+
+class SalesCubeTests(TestCase):
+    """销售多维汇总测试"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.customers = [
+            Customer.objects.create(
+                name=f'Cube Customer {i}', type=kind, phone='1', province=province, city=city,
+                district='D', street='S', detail_address='A', zip_code='1'
+            )
+            for i, (kind, province, city) in enumerate([
+                ('wholesale', '广东省', '广州市'), ('retail', '广东省', '深圳市'), ('retail', '浙江省', '杭州市'),
+            ])
+        ]
+        self.inventories = []
+        for i, manufacturer in enumerate(['甲厂', '乙厂']):
+            medicine = Medicine.objects.create(
+                common_name=f'Cube Med {i}', specification='1g', manufacturer=manufacturer,
+                approval_number=f'HCUBE{i}', buy_price=1, sell_price=5
+            )
+            self.inventories.append(Inventory.objects.create(
+                medicine=medicine, batch_number='CB1',
+                expiry_date=timezone.now().date() + timedelta(days=365), quantity=1000
+            ))
+
+    def _sale(self, customer, lines, approve=True):
+        so = SalesOrder.objects.create(customer=customer)
+        for inventory, quantity in lines:
+            SalesDetail.objects.create(order=so, inventory=inventory, quantity=quantity, actual_price=2)
+        if approve:
+            so.status = 'approved'
+            so.save()
+        return so
+
+    def _snapshot(self):
+        from biz.models import SalesCube
+        return sorted(SalesCube.objects.exclude(line_count=0).values_list(
+            'month', 'medicine_id', 'customer_type', 'province', 'city', 'quantity', 'amount', 'line_count'
+        ))
+
+    def test_rollups_and_slices(self):
+        from biz.cube import cube_query
+        med0, med1 = self.inventories
+        self._sale(self.customers[0], [(med0, 10), (med1, 5)])
+        self._sale(self.customers[1], [(med0, 3)])
+        self._sale(self.customers[2], [(med1, 4)])
+        self._sale(self.customers[2], [(med1, 100)], approve=False)
+
+        by_province = {row['province']: (row['quantity'], row['amount']) for row in cube_query('province')}
+        self.assertEqual(by_province, {'广东省': (18, 36), '浙江省': (4, 8)})
+        by_city = [(row['city'], row['quantity']) for row in cube_query('city', {'province': '广东省'})]
+        self.assertEqual(by_city, [('广州市', 15), ('深圳市', 3)])
+        by_medicine = [row['label'] for row in cube_query('medicine', {'customer_type': 'retail'})]
+        self.assertEqual(by_medicine, ['Cube Med 1', 'Cube Med 0'])
+        month = f'{timezone.localdate():%Y-%m}'
+        rows = cube_query(['manufacturer', 'customer_type'], {'month': month})
+        self.assertEqual(
+            [(row['label'], row['quantity']) for row in rows],
+            [('甲厂 / 批发', 10), ('乙厂 / 批发', 5), ('乙厂 / 零售', 4), ('甲厂 / 零售', 3)]
+        )
+
+    def test_incremental_maintenance_matches_rebuild(self):
+        from biz.cube import rebuild_sales_cube
+        med0, med1 = self.inventories
+        so = self._sale(self.customers[0], [(med0, 10), (med1, 5)])
+        other = self._sale(self.customers[1], [(med0, 3)])
+        self._sale(self.customers[2], [(med1, 4)]).delete()
+
+        # 修改已审核单据的明细：重算其切片
+        detail = so.details.get(inventory=med1)
+        detail.quantity = 7
+        detail.save()
+        # 撤销审核
+        other.status = 'pending'
+        other.save()
+
+        incremental = self._snapshot()
+        self.assertEqual(
+            [(row[1], row[5], row[7]) for row in incremental],
+            [(med0.medicine_id, 10, 1), (med1.medicine_id, 7, 1)]
+        )
+        self.assertEqual(rebuild_sales_cube(), (1, 2))
+        self.assertEqual(self._snapshot(), incremental)
+
+    def test_customer_changes_keep_approved_cells(self):
+        from biz.cube import rebuild_sales_cube
+        med0 = self.inventories[0]
+        customer = self.customers[0]
+        so = self._sale(customer, [(med0, 10)])
+        # 客户搬家、改类型：已审核单据仍记在审核时的单元格
+        customer.type, customer.province, customer.city = 'retail', '浙江省', '杭州市'
+        customer.save()
+        detail = so.details.get()
+        detail.quantity = 12
+        detail.save()
+        self.assertEqual([row[2:6] for row in self._snapshot()], [('wholesale', '广东省', '广州市', 12)])
+        self.assertEqual(rebuild_sales_cube(), (1, 1))
+        self.assertEqual([row[2:6] for row in self._snapshot()], [('wholesale', '广东省', '广州市', 12)])
+
+        # 撤销审核从原单元格减掉，不会在新地址出现负数；重新审核按客户现在的资料归类
+        so.status = 'pending'
+        so.save()
+        self.assertEqual(self._snapshot(), [])
+        so.status = 'approved'
+        so.save()
+        self.assertEqual([row[2:6] for row in self._snapshot()], [('retail', '浙江省', '杭州市', 12)])
+
+    def _queries(self, query_string):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/finance-report/cube/' + query_string)
+        return ctx.captured_queries
+
+    def test_drill_down_page(self):
+        self._sale(self.customers[0], [(self.inventories[0], 10)])
+        User.objects.create_user(username='cube_boss', password='password', position='manager')
+        self.client.login(username='cube_boss', password='password')
+
+        response = self.client.get('/finance-report/cube/', {'by': 'province'})
+        self.assertEqual(response.status_code, 200)
+        row = response.context['rows'][0]
+        self.assertEqual(row['label'], '广东省')
+        self.assertIn('by=city', row['drill_url'])
+
+        response = self.client.get('/finance-report/cube/' + row['drill_url'])
+        self.assertEqual([r['label'] for r in response.context['rows']], ['广州市'])
+        self.assertEqual([c['value'] for c in response.context['crumbs']], ['广东省'])
+        # 报表只查询立方体表，不关联销售明细
+        self.assertFalse(any('biz_salesdetail' in q['sql'] for q in self._queries(row['drill_url'] + '&month=' + f'{timezone.localdate():%Y-%m}')))
+
+
+class ReceivablesTests(TestCase):
+    """应收账款测试"""
+
+    def setUp(self):
+        self.customers = [
+            Customer.objects.create(
+                name=name, type='wholesale', phone='1',
+                province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+            )
+            for name in ('AR Customer A', 'AR Customer B', 'AR Customer Idle')
+        ]
+        medicine = Medicine.objects.create(
+            common_name='AR Med', specification='1g', manufacturer='M',
+            approval_number='HAR1', buy_price=1, sell_price=5
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=medicine, batch_number='AR1',
+            expiry_date=timezone.now().date() + timedelta(days=365), quantity=1000
+        )
+
+    def _sale(self, customer, amount, days_ago):
+        so = SalesOrder.objects.create(customer=customer, order_date=timezone.now() - timedelta(days=days_ago))
+        SalesDetail.objects.create(order=so, inventory=self.inventory, quantity=amount, actual_price=1)
+        so.status = 'approved'
+        so.save()
+        return so
+
+    def test_aging_buckets_in_one_query(self):
+        from biz.models import Receipt
+        from biz.receivables import aging_report
+        a, b, idle = self.customers
+        self._sale(a, 100, 5)
+        paid_part = self._sale(a, 50, 45)
+        Receipt.objects.create(order=paid_part, amount=20)
+        self._sale(a, 30, 120)
+        paid_off = self._sale(b, 40, 70)
+        Receipt.objects.create(order=paid_off, amount=40)
+        self._sale(b, 10, 75)
+
+        with self.assertNumQueries(1):
+            rows, totals = aging_report()
+        self.assertEqual(
+            [(r['customer__name'], r['current'], r['d30'], r['d60'], r['d90'], r['total']) for r in rows],
+            [('AR Customer A', 100, 30, 0, 30, 160), ('AR Customer B', 0, 0, 10, 0, 10)]
+        )
+        self.assertEqual(totals['total'], 170)
+
+    def test_receipt_cannot_exceed_balance(self):
+        from biz.models import Receipt
+        so = self._sale(self.customers[0], 100, 1)
+        User.objects.create_user(username='ar_finance', password='password', position='finance')
+        self.client.login(username='ar_finance', password='password')
+        url = f'/sales/{so.pk}/receipt/'
+        response = self.client.post(url, {'amount': '150', 'received_at': '2026-01-01T10:00', 'method': 'cash'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Receipt.objects.exists())
+        response = self.client.post(url, {'amount': '60', 'received_at': '2026-01-01T10:00', 'method': 'cash'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Receipt.objects.get().employee.username, 'ar_finance')
+        response = self.client.get('/finance-report/aging/', {'customer': so.customer_id})
+        self.assertEqual([o.open_balance for o in response.context['orders']], [40])
+
+    def test_monthly_statements_stream(self):
+        import io
+        from biz.models import Receipt
+        from biz.receivables import write_statements
+        a, b, idle = self.customers
+        today = timezone.localdate()
+        month = today.replace(day=1)
+        # 上月的销售进入期初余额
+        before = self._sale(a, 100, today.day + 3)
+        Receipt.objects.create(order=before, amount=30, received_at=timezone.now() - timedelta(days=today.day + 2))
+        this_month = self._sale(b, 40, 0)
+        Receipt.objects.create(order=this_month, amount=15)
+
+        stream = io.StringIO()
+        with self.assertNumQueries(4):
+            customers = write_statements(month, stream)
+        self.assertEqual(customers, 2)
+        lines = [line.split(',') for line in stream.getvalue().splitlines()[1:]]
+        self.assertEqual([(l[1], l[3], l[7]) for l in lines], [
+            ('AR Customer A', '期初余额', '70.00'),
+            ('AR Customer A', '期末余额', '70.00'),
+            ('AR Customer B', '期初余额', '0.00'),
+            ('AR Customer B', '销售', '40.00'),
+            ('AR Customer B', '收款', '25.00'),
+            ('AR Customer B', '期末余额', '25.00'),
+        ])
+
+    def test_statement_command_rejects_bad_month(self):
+        from django.core.management import CommandError, call_command
+        for value in ['2026-13', '2026/01']:
+            with self.assertRaisesMessage(CommandError, 'expected YYYY-MM'):
+                call_command('generate_customer_statements', '--month', value)
+
+
+class CreditLimitTests(TestCase):
+    """客户信用额度测试"""
+
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            name='Credit Customer', type='wholesale', phone='1', credit_limit=100,
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        medicine = Medicine.objects.create(
+            common_name='Credit Med', specification='1g', manufacturer='M',
+            approval_number='HCR1', buy_price=1, sell_price=5
+        )
+        self.inventory = Inventory.objects.create(
+            medicine=medicine, batch_number='CR1',
+            expiry_date=timezone.now().date() + timedelta(days=365), quantity=1000
+        )
+
+    def _sale(self, amount):
+        so = SalesOrder.objects.create(customer=self.customer)
+        SalesDetail.objects.create(order=so, inventory=self.inventory, quantity=amount, actual_price=1)
+        return so
+
+    def _balance(self):
+        self.customer.refresh_from_db()
+        return self.customer.outstanding_balance
+
+    def test_approval_enforces_limit(self):
+        from biz.approval import approve_order
+        approve_order(self._sale(60))
+        self.assertEqual(self._balance(), 60)
+
+        over = self._sale(50)
+        with self.assertRaisesMessage(ValueError, '超出信用额度'):
+            approve_order(over)
+        # 整单回滚：状态、余额、库存都不变
+        over.refresh_from_db()
+        self.inventory.refresh_from_db()
+        self.assertEqual((over.status, self._balance(), self.inventory.quantity), ('pending', 60, 940))
+
+        # 收款释放额度后可以审核
+        from biz.models import Receipt
+        first = SalesOrder.objects.get(status='approved')
+        Receipt.objects.create(order=first, amount=30)
+        approve_order(over)
+        self.assertEqual(self._balance(), 80)
+
+    def test_balance_follows_changes(self):
+        from biz.approval import approve_order
+        from biz.credit import rebuild_outstanding
+        so = self._sale(40)
+        approve_order(so)
+        # 修改已审核单据的明细
+        detail = so.details.get()
+        detail.quantity = 45
+        detail.save()
+        self.assertEqual(self._balance(), 45)
+        # 撤销审核，再删除
+        so.status = 'pending'
+        so.save()
+        self.assertEqual(self._balance(), 0)
+        other = self._sale(20)
+        approve_order(other)
+        other.delete()
+        self.assertEqual(self._balance(), 0)
+
+        # 不限额的客户不检查
+        self.customer.credit_limit = None
+        self.customer.save()
+        approve_order(self._sale(500))
+        self.assertEqual(self._balance(), 500)
+        Customer.objects.update(outstanding_balance=0)
+        rebuild_outstanding()
+        self.assertEqual(self._balance(), 500)
+
+    def test_edit_and_approve_checks_new_total(self):
+        from biz.approval import approve_order
+        approve_order(self._sale(60))
+        self.client.force_login(User.objects.create_user(username='credit', password='password', position='sales'))
+
+        def edit(order, quantity, status):
+            detail = order.details.get()
+            return self.client.post(f'/sales/{order.pk}/edit/', {
+                'customer': self.customer.pk, 'order_date': order.order_date.strftime('%Y-%m-%dT%H:%M'), 'status': status,
+                'details-TOTAL_FORMS': 1, 'details-INITIAL_FORMS': 1, 'details-MIN_NUM_FORMS': 0, 'details-MAX_NUM_FORMS': 1000,
+                'details-0-id': detail.pk, 'details-0-order': order.pk, 'details-0-medicine': '',
+                'details-0-inventory': self.inventory.pk, 'details-0-quantity': quantity, 'details-0-actual_price': 1,
+            })
+
+        # 待审核的 10 元单据改成 50 元并审核：按新金额检查，超额后整单回滚
+        so = self._sale(10)
+        response = edit(so, 50, 'approved')
+        self.assertContains(response, '超出信用额度')
+        so.refresh_from_db()
+        self.assertEqual((so.status, so.total_amount, self._balance()), ('pending', 10, 60))
+
+        # 已审核单据改大金额同样检查额度
+        first = SalesOrder.objects.get(status='approved')
+        response = edit(first, 120, 'approved')
+        self.assertContains(response, '超出信用额度')
+        self.assertEqual((first.details.get().quantity, self._balance()), (60, 60))
+        edit(first, 90, 'approved')
+        self.assertEqual(self._balance(), 90)
+
+    def test_limit_check_is_single_row_update(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from biz.approval import approve_order
+        so = self._sale(10)
+        with CaptureQueriesContext(connection) as ctx:
+            approve_order(so)
+        # 额度检查与累加 (审核时另有一次读取客户类型和地址，供销售多维汇总使用)
+        customer_queries = [q['sql'] for q in ctx.captured_queries if 'outstanding_balance' in q['sql']]
+        self.assertEqual(len(customer_queries), 1)
+        self.assertTrue(customer_queries[0].startswith('UPDATE'))
+
+
+class SupplierScorecardTests(TestCase):
+    """供应商月度指标测试"""
+
+    def setUp(self):
+        self.suppliers = [
+            Supplier.objects.create(
+                name=name, contact_person='A', license_no=f'LS{i}',
+                province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+            )
+            for i, name in enumerate(['Good Supplier', 'Pricey Supplier'])
+        ]
+        self.medicine = Medicine.objects.create(
+            common_name='Score Med', specification='1g', manufacturer='M',
+            approval_number='HSC1', buy_price=2, sell_price=5
+        )
+
+    def _purchase(self, supplier, quantity, unit_price, shelf_days, batch):
+        po = PurchaseOrder.objects.create(supplier=supplier)
+        produce = timezone.now().date() - timedelta(days=10)
+        PurchaseDetail.objects.create(
+            order=po, medicine=self.medicine, batch_number=batch,
+            produce_date=produce, expiry_date=produce + timedelta(days=shelf_days),
+            quantity=quantity, unit_price=unit_price
+        )
+        po.status = 'approved'
+        po.save()
+        return po
+
+    def _metrics(self):
+        from biz.models import SupplierMonthlyMetrics
+        return sorted(SupplierMonthlyMetrics.objects.values_list(
+            'supplier_id', 'month', 'purchase_orders', 'purchase_quantity', 'purchase_amount',
+            'list_amount', 'shelf_life_days', 'return_orders', 'return_amount'
+        ))
+
+    def test_scorecard_ratios(self):
+        from biz.scorecard import scorecard
+        good, pricey = self.suppliers
+        self._purchase(good, 100, 2, 720, 'G1')
+        self._purchase(good, 100, 2, 360, 'G2')
+        self._purchase(pricey, 10, 3, 180, 'P1')
+        inventory = Inventory.objects.get(batch_number='G1')
+        pr = PurchaseReturnOrder.objects.create(supplier=good)
+        PurchaseReturnDetail.objects.create(order=pr, inventory=inventory, quantity=20, unit_price=2)
+        pr.status = 'approved'
+        pr.save()
+
+        month = timezone.localdate().replace(day=1)
+        with self.assertNumQueries(1):
+            rows = scorecard(month, month)
+        self.assertEqual(
+            [(r['supplier__name'], r['purchase_amount'], r['return_rate'], r['price_drift'], r['avg_shelf_life']) for r in rows],
+            [('Good Supplier', 400, 10.0, 0.0, 540), ('Pricey Supplier', 30, 0.0, 50.0, 180)]
+        )
+
+    def test_incremental_matches_rebuild(self):
+        from biz.scorecard import rebuild_supplier_metrics
+        good, pricey = self.suppliers
+        po = self._purchase(good, 100, 2, 720, 'G1')
+        other = self._purchase(pricey, 10, 3, 180, 'P1')
+        # 修改已审核单据的明细、撤销审核、删除
+        detail = po.details.get()
+        detail.unit_price = 3
+        detail.save()
+        other.status = 'pending'
+        other.save()
+        self._purchase(pricey, 5, 3, 100, 'P2').delete()
+
+        incremental = self._metrics()
+        self.assertEqual(len([row for row in incremental if row[2]]), 1)
+        self.assertEqual(incremental[0][4], 300)
+        rebuild_supplier_metrics()
+        self.assertEqual([row for row in self._metrics() if any(row[2:])], [row for row in incremental if any(row[2:])])
+
+    def test_unapprove_uses_approval_list_price(self):
+        from biz.scorecard import rebuild_supplier_metrics
+        po = self._purchase(self.suppliers[0], 100, 2, 720, 'G1')
+        self.assertEqual(self._metrics()[0][5], 200)
+        # 审核之后药品进价变动：重建和撤销审核都按审核时的进价
+        Medicine.objects.filter(pk=self.medicine.pk).update(buy_price=5)
+        rebuild_supplier_metrics()
+        self.assertEqual(self._metrics()[0][5], 200)
+        po.status = 'pending'
+        po.save()
+        self.assertEqual([row for row in self._metrics() if any(row[2:])], [])
+
+    def test_scorecard_page(self):
+        self._purchase(self.suppliers[0], 100, 2, 720, 'G1')
+        User.objects.create_user(username='buyer', password='password', position='purchaser')
+        self.client.login(username='buyer', password='password')
+        response = self.client.get('/supplier/scorecard/', {'sort': 'shelf_life', 'supplier': self.suppliers[0].pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['supplier__name'] for row in response.context['rows']], ['Good Supplier'])
+        self.assertEqual(len(response.context['monthly']), 1)
+
+
+class KeysetPaginationTests(TestCase):
+    """单据列表游标分页测试"""
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(name='Page Supplier', contact_person='X', license_no='PG1', province='P', city='C', district='D', street='S', detail_address='A', zip_code='1')
+        self.medicine = Medicine.objects.create(
+            common_name='Page Med', specification='1g', manufacturer='M',
+            approval_number='HPG1', buy_price=1, sell_price=2
+        )
+        self.user = User.objects.create_user(username='pager', password='password', position='purchaser')
+        # 同一时间的单据多张，验证 (日期, id) 作为游标时不重不漏
+        now = timezone.now()
+        self.orders = []
+        for i in range(45):
+            po = PurchaseOrder.objects.create(supplier=self.supplier, employee=self.user, order_date=now - timedelta(days=i // 3))
+            PurchaseDetail.objects.create(
+                order=po, medicine=self.medicine, quantity=1, unit_price=1, batch_number=f'PG{i}',
+                produce_date=now.date(), expiry_date=now.date() + timedelta(days=365)
+            )
+            self.orders.append(po)
+
+    def test_pages_are_stable_in_both_directions(self):
+        from biz.pagination import keyset_page
+        queryset = PurchaseOrder.objects.all()
+        expected = list(PurchaseOrder.objects.order_by('-order_date', '-pk').values_list('pk', flat=True))
+
+        pages = [keyset_page(queryset, 'order_date')]
+        while pages[-1].has_next:
+            pages.append(keyset_page(queryset, 'order_date', after=pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual([order.pk for page in pages for order in page], expected)
+        self.assertFalse(pages[0].has_previous)
+
+        # 从最后一页往回翻，得到同样的页面
+        back = keyset_page(queryset, 'order_date', before=pages[2].previous_cursor)
+        self.assertEqual([o.pk for o in back], [o.pk for o in pages[1]])
+        first = keyset_page(queryset, 'order_date', before=back.previous_cursor)
+        self.assertEqual([o.pk for o in first], [o.pk for o in pages[0]])
+        self.assertFalse(first.has_previous)
+
+        # 翻页期间新增的单据不影响后面的页
+        PurchaseOrder.objects.create(supplier=self.supplier, employee=self.user)
+        again = keyset_page(queryset, 'order_date', after=pages[0].next_cursor)
+        self.assertEqual([o.pk for o in again], [o.pk for o in pages[1]])
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        from biz.pagination import keyset_page
+        page = keyset_page(PurchaseOrder.objects.all(), 'order_date', after='not-a-cursor')
+        self.assertFalse(page.has_previous)
+        self.assertEqual(len(page), 20)
+
+    def test_list_view_query_count_independent_of_depth(self):
+        from biz.pagination import keyset_page
+        self.client.login(username='pager', password='password')
+        self.client.get('/purchase/', {'search': 'Page'})
+        second = keyset_page(PurchaseOrder.objects.all(), 'order_date')
+        third = keyset_page(PurchaseOrder.objects.all(), 'order_date', after=second.next_cursor)
+
+        # 会话/用户 + 一页单据 + 当前页的明细和药品
+        with self.assertNumQueries(5):
+            response = self.client.get('/purchase/')
+        self.assertEqual(len(response.context['orders']), 20)
+        with self.assertNumQueries(5):
+            response = self.client.get('/purchase/', {'after': third.next_cursor, 'search': 'Page'})
+        self.assertEqual(len(response.context['orders']), 5)
+        self.assertContains(response, '上一页')
+        self.assertNotContains(response, '下一页')
+
+
+class OrderSearchTests(TestCase):
+    """单据检索文档测试"""
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(
+            name='华东医药供应站', contact_person='X', license_no='OS1',
+            province='P', city='C', district='D', street='S', detail_address='A', zip_code='1'
+        )
+        self.amoxicillin = Medicine.objects.create(
+            common_name='阿莫西林胶囊', specification='1g', manufacturer='M',
+            approval_number='HOS1', buy_price=1, sell_price=2
+        )
+        self.vitamin = Medicine.objects.create(
+            common_name='维生素C片', specification='1g', manufacturer='M',
+            approval_number='HOS2', buy_price=1, sell_price=2
+        )
+        self.user = User.objects.create_user(username='finder', password='password', position='purchaser')
+        self.order = PurchaseOrder.objects.create(supplier=self.supplier, employee=self.user)
+        self.detail = self._add_line(self.order, self.amoxicillin)
+        self.other = PurchaseOrder.objects.create(supplier=self.supplier, employee=self.user)
+        self._add_line(self.other, self.vitamin)
+
+    def _add_line(self, order, medicine):
+        today = timezone.now().date()
+        return PurchaseDetail.objects.create(
+            order=order, medicine=medicine, quantity=1, unit_price=1, batch_number='OS',
+            produce_date=today, expiry_date=today + timedelta(days=365)
+        )
+
+    def _search(self, query):
+        from biz.order_search import search_orders
+        return sorted(search_orders(PurchaseOrder, PurchaseOrder.objects.all(), query).values_list('pk', flat=True))
+
+    def test_document_follows_order_and_details(self):
+        from biz.models import OrderSearchDoc
+        doc = OrderSearchDoc.objects.get(kind='purchase', order_id=self.order.pk)
+        self.assertEqual(doc.document, f'PO-{self.order.pk} 华东医药供应站 阿莫西林胶囊')
+
+        self.assertEqual(self._search('莫西林'), [self.order.pk])
+        self.assertEqual(self._search('医药供应'), [self.order.pk, self.other.pk])
+
+        self.detail.medicine = self.vitamin
+        self.detail.save()
+        self.assertEqual(self._search('维生素'), [self.order.pk, self.other.pk])
+        self.vitamin.common_name = '维生素B片'
+        self.vitamin.save()
+        self.assertEqual(self._search('维生素B'), [self.order.pk, self.other.pk])
+
+        self.other.delete()
+        self.assertFalse(OrderSearchDoc.objects.filter(order_id=self.other.pk).exists())
+
+    def test_rebuilds_once_per_order_and_tracks_names_without_select(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from biz.models import OrderSearchDoc
+        from biz.signals import defer_order_totals
+
+        def doc_writes(queries):
+            return [q['sql'] for q in queries.captured_queries if q['sql'].startswith('DELETE FROM "biz_ordersearchdoc"')]
+
+        # 新建单据加两行明细 (表单集保存)：文档只重写一次
+        with CaptureQueriesContext(connection) as queries, defer_order_totals():
+            order = PurchaseOrder.objects.create(supplier=self.supplier, employee=self.user)
+            self._add_line(order, self.amoxicillin)
+            self._add_line(order, self.vitamin)
+        self.assertEqual(len(doc_writes(queries)), 1)
+        self.assertEqual(
+            OrderSearchDoc.objects.get(kind='purchase', order_id=order.pk).document,
+            f'PO-{order.pk} 华东医药供应站 阿莫西林胶囊 维生素C片'
+        )
+
+        # 保存药品时不再先查一次原名称；名称没变时不重写文档
+        medicine = Medicine.objects.get(pk=self.vitamin.pk)
+        with CaptureQueriesContext(connection) as queries:
+            medicine.sell_price = 3
+            medicine.save()
+        self.assertEqual([q['sql'].split()[0] for q in queries.captured_queries], ['UPDATE'])
+        medicine.common_name = '维生素E软胶囊'
+        medicine.save()
+        self.assertEqual(self._search('维生素E'), [self.other.pk, order.pk])
+
+    def test_exact_number_is_primary_key_lookup(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from biz.order_search import search_orders
+        with CaptureQueriesContext(connection) as queries:
+            orders = list(search_orders(PurchaseOrder, PurchaseOrder.objects.all(), f'po-{self.order.pk}'))
+        self.assertEqual(orders, [self.order])
+        self.assertNotIn('ordersearchdoc', ' '.join(q['sql'] for q in queries.captured_queries))
+        # 不存在的单号按检索文档查
+        self.assertEqual(self._search('PO-99999'), [])
+
+    def test_list_view_has_no_distinct(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.client.login(username='finder', password='password')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/purchase/', {'search': '阿莫西林'})
+        self.assertEqual([o.pk for o in response.context['orders']], [self.order.pk])
+        self.assertFalse(any('DISTINCT' in q['sql'] for q in queries.captured_queries))
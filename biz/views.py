@@ -1,18 +1,34 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.db import transaction
 from .models import (
     PurchaseOrder, SalesOrder,
     PurchaseReturnOrder, SalesReturnOrder
 )
+from .signals import defer_order_totals
+from .reservations import reserve_order
+from .stock_writer import get_stock_writer, submit_approval, submit_approvals
+from .reports import cached_report, recent_range, single_flight, summarize
+from .cogs import gross_margin
+from . import cube
+from .receivables import aging_report, bucket_columns, open_orders, order_balance
+from .scorecard import scorecard
+from .pagination import keyset_page
+from .order_search import search_orders
 from .forms import (
     PurchaseOrderForm, SalesOrderForm, PurchaseDetailFormSet, SalesDetailFormSet,
-    PurchaseReturnOrderForm, SalesReturnOrderForm, PurchaseReturnDetailFormSet, SalesReturnDetailFormSet
+    PurchaseReturnOrderForm, SalesReturnOrderForm, PurchaseReturnDetailFormSet, SalesReturnDetailFormSet,
+    ReceiptForm
 )
-from django.db.models import Sum, Count
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+from urllib.parse import urlencode
+from decimal import Decimal
+from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
-from django.db.models.functions import TruncDate
+from base.models import Customer, Supplier
 
 # Helper to check permissions
 def can_manage_orders(user):
@@ -27,18 +43,49 @@ def can_view_finance_data(user):
     # Finance can view Purchase Order, Sales Order, Customer and Supplier
     return user.position in ['finance', 'manager']
 
+def _save_order(form, formset, employee=None, after_save=None):
+    """
+    保存单据表单和明细 (明细保存期间只标记单据，提交前统一重算一次总金额)，返回单据。
+    表单把状态改为 "已审核" 时，单据先按原状态保存，明细写入、总金额重算之后再经 submit_approval 审核过账：
+    未开启组提交时在同一事务中直接过账，失败则整体回滚；
+    开启组提交 (settings.STOCK_WRITER) 时在本事务提交之后交给写入线程，失败时单据已保存、保持原状态。
+    库存不足等错误抛出 ValueError。
+    """
+    order = form.save(commit=False)
+    approving = order.status == 'approved' and order._loaded_status != 'approved'
+    writer = get_stock_writer() if approving else None
+    with transaction.atomic():
+        with defer_order_totals():
+            if approving:
+                order.status = order._loaded_status or 'pending'
+            if employee is not None:
+                order.employee = employee
+            order.save()
+            formset.instance = order
+            formset.save()
+            if after_save is not None:
+                after_save(order)
+        if approving:
+            # 总金额已按新明细重算 (queryset.update)，审核 (信用额度检查等) 使用新金额
+            order.refresh_from_db(fields=['total_amount'])
+            if writer is None:
+                submit_approval(order)
+    if writer is not None:
+        submit_approval(order)
+    return order
+
 @login_required
 def purchase_list(request):
     """采购订单列表视图"""
-    queryset = PurchaseOrder.objects.select_related('supplier', 'employee').prefetch_related('details__medicine').all()
+    queryset = PurchaseOrder.objects.select_related('supplier', 'employee')
     search_query = request.GET.get('search', '')
     if search_query:
-        queryset = queryset.filter(
-            Q(supplier__name__icontains=search_query) |
-            Q(id__icontains=search_query) |
-            Q(details__medicine__common_name__icontains=search_query)
-        ).distinct()
-    orders = queryset.order_by('-order_date')
+        # 查单据检索文档 (单号精确匹配时直接按主键取)，见 biz/order_search.py
+        queryset = search_orders(PurchaseOrder, queryset, search_query)
+    orders = keyset_page(
+        queryset, 'order_date', request.GET.get('after'), request.GET.get('before'),
+        prefetch=['details__medicine'],
+    )
     
     context = {
         'orders': orders,
@@ -57,16 +104,13 @@ def purchase_create(request):
         form = PurchaseOrderForm(request.POST)
         formset = PurchaseDetailFormSet(request.POST)
         if form.is_valid() and formset.is_valid():
-            order = form.save(commit=False)
-            order.employee = request.user
-            order.save()
-            formset.instance = order
-            formset.save()
-            # 更新总金额
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '采购单已创建')
-            return redirect('purchase_list')
+            try:
+                _save_order(form, formset, employee=request.user)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '采购单已创建')
+                return redirect('purchase_list')
     else:
         form = PurchaseOrderForm()
         formset = PurchaseDetailFormSet()
@@ -83,33 +127,58 @@ def purchase_edit(request, pk):
         form = PurchaseOrderForm(request.POST, instance=order)
         formset = PurchaseDetailFormSet(request.POST, instance=order)
         if form.is_valid() and formset.is_valid():
-            form.save()
-            formset.save()
-            # 更新总金额
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '采购单已更新')
-            return redirect('purchase_list')
+            try:
+                _save_order(form, formset)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '采购单已更新')
+                return redirect('purchase_list')
     else:
         form = PurchaseOrderForm(instance=order)
         formset = PurchaseDetailFormSet(instance=order)
     return render(request, 'biz/purchase_form.html', {'form': form, 'formset': formset, 'title': '编辑采购单', 'order': order})
 
+def _bulk_approve(request, order_model, prefix):
+    """批量审核列表页勾选的单据，逐单报告失败原因，成功的单据不受影响"""
+    pks = [pk for pk in request.POST.getlist('order_ids') if pk.isdigit()]
+    if not pks:
+        messages.error(request, '请先勾选要审核的单据')
+        return
+    results = submit_approvals(order_model, pks)
+    approved = sum(1 for order, error in results if error is None)
+    if approved:
+        messages.success(request, f'已审核 {approved} 张单据')
+    for order, error in results:
+        if error:
+            messages.error(request, f'{prefix}-{order.pk} 审核失败：{error}')
+    skipped = len(pks) - len(results)
+    if skipped:
+        messages.warning(request, f'{skipped} 张单据不是待审核状态，已跳过')
+
+@login_required
+def purchase_bulk_approve(request):
+    if not can_manage_orders(request.user):
+        messages.error(request, '无权限审核采购单')
+    elif request.method == 'POST':
+        _bulk_approve(request, PurchaseOrder, 'PO')
+    return redirect('purchase_list')
+
 @login_required
 def sales_list(request):
     """销售订单列表视图"""
-    queryset = SalesOrder.objects.select_related('customer', 'employee').prefetch_related('details__inventory__medicine').all()
+    queryset = SalesOrder.objects.select_related('customer', 'employee')
     
     # Search
     search_query = request.GET.get('search', '')
     if search_query:
-        queryset = queryset.filter(
-            Q(customer__name__icontains=search_query) |
-            Q(id__icontains=search_query) |
-            Q(details__inventory__medicine__common_name__icontains=search_query)
-        ).distinct()
+        # 查单据检索文档 (单号精确匹配时直接按主键取)，见 biz/order_search.py
+        queryset = search_orders(SalesOrder, queryset, search_query)
 
-    orders = queryset.order_by('-order_date')
+    orders = keyset_page(
+        queryset, 'order_date', request.GET.get('after'), request.GET.get('before'),
+        prefetch=['details__medicine'],
+    )
     
     context = {
         'orders': orders,
@@ -128,16 +197,14 @@ def sales_create(request):
         form = SalesOrderForm(request.POST)
         formset = SalesDetailFormSet(request.POST)
         if form.is_valid() and formset.is_valid():
-            order = form.save(commit=False)
-            order.employee = request.user
-            order.save()
-            formset.instance = order
-            formset.save()
-            # 更新总金额
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '销售单已创建')
-            return redirect('sales_list')
+            try:
+                # 待审核销售单按明细预留库存
+                _save_order(form, formset, employee=request.user, after_save=reserve_order)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '销售单已创建')
+                return redirect('sales_list')
     else:
         form = SalesOrderForm()
         formset = SalesDetailFormSet()
@@ -154,80 +221,269 @@ def sales_edit(request, pk):
         form = SalesOrderForm(request.POST, instance=order)
         formset = SalesDetailFormSet(request.POST, instance=order)
         if form.is_valid() and formset.is_valid():
-            form.save()
-            formset.save()
-            # 更新总金额
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '销售单已更新')
-            return redirect('sales_list')
+            try:
+                # 待审核销售单按明细重新预留库存
+                _save_order(form, formset, after_save=reserve_order)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '销售单已更新')
+                return redirect('sales_list')
     else:
         form = SalesOrderForm(instance=order)
         formset = SalesDetailFormSet(instance=order)
     return render(request, 'biz/sales_form.html', {'form': form, 'formset': formset, 'title': '编辑销售单', 'order': order})
 
 @login_required
-def finance_report(request):
-    """财务报表视图"""
-    try:
-        days = int(request.GET.get('days', 30))
-    except Exception:
-        days = 30
-    if days not in [7, 30, 90]:
-        days = 30
-    since = timezone.now() - timedelta(days=days)
-    
-    purchase_stats = PurchaseOrder.objects.filter(order_date__gte=since, status='approved').aggregate(
-        total_orders=Count('id'),
-        total_amount=Sum('total_amount')
-    )
-    
-    sales_stats = SalesOrder.objects.filter(order_date__gte=since, status='approved').aggregate(
-        total_orders=Count('id'),
-        total_amount=Sum('total_amount')
-    )
+def sales_bulk_approve(request):
+    if not can_manage_orders(request.user):
+        messages.error(request, '无权限审核销售单')
+    elif request.method == 'POST':
+        _bulk_approve(request, SalesOrder, 'SO')
+    return redirect('sales_list')
+
+@single_flight()
+def _finance_report_context(start, end):
+    """财务报表的计算结果 (按版本号缓存；并发的相同请求只计算一次，见 biz/reports.py)"""
+    summary = summarize(start, end)
+    purchase_stats = summary['totals']['purchase']
+    sales_stats = summary['totals']['sales']
     
-    profit = (sales_stats['total_amount'] or 0) - (purchase_stats['total_amount'] or 0)
+    profit = sales_stats['total_amount'] - purchase_stats['total_amount']
     
-    purchase_daily_qs = (
-        PurchaseOrder.objects.filter(order_date__gte=since, status='approved')
-        .annotate(d=TruncDate('order_date'))
-        .values('d')
-        .annotate(amount=Sum('total_amount'))
-        .order_by('d')
-    )
-    sales_daily_qs = (
-        SalesOrder.objects.filter(order_date__gte=since, status='approved')
-        .annotate(d=TruncDate('order_date'))
-        .values('d')
-        .annotate(amount=Sum('total_amount'))
-        .order_by('d')
-    )
-    purchase_daily = [{'date': x['d'], 'amount': x['amount'] or 0} for x in purchase_daily_qs]
-    sales_daily = [{'date': x['d'], 'amount': x['amount'] or 0} for x in sales_daily_qs]
+    purchase_daily = summary['daily']['purchase']
+    sales_daily = summary['daily']['sales']
     max_amount = max([*(y['amount'] for y in purchase_daily), *(y['amount'] for y in sales_daily), 1])
     for x in purchase_daily:
         x['pct'] = int((x['amount'] / max_amount) * 100)
     for x in sales_daily:
         x['pct'] = int((x['amount'] / max_amount) * 100)
     
-    # 最近的采购和销售记录（各取前5条）
-    recent_purchases = PurchaseOrder.objects.select_related('supplier').filter(status='approved').order_by('-order_date')[:5]
-    recent_sales = SalesOrder.objects.select_related('customer').filter(status='approved').order_by('-order_date')[:5]
+    # 最近的采购和销售记录（各取前5条，走日期索引，与历史数据量无关）
+    recent_purchases = list(PurchaseOrder.objects.select_related('supplier').filter(status='approved').order_by('-order_date')[:5])
+    recent_sales = list(SalesOrder.objects.select_related('customer').filter(status='approved').order_by('-order_date')[:5])
 
-    context = {
+    return {
         'purchase_stats': purchase_stats,
         'sales_stats': sales_stats,
         'profit': profit,
-        'period': f'最近{days}天',
-        'days': days,
         'purchase_daily': purchase_daily,
         'sales_daily': sales_daily,
         'recent_purchases': recent_purchases,
         'recent_sales': recent_sales,
     }
+
+@login_required
+def finance_report(request):
+    """财务报表视图 (只读每日汇总表 DailyBizSummary，成本与历史单据数量无关)"""
+    # 自定义区间 ?start=YYYY-MM-DD&end=YYYY-MM-DD，否则取最近 7/30/90 天
+    try:
+        start = parse_date(request.GET.get('start') or '')
+        end = parse_date(request.GET.get('end') or '')
+    except ValueError:
+        start = end = None
+    if start and end and start <= end:
+        days = None
+        period = f'{start:%Y-%m-%d} 至 {end:%Y-%m-%d}'
+    else:
+        try:
+            days = int(request.GET.get('days', 30))
+        except Exception:
+            days = 30
+        if days not in [7, 30, 90]:
+            days = 30
+        start, end = recent_range(days)
+        period = f'最近{days}天'
+
+    # 缓存/单飞返回的结果可能被多个请求共用，复制一份再加入本次请求的参数
+    context = {
+        **cached_report('finance', (start, end), lambda: _finance_report_context(start, end)),
+        'period': period, 'days': days, 'start': start, 'end': end,
+    }
     return render(request, 'biz/finance_report.html', context)
 
+@login_required
+def margin_report(request):
+    """按 FIFO 销售成本计算的毛利 (按月份、按药品)"""
+    if not (request.user.is_superuser or can_view_finance_data(request.user)):
+        messages.error(request, '无权限查看毛利分析')
+        return redirect('index')
+    try:
+        start = parse_date(request.GET.get('start') or '')
+        end = parse_date(request.GET.get('end') or '')
+    except ValueError:
+        start = end = None
+    if not (start and end and start <= end):
+        start, end = recent_range(30)
+
+    result = gross_margin(start, end)
+    context = {
+        'start': start,
+        'end': end,
+        'totals': result['totals'],
+        'by_medicine': result['by_medicine'],
+        'by_period': result['by_period'],
+    }
+    return render(request, 'biz/margin_report.html', context)
+
+@login_required
+def sales_cube(request):
+    """销售多维分析：按任意维度上卷，点击行下钻 (只读销售立方体 SalesCube)"""
+    if not (request.user.is_superuser or can_view_finance_data(request.user)):
+        messages.error(request, '无权限查看销售分析')
+        return redirect('index')
+
+    by = request.GET.get('by', 'month')
+    if by not in cube.DIMENSIONS:
+        by = 'month'
+    # 其余查询参数中的维度即切片条件，如 ?by=city&province=广东省&month=2026-01
+    filters = {dim: request.GET[dim] for dim in cube.DIMENSIONS if request.GET.get(dim) and dim != by}
+    try:
+        rows = cached_report('sales_cube', (by, *sorted(filters.items())), lambda: cube.cube_query(by, filters))
+    except ValueError:
+        messages.error(request, '筛选条件格式不正确')
+        return redirect('sales_cube')
+
+    next_by = cube.next_dimension(by, filters)
+    drill = [
+        {**row, 'drill_url': '?' + urlencode({**filters, by: row[by], 'by': next_by}) if next_by else None}
+        for row in rows
+    ]
+    # 面包屑：每个切片条件都可以单独去掉
+    crumbs = [
+        {
+            'name': cube.DIMENSIONS[dim][1],
+            'value': cube.filter_label(dim, value),
+            'remove_url': '?' + urlencode({**{k: v for k, v in filters.items() if k != dim}, 'by': by}),
+        }
+        for dim, value in filters.items()
+    ]
+    context = {
+        'by': by,
+        'by_name': cube.DIMENSIONS[by][1],
+        'dimensions': [(dim, name) for dim, (field, name) in cube.DIMENSIONS.items() if dim not in filters],
+        'filters': filters,
+        'crumbs': crumbs,
+        'rows': drill,
+        'total_quantity': sum(row['quantity'] for row in rows),
+        'total_amount': sum((row['amount'] for row in rows), Decimal('0')),
+    }
+    return render(request, 'biz/sales_cube.html', context)
+
+@login_required
+def supplier_scorecard(request):
+    """供应商评分：进货量、退货率、价格偏差、平均效期 (只读供应商月度指标)"""
+    if not (request.user.is_superuser or request.user.position in ['purchaser', 'manager', 'finance']):
+        messages.error(request, '无权限查看供应商评分')
+        return redirect('index')
+    try:
+        months = int(request.GET.get('months', 12))
+    except ValueError:
+        months = 12
+    if months not in [3, 6, 12, 24]:
+        months = 12
+    end = timezone.localdate().replace(day=1)
+    start = end
+    for _ in range(months - 1):
+        start = (start - timedelta(days=1)).replace(day=1)
+
+    supplier = None
+    supplier_id = request.GET.get('supplier')
+    if supplier_id and supplier_id.isdigit():
+        supplier = get_object_or_404(Supplier, pk=supplier_id)
+
+    rows = scorecard(start, end)
+    sort = request.GET.get('sort', 'volume')
+    sort_keys = {
+        'volume': lambda row: -row['purchase_amount'],
+        'return_rate': lambda row: (row['return_rate'] is None, -(row['return_rate'] or 0)),
+        'price_drift': lambda row: (row['price_drift'] is None, -(row['price_drift'] or 0)),
+        'shelf_life': lambda row: (row['avg_shelf_life'] is None, row['avg_shelf_life'] or 0),
+    }
+    if sort not in sort_keys:
+        sort = 'volume'
+    rows.sort(key=sort_keys[sort])
+    context = {
+        'rows': rows,
+        'months': months,
+        'start': start,
+        'sort': sort,
+        'supplier': supplier,
+        'monthly': scorecard(start, end, supplier.pk) if supplier else [],
+    }
+    return render(request, 'biz/supplier_scorecard.html', context)
+
+# ==========================================
+# 应收账款视图
+# ==========================================
+@login_required
+def receivables_aging(request):
+    """应收账款账龄 (一条分组查询)；?customer=<id> 时列出该客户的未收销售单"""
+    if not (request.user.is_superuser or can_view_finance_data(request.user)):
+        messages.error(request, '无权限查看应收账款')
+        return redirect('index')
+    try:
+        as_of = parse_date(request.GET.get('as_of') or '')
+    except ValueError:
+        as_of = None
+    as_of = as_of or timezone.localdate()
+
+    rows, totals = aging_report(as_of)
+    customer = None
+    orders = []
+    customer_id = request.GET.get('customer')
+    if customer_id and customer_id.isdigit():
+        customer = get_object_or_404(Customer, pk=customer_id)
+        orders = open_orders(as_of).filter(customer=customer).order_by('order_date')
+    context = {
+        'as_of': as_of,
+        'buckets': bucket_columns(),
+        'rows': rows,
+        'totals': totals,
+        'customer': customer,
+        'orders': orders,
+    }
+    return render(request, 'biz/receivables_aging.html', context)
+
+@login_required
+def receipt_create(request, pk):
+    """登记销售单收款"""
+    if not (request.user.is_superuser or can_view_finance_data(request.user)):
+        messages.error(request, '无权限登记收款')
+        return redirect('index')
+    order = get_object_or_404(SalesOrder.objects.select_related('customer'), pk=pk)
+    if order.status != 'approved':
+        messages.error(request, '只能对已审核的销售单收款')
+        return redirect('receivables_aging')
+
+    if request.method == 'POST':
+        form = ReceiptForm(request.POST)
+        if form.is_valid():
+            with transaction.atomic():
+                # 锁住销售单，并发登记收款时不会超收
+                order = SalesOrder.objects.select_for_update().get(pk=order.pk)
+                balance = order_balance(order)
+                if form.cleaned_data['amount'] > balance:
+                    form.add_error('amount', f'超过未收余额 ¥{balance}')
+                else:
+                    receipt = form.save(commit=False)
+                    receipt.order = order
+                    receipt.employee = request.user
+                    receipt.save()
+            if not form.errors:
+                messages.success(request, f'SO-{order.pk} 收款 ¥{receipt.amount} 已登记')
+                return redirect(f"{reverse('receivables_aging')}?customer={order.customer_id}")
+    else:
+        form = ReceiptForm(initial={'amount': order_balance(order)})
+    context = {
+        'form': form,
+        'order': order,
+        'balance': order_balance(order),
+        'receipts': order.receipts.select_related('employee'),
+        'title': f'登记收款 - SO-{order.pk}',
+    }
+    return render(request, 'biz/receipt_form.html', context)
+
 # ==========================================
 # 采购退货视图
 # ==========================================
@@ -237,15 +493,15 @@ def purchase_return_list(request):
         messages.error(request, '无权限访问采购退货模块')
         return redirect('index')
         
-    queryset = PurchaseReturnOrder.objects.select_related('supplier', 'employee').prefetch_related('details__inventory__medicine').all()
+    queryset = PurchaseReturnOrder.objects.select_related('supplier', 'employee')
     search_query = request.GET.get('search', '')
     if search_query:
-        queryset = queryset.filter(
-            Q(supplier__name__icontains=search_query) |
-            Q(id__icontains=search_query) |
-            Q(details__inventory__medicine__common_name__icontains=search_query)
-        ).distinct()
-    orders = queryset.order_by('-return_date')
+        # 查单据检索文档 (单号精确匹配时直接按主键取)，见 biz/order_search.py
+        queryset = search_orders(PurchaseReturnOrder, queryset, search_query)
+    orders = keyset_page(
+        queryset, 'return_date', request.GET.get('after'), request.GET.get('before'),
+        prefetch=['details__inventory__medicine'],
+    )
     
     context = {
         'orders': orders,
@@ -264,15 +520,13 @@ def purchase_return_create(request):
         form = PurchaseReturnOrderForm(request.POST)
         formset = PurchaseReturnDetailFormSet(request.POST)
         if form.is_valid() and formset.is_valid():
-            order = form.save(commit=False)
-            order.employee = request.user
-            order.save()
-            formset.instance = order
-            formset.save()
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '采购退货单已创建')
-            return redirect('purchase_return_list')
+            try:
+                _save_order(form, formset, employee=request.user)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '采购退货单已创建')
+                return redirect('purchase_return_list')
     else:
         form = PurchaseReturnOrderForm()
         formset = PurchaseReturnDetailFormSet()
@@ -289,12 +543,13 @@ def purchase_return_edit(request, pk):
         form = PurchaseReturnOrderForm(request.POST, instance=order)
         formset = PurchaseReturnDetailFormSet(request.POST, instance=order)
         if form.is_valid() and formset.is_valid():
-            form.save()
-            formset.save()
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '采购退货单已更新')
-            return redirect('purchase_return_list')
+            try:
+                _save_order(form, formset)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '采购退货单已更新')
+                return redirect('purchase_return_list')
     else:
         form = PurchaseReturnOrderForm(instance=order)
         formset = PurchaseReturnDetailFormSet(instance=order)
@@ -309,15 +564,15 @@ def sales_return_list(request):
         messages.error(request, '无权限访问销售退货模块')
         return redirect('index')
         
-    queryset = SalesReturnOrder.objects.select_related('customer', 'employee').prefetch_related('details__inventory__medicine').all()
+    queryset = SalesReturnOrder.objects.select_related('customer', 'employee')
     search_query = request.GET.get('search', '')
     if search_query:
-        queryset = queryset.filter(
-            Q(customer__name__icontains=search_query) |
-            Q(id__icontains=search_query) |
-            Q(details__inventory__medicine__common_name__icontains=search_query)
-        ).distinct()
-    orders = queryset.order_by('-return_date')
+        # 查单据检索文档 (单号精确匹配时直接按主键取)，见 biz/order_search.py
+        queryset = search_orders(SalesReturnOrder, queryset, search_query)
+    orders = keyset_page(
+        queryset, 'return_date', request.GET.get('after'), request.GET.get('before'),
+        prefetch=['details__inventory__medicine'],
+    )
     
     context = {
         'orders': orders,
@@ -336,15 +591,13 @@ def sales_return_create(request):
         form = SalesReturnOrderForm(request.POST)
         formset = SalesReturnDetailFormSet(request.POST)
         if form.is_valid() and formset.is_valid():
-            order = form.save(commit=False)
-            order.employee = request.user
-            order.save()
-            formset.instance = order
-            formset.save()
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '销售退货单已创建')
-            return redirect('sales_return_list')
+            try:
+                _save_order(form, formset, employee=request.user)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '销售退货单已创建')
+                return redirect('sales_return_list')
     else:
         form = SalesReturnOrderForm()
         formset = SalesReturnDetailFormSet()
@@ -361,12 +614,13 @@ def sales_return_edit(request, pk):
         form = SalesReturnOrderForm(request.POST, instance=order)
         formset = SalesReturnDetailFormSet(request.POST, instance=order)
         if form.is_valid() and formset.is_valid():
-            form.save()
-            formset.save()
-            order.total_amount = sum(item.total_amount for item in order.details.all())
-            order.save()
-            messages.success(request, '销售退货单已更新')
-            return redirect('sales_return_list')
+            try:
+                _save_order(form, formset)
+            except ValueError as e:
+                messages.error(request, str(e))
+            else:
+                messages.success(request, '销售退货单已更新')
+                return redirect('sales_return_list')
     else:
         form = SalesReturnOrderForm(instance=order)
         formset = SalesReturnDetailFormSet(instance=order)
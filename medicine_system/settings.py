@@ -123,3 +123,41 @@ USE_TZ = True
 STATIC_URL = 'static/'
 
 AUTH_USER_MODEL = 'users.Employee'
+
+# 库存扣减策略 (biz/stock.py)：
+# 'conditional' 单条条件 UPDATE 完成检查和扣减；'locked' 先 select_for_update 再扣减
+STOCK_DEDUCT_STRATEGY = 'conditional'
+
+
+# 待审核销售单的库存预留有效期 (分钟)，过期后由 release_expired_reservations 命令释放
+STOCK_RESERVATION_TTL_MINUTES = 24 * 60
+
+# 开启分片计数的热销批次默认拆成几个分片 (base/shards.py)
+STOCK_SHARD_COUNT = 8
+
+# 组提交库存写入服务 (biz/stock_writer.py)，SQLite 下高并发审核时可开启：
+# 审核请求排队，由单个写入线程每攒够 MAX_BATCH 个或等满 MAX_WAIT_MS 毫秒合并提交一次
+STOCK_WRITER = {
+    'ENABLED': False,
+    'MAX_BATCH': 50,
+    'MAX_WAIT_MS': 5,
+}
+
+# 缓存：报表结果按版本号缓存 (biz/reports.py)，多进程部署请改为 Redis/Memcached 等共享缓存
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 多进程 (多个 worker) 共享的缓存，存放财务报表版本号 (biz/reports.py)：
+    # 一个进程审核单据后其他进程立即看到新版本号。缓存表由 python manage.py createcachetable 创建
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_shared_cache',
+    },
+}
+
+# 报表缓存的最长保留时间 (秒)；审核单据时会立即失效，不依赖这个时间
+REPORT_CACHE_TIMEOUT = 60 * 60
+
+# 带筛选条件的列表 (药品库存、药品信息) 总条数的缓存时间 (秒)，见 base/pagination.py
+LIST_COUNT_CACHE_TIMEOUT = 30
\ No newline at end of file
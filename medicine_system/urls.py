@@ -37,6 +37,9 @@ urlpatterns = [
     path('inventory/<int:pk>/adjust/', base_views.inventory_adjust, name='inventory_adjust'),
     path('inventory/new/', base_views.inventory_create, name='inventory_create'),
     path('inventory/<int:pk>/edit/', base_views.inventory_edit, name='inventory_edit'),
+    path('inventory/valuation/', base_views.inventory_valuation, name='inventory_valuation'),
+    path('inventory/valuation/export/', base_views.inventory_valuation_csv, name='inventory_valuation_csv'),
+    path('inventory/expiry/', base_views.expiry_dashboard, name='expiry_dashboard'),
     path('medicine-info/', base_views.medicine_info_list, name='medicine_info_list'),
     path('medicine-info/new/', base_views.medicine_create, name='medicine_create'),
     path('customer/', base_views.customer_list, name='customer_list'),
@@ -45,13 +48,20 @@ urlpatterns = [
     path('supplier/', base_views.supplier_list, name='supplier_list'),
     path('supplier/new/', base_views.supplier_create, name='supplier_create'),
     path('supplier/<int:pk>/edit/', base_views.supplier_edit, name='supplier_edit'),
+    path('supplier/scorecard/', biz_views.supplier_scorecard, name='supplier_scorecard'),
     path('purchase/', biz_views.purchase_list, name='purchase_list'),
     path('purchase/new/', biz_views.purchase_create, name='purchase_create'),
     path('purchase/<int:pk>/edit/', biz_views.purchase_edit, name='purchase_edit'),
+    path('purchase/approve/', biz_views.purchase_bulk_approve, name='purchase_bulk_approve'),
     path('sales/', biz_views.sales_list, name='sales_list'),
     path('sales/new/', biz_views.sales_create, name='sales_create'),
     path('sales/<int:pk>/edit/', biz_views.sales_edit, name='sales_edit'),
+    path('sales/approve/', biz_views.sales_bulk_approve, name='sales_bulk_approve'),
     path('finance-report/', biz_views.finance_report, name='finance_report'),
+    path('finance-report/margin/', biz_views.margin_report, name='margin_report'),
+    path('finance-report/cube/', biz_views.sales_cube, name='sales_cube'),
+    path('finance-report/aging/', biz_views.receivables_aging, name='receivables_aging'),
+    path('sales/<int:pk>/receipt/', biz_views.receipt_create, name='receipt_create'),
     path('purchase-return/', biz_views.purchase_return_list, name='purchase_return_list'),
     path('purchase-return/new/', biz_views.purchase_return_create, name='purchase_return_create'),
     path('purchase-return/<int:pk>/edit/', biz_views.purchase_return_edit, name='purchase_return_edit'),
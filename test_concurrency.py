@@ -8,9 +8,12 @@ import random
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'medicine_system.settings')
 django.setup()
 
+from django.conf import settings
+
 from biz.models import SalesOrder, SalesDetail
 from base.models import Inventory, Customer, Medicine
 from users.models import Employee
+from biz.stock_writer import StockWriter
 
 def create_test_data():
     """准备测试数据：确保有一个库存为 10 的商品"""
@@ -43,9 +46,10 @@ def create_test_data():
         print(f"数据准备失败: {e}")
         return None
 
-def worker_buy(inventory_id, customer, employee, quantity, thread_name):
+def worker_buy(inventory_id, customer, employee, quantity, thread_name, results, writer=None):
     """
-    模拟一个线程尝试购买
+    模拟一个线程尝试购买，结果记入 results: 'ok' / 'short' / 'error'
+    writer 不为空时，审核请求交给组提交写入线程处理
     """
     try:
         # 模拟网络延迟
@@ -72,37 +76,58 @@ def worker_buy(inventory_id, customer, employee, quantity, thread_name):
         
         # 3. 尝试审核 (触发并发锁逻辑)
         print(f"[{thread_name}] ---> 点击审核！")
-        order.status = 'approved'
-        order.save() # 这里会触发 signals.py 里的逻辑
+        if writer is not None:
+            writer.approve(SalesOrder, order.pk)
+        else:
+            order.status = 'approved'
+            order.save() # 这里会触发 signals.py 里的逻辑
         
         print(f"[{thread_name}] ✅✅✅ 抢购成功！")
+        results.append('ok')
         
     except ValueError as e:
         # 捕获库存不足的错误
         print(f"[{thread_name}] ❌ 抢购失败 (预期内): {e}")
+        results.append('short')
     except Exception as e:
+        # SQLite 下常见的是 "database is locked"
         print(f"[{thread_name}] ❌ 发生未知错误: {e}")
+        results.append('error')
 
-if __name__ == "__main__":
-    # 1. 准备数据
+def run_scenario(strategy, threads_count=5, quantity=3):
+    """
+    用指定的扣减策略跑一轮并发抢购，返回统计结果。
+    strategy 对应 settings.STOCK_DEDUCT_STRATEGY：
+      - 'locked'：select_for_update 加锁读取 -> 检查 -> 扣减 (旧路径)
+      - 'conditional'：单条 UPDATE ... WHERE quantity >= n (新路径)
+      - 'writer'：conditional + 组提交写入线程 (biz/stock_writer.py)
+    """
+    writer = None
+    if strategy == 'writer':
+        writer = StockWriter(max_batch=50, max_wait_ms=20)
+        settings.STOCK_DEDUCT_STRATEGY = 'conditional'
+    else:
+        settings.STOCK_DEDUCT_STRATEGY = strategy
+
+    # 1. 准备数据 (每轮都把库存重置为 10)
     data = create_test_data()
     if not data:
-        exit()
-    
+        return None
     inv_id, cust, emp = data
-    
+
     # 2. 模拟高并发场景
     # 库存 10 个。
     # 启动 5 个线程，每个买 3 个。总需求 15 个。
     # 预期结果：前 3 个线程成功 (消耗9个)，剩 1 个。第 4、5 个线程应该失败。
-    
     threads = []
-    print("\n>>> 开始并发测试 (5个线程，每人买3个，总库存10个)...\n")
-    
-    for i in range(5):
+    results = []
+    print(f"\n>>> [{strategy}] 开始并发测试 ({threads_count}个线程，每人买{quantity}个，总库存10个)...\n")
+
+    started = time.perf_counter()
+    for i in range(threads_count):
         t = threading.Thread(
             target=worker_buy, 
-            args=(inv_id, cust, emp, 3, f"Thread-{i+1}")
+            args=(inv_id, cust, emp, quantity, f"Thread-{i+1}", results, writer)
         )
         threads.append(t)
         t.start()
@@ -110,15 +135,37 @@ if __name__ == "__main__":
     # 等待所有线程结束
     for t in threads:
         t.join()
-        
-    # 3. 验证结果
+    elapsed = time.perf_counter() - started
+    if writer is not None:
+        writer.stop()
+
     final_inv = Inventory.objects.get(id=inv_id)
-    print("\n" + "="*30)
-    print(f"测试结束。")
-    print(f"最终库存: {final_inv.quantity}")
-    
-    if final_inv.quantity >= 0:
-        print("✅ 测试通过：库存没有变成负数！")
-    else:
-        print("❌ 测试失败：出现超卖 (库存为负)！")
-    print("="*30)
\ No newline at end of file
+    return {
+        'strategy': strategy,
+        'ok': results.count('ok'),
+        'short': results.count('short'),
+        'error': results.count('error'),
+        'final': final_inv.quantity,
+        'elapsed': elapsed,
+    }
+
+
+if __name__ == "__main__":
+    # 新旧两种扣减路径各跑一轮，对比结果
+    reports = [run_scenario('locked'), run_scenario('conditional'), run_scenario('writer')]
+    if not all(reports):
+        exit()
+
+    # 3. 验证结果
+    print("\n" + "="*60)
+    print("测试结束。扣减策略对比：")
+    print(f"{'策略':<14}{'成功':>6}{'库存不足':>10}{'其他错误':>10}{'最终库存':>10}{'耗时(秒)':>10}")
+    for r in reports:
+        print(f"{r['strategy']:<14}{r['ok']:>6}{r['short']:>10}{r['error']:>10}{r['final']:>10}{r['elapsed']:>10.3f}")
+
+    for r in reports:
+        if r['final'] >= 0 and r['final'] == 10 - 3 * r['ok']:
+            print(f"✅ [{r['strategy']}] 测试通过：库存没有变成负数，且与成功订单数一致！")
+        else:
+            print(f"❌ [{r['strategy']}] 测试失败：出现超卖或库存与成功订单数不符！")
+    print("="*60)